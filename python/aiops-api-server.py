@@ -0,0 +1,401 @@
+#!/usr/bin/python3.11
+
+#
+# Stand-in Watson AIOps / Predictive Insights metric API, for load testing the datachannel offline
+#
+# Serves the AIOps metric API (POST /aiops/api/app/metric-api/v1/metrics) and the PI REST mediation API
+# (POST /metrics/api/1.0/metrics) over HTTP, or HTTPS with --tls-cert and --tls-key. Each post is checked
+# for the tenant and authorization headers the datachannel sends, decompressed if it was sent with a
+# Content-Encoding, and the metrics in it are counted. Faults can be injected to measure the retry cost,
+# batch loss and recovery time of the datachannel: response latency, a throughput cap, 413/429/500/503
+# response rates, connection resets, and outages at set times. Point watsonRestRoute at it, e.g.:
+#
+#    python3 aiops-api-server.py --port 9100 --latency 50 --rate-503 0.02 --outage 120+60
+#    watsonRestRoute = "http://127.0.0.1:9100/aiops/api/app/metric-api/v1/metrics"
+#
+# The expected credentials are read from conf/sevone-watson-datachannel.props (watsonTenantId, watsonUser,
+# watsonApiKey, watsonTopicName and the restMediationService* properties) unless they are given on the
+# command line. python/zabbix-benchmark.py posts as user "benchmark" with API key "benchmark".
+#
+# GET /stats returns the counts as JSON, a summary is printed every --report-interval seconds, and
+# --stats-file writes the final counts when the server is stopped
+#
+
+import argparse
+import base64
+import collections
+import gzip
+import http.server
+import json
+import os
+import random
+import signal
+import socket
+import ssl
+import struct
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+
+aiopsPath = "/aiops/api/app/metric-api/v1/metrics"
+piPath = "/metrics/api/1.0/metrics"
+
+def loadProperties(filepath, sep='=', comment_char='#'):
+
+   # reads the datachannel properties file, as the datachannel does
+
+   props = {}
+   with open(filepath, "rt") as f:
+      for line in f:
+         l = line.strip()
+         if l and not l.startswith(comment_char) and "=" in l:
+            key_value = l.split(sep)
+            key = key_value[0].strip()
+            value = sep.join(key_value[1:]).strip().strip('"')
+            props[key] = value
+   return props
+
+def log(message):
+
+   print(datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " " + message, flush=True)
+
+##########################################################################
+#
+# Counts. Every request is counted by its outcome, and the accepted
+# metrics by request and by metric value. With --track-duplicates the
+# resource, timestamp and metric name of every accepted value is kept, so
+# that values posted again after a retry are counted as duplicates
+#
+##########################################################################
+
+statsLock = threading.Lock()
+stats = collections.Counter()
+seenMetrics = set()
+serverStart = time.time()
+outageEndedAt = None
+endedOutages = set()
+recoveryTimes = []
+
+def countMetrics(body):
+
+   # returns the number of metric entries and metric values in a posted {"groups": [...]} body, and their keys
+
+   groups = json.loads(body)["groups"]
+   values = 0
+   keys = []
+   for group in groups:
+      values += len(group["metrics"])
+      if options.track_duplicates:
+         for metric in group["metrics"]:
+            keys.append((group.get("resourceID"), group.get("timestamp"), metric))
+   return len(groups), values, keys
+
+def snapshot():
+
+   with statsLock:
+      counts = dict(stats)
+   elapsed = time.time() - serverStart
+   return {
+      "uptimeSeconds": round(elapsed, 1),
+      "counts": counts,
+      "acceptedMetricsPerSecond": round(counts.get("acceptedMetrics", 0) / elapsed, 1) if elapsed > 0 else 0,
+      "recoverySeconds": list(recoveryTimes)
+   }
+
+def reporter():
+
+   previous = collections.Counter()
+   while True:
+      time.sleep(options.report_interval)
+      with statsLock:
+         current = collections.Counter(stats)
+      delta = current - previous
+      previous = current
+      faults = ", ".join(name[len("fault_"):] + " " + str(count) for name, count in sorted(delta.items()) if name.startswith("fault_"))
+      log(str(delta["requests"]) + " requests, " + str(delta["acceptedMetrics"]) + " metrics accepted (" + str(round(delta["acceptedMetrics"] / options.report_interval, 1)) + "/s), " + str(delta["duplicateMetrics"]) + " duplicates, " + str(delta["authFailures"]) + " auth failures, faults: " + (faults or "none"))
+
+##########################################################################
+#
+# Fault injection. Outages are windows of seconds after the server
+# started during which every post fails. The throughput cap is a token
+# bucket of metrics per second, which either delays posts until it has
+# room or rejects them with 429. The random faults are drawn per post
+#
+##########################################################################
+
+def parseOutage(value):
+
+   try:
+      start, duration = value.split("+")
+      return float(start), float(start) + float(duration)
+   except ValueError:
+      raise argparse.ArgumentTypeError("an outage is given as START+DURATION in seconds, e.g. 120+60")
+
+def inOutage():
+
+   global outageEndedAt
+
+   elapsed = time.time() - serverStart
+   for start, end in options.outage:
+      if start <= elapsed < end:
+         return True
+   with statsLock:
+      for outage, (start, end) in enumerate(options.outage):
+         if elapsed >= end and outage not in endedOutages:
+            endedOutages.add(outage)
+            outageEndedAt = serverStart + end
+   return False
+
+capLock = threading.Lock()
+capTokens = float("inf")
+capUpdated = time.time()
+
+def takeCapacity(metricCount):
+
+   # returns how long to wait before the metrics fit under the throughput cap
+
+   global capTokens
+   global capUpdated
+
+   with capLock:
+      now = time.time()
+      capTokens = min(capTokens + (now - capUpdated) * options.max_metrics_per_sec, float(options.max_metrics_per_sec))
+      capUpdated = now
+      capTokens -= metricCount
+      if capTokens >= 0:
+         return 0
+      if options.throttle == "reject":
+         capTokens += metricCount
+      return -capTokens / options.max_metrics_per_sec
+
+def drawFault():
+
+   draw = random.random()
+   for name, rate in [ ("413", options.rate_413), ("429", options.rate_429), ("500", options.rate_500), ("503", options.rate_503), ("reset", options.rate_reset) ]:
+      if draw < rate:
+         return name
+      draw -= rate
+   return None
+
+##########################################################################
+#
+# Request handling
+#
+##########################################################################
+
+class MetricApiHandler(http.server.BaseHTTPRequestHandler):
+
+   protocol_version = "HTTP/1.1"
+
+   def do_POST(self):
+
+      global outageEndedAt
+
+      with statsLock:
+         stats["requests"] += 1
+      body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+      with statsLock:
+         stats["bytesReceived"] += len(body)
+
+      if self.path not in [ aiopsPath, piPath ]:
+         return self.reply(404, "unknown path")
+      if not self.authorized():
+         with statsLock:
+            stats["authFailures"] += 1
+         return
+
+      if options.latency > 0 or options.latency_jitter > 0:
+         time.sleep(max(options.latency + random.uniform(-options.latency_jitter, options.latency_jitter), 0) / 1000.0)
+
+      if inOutage():
+         return self.fault(options.outage_mode)
+      if options.max_body_bytes > 0 and len(body) > options.max_body_bytes:
+         return self.fault("413")
+      fault = drawFault()
+      if fault is not None:
+         return self.fault(fault)
+
+      encoding = self.headers.get("Content-Encoding", "identity").lower()
+      try:
+         if encoding == "gzip":
+            body = gzip.decompress(body)
+         elif encoding == "deflate":
+            body = zlib.decompress(body)
+         metricCount, valueCount, keys = countMetrics(body)
+      except (ValueError, KeyError, TypeError, OSError, zlib.error) as error:
+         with statsLock:
+            stats["badRequests"] += 1
+         return self.reply(400, "unable to parse the metric payload: " + str(error))
+
+      if options.max_metrics_per_sec > 0:
+         wait = takeCapacity(metricCount)
+         if wait > 0:
+            if options.throttle == "reject":
+               return self.fault("429", retryAfter=max(int(wait + 0.999), 1))
+            with statsLock:
+               stats["throttledWaits"] += 1
+            time.sleep(wait)
+
+      with statsLock:
+         stats["acceptedRequests"] += 1
+         stats["acceptedMetrics"] += metricCount
+         stats["acceptedValues"] += valueCount
+         if options.track_duplicates:
+            for key in keys:
+               if key in seenMetrics:
+                  stats["duplicateMetrics"] += 1
+               else:
+                  seenMetrics.add(key)
+         if outageEndedAt is not None:
+            recoveryTimes.append(round(time.time() - outageEndedAt, 3))
+            log("First post accepted " + str(recoveryTimes[-1]) + " seconds after the outage ended")
+            outageEndedAt = None
+      self.reply(200, None)
+
+   def do_GET(self):
+
+      if self.path == "/stats":
+         body = json.dumps(snapshot(), indent=3).encode("utf-8")
+         self.send_response(200)
+         self.send_header("Content-Type", "application/json")
+         self.send_header("Content-Length", str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+      else:
+         self.reply(404, "unknown path")
+
+   def authorized(self):
+
+      # the AIOps API takes a tenant id and a ZenApiKey, the PI mediation service its topic as tenant and optional basic auth
+
+      if options.no_auth:
+         return True
+      if self.path == aiopsPath:
+         tenant = options.tenant_id
+         authorization = "ZenApiKey " + base64.b64encode((options.user + ":" + options.api_key).encode("utf-8")).decode("ascii")
+      else:
+         tenant = options.pi_tenant
+         if options.pi_user:
+            authorization = "Basic " + base64.b64encode((options.pi_user + ":" + options.pi_password).encode("utf-8")).decode("ascii")
+         else:
+            authorization = None
+      if self.headers.get("X-TenantID") != tenant:
+         self.reply(403, "unknown tenant " + str(self.headers.get("X-TenantID")))
+         return False
+      if authorization is not None and self.headers.get("Authorization") != authorization:
+         self.reply(401, "not authorized")
+         return False
+      return True
+
+   def fault(self, kind, retryAfter=1):
+
+      with statsLock:
+         stats["fault_" + kind] += 1
+      if kind == "reset":
+
+         # close the connection with a RST instead of a response
+
+         self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+         self.close_connection = True
+         os.close(self.connection.detach())
+         return
+      reasons = { "413": "payload too large", "429": "too many requests", "500": "internal server error", "503": "service unavailable" }
+      self.reply(int(kind), reasons[kind], retryAfter=retryAfter if kind in [ "429", "503" ] else None)
+
+   def reply(self, code, message, retryAfter=None):
+
+      if code != 200:
+         with statsLock:
+            stats["responses_" + str(code)] += 1
+      body = json.dumps({ "message": message } if message else {}).encode("utf-8")
+      self.send_response(code)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      if retryAfter is not None:
+         self.send_header("Retry-After", str(retryAfter))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, format, *args):
+      pass
+
+def stopServer(*args):
+
+   if options.stats_file:
+      with open(options.stats_file, "w") as statsFile:
+         json.dump(snapshot(), statsFile, indent=3)
+      log("Counts written to " + options.stats_file)
+   log("Final counts: " + json.dumps(snapshot()["counts"], sort_keys=True))
+   os._exit(0)
+
+#############
+#
+# Begins here
+#
+#############
+
+mediatorHome = os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))
+propsFile = mediatorHome + "/conf/sevone-watson-datachannel.props"
+if os.path.exists(propsFile):
+   datachannelProps = loadProperties(propsFile)
+else:
+   datachannelProps = {}
+
+argParser = argparse.ArgumentParser(description="Stand-in Watson AIOps / PI metric API with latency and fault injection")
+argParser.add_argument("--bind", default="127.0.0.1", help="address to listen on (default 127.0.0.1)")
+argParser.add_argument("--port", type=int, default=9100, help="port to listen on (default 9100)")
+argParser.add_argument("--tls-cert", default=None, help="serve HTTPS with this certificate (PEM)")
+argParser.add_argument("--tls-key", default=None, help="private key of the TLS certificate (PEM)")
+argParser.add_argument("--tenant-id", default=datachannelProps.get("watsonTenantId", "cfd95b7e-3bc7-4006-a4a8-a73a79c71255"), help="expected AIOps X-TenantID (default watsonTenantId)")
+argParser.add_argument("--user", default=datachannelProps.get("watsonUser", "admin"), help="expected AIOps API user (default watsonUser)")
+argParser.add_argument("--api-key", default=datachannelProps.get("watsonApiKey", ""), help="expected AIOps API key (default watsonApiKey)")
+argParser.add_argument("--pi-tenant", default=datachannelProps.get("watsonTopicName", "ZABBIX"), help="expected PI X-TenantID (default watsonTopicName)")
+argParser.add_argument("--pi-user", default=datachannelProps.get("restMediationServiceUsername") if datachannelProps.get("restMediationServiceAuthentication", "false").lower() == "true" else None, help="expected PI basic auth user (default restMediationServiceUsername, if restMediationServiceAuthentication is true)")
+argParser.add_argument("--pi-password", default=datachannelProps.get("restMediationServicePassword", ""), help="expected PI basic auth password (default restMediationServicePassword)")
+argParser.add_argument("--no-auth", action="store_true", help="accept posts without checking the tenant and authorization headers")
+argParser.add_argument("--latency", type=float, default=0, help="response latency in milliseconds (default 0)")
+argParser.add_argument("--latency-jitter", type=float, default=0, help="random +/- variation of the latency in milliseconds (default 0)")
+argParser.add_argument("--max-metrics-per-sec", type=int, default=0, help="throughput cap in metrics per second, 0 for none (default 0)")
+argParser.add_argument("--throttle", choices=[ "delay", "reject" ], default="delay", help="over the cap, delay the response until there is room, or reject the post with 429 (default delay)")
+argParser.add_argument("--max-body-bytes", type=int, default=0, help="reject posts with a larger body with 413, 0 for no limit (default 0)")
+argParser.add_argument("--rate-413", type=float, default=0, help="share of posts rejected with 413 payload too large (default 0)")
+argParser.add_argument("--rate-429", type=float, default=0, help="share of posts rejected with 429 too many requests (default 0)")
+argParser.add_argument("--rate-500", type=float, default=0, help="share of posts failed with 500 internal server error (default 0)")
+argParser.add_argument("--rate-503", type=float, default=0, help="share of posts failed with 503 service unavailable (default 0)")
+argParser.add_argument("--rate-reset", type=float, default=0, help="share of posts answered by resetting the connection (default 0)")
+argParser.add_argument("--outage", type=parseOutage, action="append", default=[], metavar="START+DURATION", help="fail every post from START to START+DURATION seconds after the server started (may be repeated)")
+argParser.add_argument("--outage-mode", choices=[ "503", "500", "reset" ], default="503", help="how posts fail during an outage (default 503)")
+argParser.add_argument("--track-duplicates", action="store_true", help="count metric values accepted more than once (keeps every accepted resource/timestamp/metric in memory)")
+argParser.add_argument("--report-interval", type=float, default=10, help="seconds between summaries (default 10)")
+argParser.add_argument("--stats-file", default=None, help="write the final counts as JSON to this file when stopped")
+argParser.add_argument("--seed", type=int, default=None, help="random seed of the fault injection")
+options = argParser.parse_args()
+
+if options.rate_413 + options.rate_429 + options.rate_500 + options.rate_503 + options.rate_reset > 1:
+   argParser.error("the fault rates must add up to at most 1")
+if (options.tls_cert is None) != (options.tls_key is None):
+   argParser.error("--tls-cert and --tls-key must be given together")
+random.seed(options.seed)
+
+server = http.server.ThreadingHTTPServer((options.bind, options.port), MetricApiHandler)
+server.daemon_threads = True
+if options.tls_cert is not None:
+   tlsContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+   tlsContext.load_cert_chain(options.tls_cert, options.tls_key)
+   server.socket = tlsContext.wrap_socket(server.socket, server_side=True)
+   scheme = "https"
+else:
+   scheme = "http"
+
+signal.signal(signal.SIGINT, stopServer)
+signal.signal(signal.SIGTERM, stopServer)
+
+reporterThread = threading.Thread(target=reporter, name="reporter")
+reporterThread.daemon = True
+reporterThread.start()
+
+log("Serving " + scheme + "://" + options.bind + ":" + str(options.port) + aiopsPath + " and " + piPath + (", without authentication" if options.no_auth else ", tenant " + options.tenant_id + ", user " + options.user))
+serverStart = time.time()
+server.serve_forever()
@@ -0,0 +1,7 @@
+#!/bin/bash
+
+# Replays the Zabbix topic between two times (epoch seconds or "YYYY-MM-DD HH:MM:SS" local time), e.g.
+#
+#    ./backfill-datachannel.sh "2026-10-01 00:00" "2026-10-04 00:00"
+
+/usr/local/bin/python zabbix-aiops-metric-connector.py --backfill "$1" "$2"
@@ -0,0 +1,728 @@
+#
+# In-memory stand-in for the parts of confluent_kafka the datachannel uses, for benchmarking and profiling
+# the whole pipeline without a kafka cluster
+#
+# Topics live in one in-process broker (fakekafka.broker), as partitions of messages held in memory.
+# Consumer supports subscribe (with consumer groups spreading partitions over their members, and the
+# on_assign/on_revoke callbacks) and assign, consume/poll batches, pause/resume, commit (with on_commit),
+# committed, position, seek, offsets_for_times and get_watermark_offsets. Producer appends to the topics and
+# serves delivery callbacks from poll and flush. AdminClient lists the topics. Messages are fed in with
+# broker.append/appendBatch, or by a replay thread that feeds recorded or synthetic traffic at a set rate,
+# or as fast as the consumers take it
+#
+# Select it in the datachannel with kafkaClient = "fake" (see conf/sevone-watson-datachannel.props). It
+# only exists within one process
+#
+
+import ast
+import bisect
+import collections
+import gzip
+import threading
+import time
+import zlib
+
+OFFSET_BEGINNING = -2
+OFFSET_END = -1
+OFFSET_STORED = -1000
+OFFSET_INVALID = -1001
+TIMESTAMP_NOT_AVAILABLE = 0
+TIMESTAMP_CREATE_TIME = 1
+TIMESTAMP_LOG_APPEND_TIME = 2
+
+class KafkaError:
+
+   _PARTITION_EOF = -191
+   _UNKNOWN_PARTITION = -190
+   _TIMED_OUT = -185
+   _NO_OFFSET = -168
+   UNKNOWN_TOPIC_OR_PART = 3
+
+   def __init__(self, code, reason=""):
+      self._code = code
+      self._reason = reason
+
+   def code(self):
+      return self._code
+
+   def str(self):
+      return self._reason
+
+   def __str__(self):
+      return "KafkaError{code=" + str(self._code) + ",str=\"" + self._reason + "\"}"
+
+class KafkaException(Exception):
+   pass
+
+class TopicPartition:
+
+   def __init__(self, topic, partition=-1, offset=OFFSET_INVALID):
+      self.topic = topic
+      self.partition = partition
+      self.offset = offset
+      self.error = None
+
+   def __eq__(self, other):
+      return (self.topic, self.partition) == (other.topic, other.partition)
+
+   def __hash__(self):
+      return hash((self.topic, self.partition))
+
+   def __lt__(self, other):
+      return (self.topic, self.partition) < (other.topic, other.partition)
+
+   def __repr__(self):
+      return "TopicPartition{topic=" + self.topic + ",partition=" + str(self.partition) + ",offset=" + str(self.offset) + "}"
+
+class Message:
+
+   __slots__ = ("_topic", "_partition", "_offset", "_key", "_value", "_timestamp", "_error")
+
+   def __init__(self, topic, partition, offset, key, value, timestamp, error=None):
+      self._topic = topic
+      self._partition = partition
+      self._offset = offset
+      self._key = key
+      self._value = value
+      self._timestamp = timestamp
+      self._error = error
+
+   def topic(self):
+      return self._topic
+
+   def partition(self):
+      return self._partition
+
+   def offset(self):
+      return self._offset
+
+   def key(self):
+      return self._key
+
+   def value(self):
+      return self._value
+
+   def timestamp(self):
+      return (TIMESTAMP_CREATE_TIME, self._timestamp)
+
+   def error(self):
+      return self._error
+
+   def __len__(self):
+      return len(self._value) if self._value is not None else 0
+
+##########################################################################
+#
+# Metadata, shaped like confluent_kafka.admin's ClusterMetadata
+#
+##########################################################################
+
+class PartitionMetadata:
+
+   def __init__(self, partition):
+      self.id = partition
+      self.leader = 0
+      self.replicas = [ 0 ]
+      self.isrs = [ 0 ]
+      self.error = None
+
+class TopicMetadata:
+
+   def __init__(self, topic, partitionCount):
+      self.topic = topic
+      self.partitions = { partition: PartitionMetadata(partition) for partition in range(partitionCount) }
+      self.error = None
+
+class ClusterMetadata:
+
+   def __init__(self, topics):
+      self.cluster_id = "fakekafka"
+      self.controller_id = 0
+      self.brokers = {}
+      self.topics = topics
+      self.orig_broker_id = 0
+      self.orig_broker_name = "fakekafka"
+
+##########################################################################
+#
+# The broker. A partition is three parallel lists (keys, values and
+# timestamps in ms) and the offset of their first element, which advances
+# as messages beyond the topic's retention (a message count per
+# partition, 0 for unlimited) are dropped. One condition guards all of
+# the broker's state, and is notified when messages are appended, so that
+# consumers waiting in consume() wake up, and when messages are read, so
+# that a replay waiting for the backlog to shrink wakes up. The condition's
+# lock is reentrant
+#
+##########################################################################
+
+class FakePartition:
+
+   __slots__ = ("keys", "values", "timestamps", "timeIndex", "baseOffset", "readOffset")
+
+   def __init__(self):
+      self.keys = []
+      self.values = []
+      self.timestamps = []
+
+      # the largest timestamp up to each message, like kafka's time index, so that
+      # offsets_for_times can bisect even when the timestamps are out of order
+
+      self.timeIndex = []
+      self.baseOffset = 0
+      self.readOffset = 0
+
+   def highOffset(self):
+      return self.baseOffset + len(self.values)
+
+class FakeBroker:
+
+   def __init__(self):
+      self.condition = threading.Condition()
+      self.topics = {}
+      self.retention = {}
+      self.committed = {}
+      self.groups = {}
+      self.defaultPartitions = 1
+
+   def createTopic(self, topic, partitions=1, retention=0):
+
+      # creates a topic, unless it exists already
+
+      with self.condition:
+         if topic not in self.topics:
+            self.topics[topic] = [ FakePartition() for partition in range(partitions) ]
+            self.retention[topic] = retention
+
+   def partitionsOf(self, topic):
+
+      # called with the condition held. Topics are created on first use, as with auto.create.topics.enable
+
+      if topic not in self.topics:
+         self.topics[topic] = [ FakePartition() for partition in range(self.defaultPartitions) ]
+         self.retention[topic] = 0
+      return self.topics[topic]
+
+   def appendBatch(self, topic, partition, values, keys=None, timestamp=None):
+
+      # appends messages to a partition, and returns the offset of the first. timestamp is
+      # in ms, either one for the whole batch or a list with one per message
+
+      if timestamp is None:
+         timestamp = int(time.time() * 1000)
+      timestamps = timestamp if isinstance(timestamp, list) else [ timestamp ] * len(values)
+      with self.condition:
+         fakePartition = self.partitionsOf(topic)[partition]
+         first = fakePartition.highOffset()
+         fakePartition.values.extend(values)
+         if keys is None:
+            fakePartition.keys.extend([ None ] * len(values))
+         else:
+            fakePartition.keys.extend(keys)
+         fakePartition.timestamps.extend(timestamps)
+         latest = fakePartition.timeIndex[-1] if fakePartition.timeIndex else 0
+         for messageTimestamp in timestamps:
+            latest = max(latest, messageTimestamp)
+            fakePartition.timeIndex.append(latest)
+         retention = self.retention[topic]
+         if retention > 0 and len(fakePartition.values) > retention:
+
+            # drop down to 90% of the retention at once rather than a message at a time
+
+            dropped = len(fakePartition.values) - int(retention * 0.9)
+            del fakePartition.keys[:dropped]
+            del fakePartition.values[:dropped]
+            del fakePartition.timestamps[:dropped]
+            del fakePartition.timeIndex[:dropped]
+            fakePartition.baseOffset += dropped
+         self.condition.notify_all()
+      return first
+
+   def append(self, topic, partition, value, key=None, timestamp=None):
+
+      return self.appendBatch(topic, partition, [ value ], None if key is None else [ key ], timestamp)
+
+   def backlog(self, topic):
+
+      # messages appended to a topic that no consumer has read yet
+
+      with self.condition:
+         return sum(fakePartition.highOffset() - max(fakePartition.readOffset, fakePartition.baseOffset) for fakePartition in self.partitionsOf(topic))
+
+   def setCommitted(self, group, topic, partition, offset):
+
+      with self.condition:
+         self.committed[(group, topic, partition)] = offset
+
+   def partitionCount(self, topic):
+
+      with self.condition:
+         return len(self.partitionsOf(topic))
+
+   def metadata(self, topic=None):
+
+      with self.condition:
+         if topic is not None:
+            self.partitionsOf(topic)
+            names = [ topic ]
+         else:
+            names = list(self.topics)
+         return ClusterMetadata({ name: TopicMetadata(name, len(self.topics[name])) for name in names })
+
+   def hasConsumers(self, topic):
+
+      # whether a group member has been assigned partitions of the topic
+
+      with self.condition:
+         return any(key[0] == topic for members in self.groups.values() for member in members for key in member.positions)
+
+   def joinGroup(self, group, consumer):
+
+      with self.condition:
+         members = self.groups.setdefault(group, [])
+         if consumer not in members:
+            members.append(consumer)
+         self.rebalance(group)
+
+   def leaveGroup(self, group, consumer):
+
+      with self.condition:
+         members = self.groups.get(group, [])
+         if consumer in members:
+            members.remove(consumer)
+            self.rebalance(group)
+
+   def rebalance(self, group):
+
+      # called with the condition held. Spreads the partitions of the group's topics over its members, round robin
+
+      members = self.groups[group]
+      partitions = []
+      for topic in sorted(set(topic for member in members for topic in member.subscription)):
+         partitions += [ (topic, partition) for partition in range(len(self.partitionsOf(topic))) ]
+      for index, member in enumerate(members):
+         member.pendingAssignment = [ key for key in partitions[index::len(members)] if key[0] in member.subscription ]
+      self.condition.notify_all()
+
+broker = FakeBroker()
+
+def resetBroker():
+
+   # replaces the broker with an empty one
+
+   global broker
+
+   broker = FakeBroker()
+   return broker
+
+##########################################################################
+#
+# Consumer
+#
+##########################################################################
+
+def autoOffsetReset(config):
+
+   reset = config.get("auto.offset.reset", config.get("default.topic.config", {}).get("auto.offset.reset", "latest"))
+   return reset.lower()
+
+class Consumer:
+
+   def __init__(self, config):
+      self.config = dict(config)
+      self.group = config.get("group.id")
+      self.offsetReset = autoOffsetReset(config)
+      self.onCommit = config.get("on_commit")
+      self.subscription = set()
+      self.onAssign = None
+      self.onRevoke = None
+      self.pendingAssignment = None
+      self.positions = collections.OrderedDict()
+      self.paused = set()
+      self.commitReports = collections.deque()
+      self.nextPartition = 0
+      self.closed = False
+
+   def subscribe(self, topics, on_assign=None, on_revoke=None, on_lost=None):
+      self.subscription = set(topics)
+      self.onAssign = on_assign
+      self.onRevoke = on_revoke
+      broker.joinGroup(self.group, self)
+
+   def unsubscribe(self):
+      self.subscription = set()
+      broker.leaveGroup(self.group, self)
+
+   def startOffset(self, topic, partition, offset):
+
+      # called with the condition held. Resolves a logical offset to a position
+
+      fakePartition = broker.partitionsOf(topic)[partition]
+      if offset == OFFSET_BEGINNING:
+         return fakePartition.baseOffset
+      if offset == OFFSET_END:
+         return fakePartition.highOffset()
+      if offset >= 0:
+         return offset
+      committed = broker.committed.get((self.group, topic, partition))
+      if committed is not None:
+         return committed
+      if self.offsetReset in [ "earliest", "smallest", "beginning" ]:
+         return fakePartition.baseOffset
+      return fakePartition.highOffset()
+
+   def assign(self, partitions):
+      with broker.condition:
+         self.positions = collections.OrderedDict()
+         for tp in partitions:
+            self.positions[(tp.topic, tp.partition)] = self.startOffset(tp.topic, tp.partition, tp.offset)
+         self.paused = set()
+
+   def unassign(self):
+      with broker.condition:
+         self.positions = collections.OrderedDict()
+
+   def assignment(self):
+      return [ TopicPartition(topic, partition) for topic, partition in self.positions ]
+
+   def applyRebalance(self):
+
+      # a rebalance is applied in consume(), as librdkafka does, with the callbacks called outside the broker's lock
+
+      with broker.condition:
+         newAssignment = self.pendingAssignment
+         self.pendingAssignment = None
+      if newAssignment is None:
+         return
+      revoked = [ TopicPartition(topic, partition) for topic, partition in self.positions if (topic, partition) not in newAssignment ]
+      if revoked and self.onRevoke is not None:
+         self.onRevoke(self, revoked)
+      assigned = [ TopicPartition(topic, partition, OFFSET_STORED) for topic, partition in newAssignment ]
+      with broker.condition:
+         kept = { key: position for key, position in self.positions.items() if key in newAssignment }
+         self.positions = collections.OrderedDict()
+         for tp in assigned:
+            key = (tp.topic, tp.partition)
+            if key in kept:
+               self.positions[key] = kept[key]
+            else:
+               self.positions[key] = self.startOffset(tp.topic, tp.partition, OFFSET_STORED)
+         self.paused &= set(self.positions)
+      if self.onAssign is not None:
+         self.onAssign(self, assigned)
+
+   def serveCommitReports(self):
+      while self.commitReports:
+         err, offsets = self.commitReports.popleft()
+         self.onCommit(err, offsets)
+
+   def consume(self, num_messages=1, timeout=-1):
+      if self.closed:
+         raise RuntimeError("Consumer closed")
+      self.applyRebalance()
+      self.serveCommitReports()
+      deadline = None if timeout is None or timeout < 0 else time.time() + timeout
+      with broker.condition:
+         while True:
+            msgs = self.fetch(num_messages)
+            if msgs or self.pendingAssignment is not None:
+               return msgs
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+               return msgs
+            broker.condition.wait(remaining)
+
+   def fetch(self, num_messages):
+
+      # called with the condition held. Takes messages from the unpaused partitions in turn, starting with a different partition each time
+
+      msgs = []
+      keys = [ key for key in self.positions if key not in self.paused ]
+      if not keys:
+         return msgs
+      self.nextPartition = (self.nextPartition + 1) % len(keys)
+      keys = keys[self.nextPartition:] + keys[:self.nextPartition]
+      perPartition = max(num_messages // len(keys), 1)
+      for topic, partition in keys:
+         if len(msgs) >= num_messages:
+            break
+         fakePartition = broker.topics[topic][partition]
+         position = max(self.positions[(topic, partition)], fakePartition.baseOffset)
+         start = position - fakePartition.baseOffset
+         end = min(start + min(perPartition, num_messages - len(msgs)), len(fakePartition.values))
+         for index in range(start, end):
+            msgs.append(Message(topic, partition, fakePartition.baseOffset + index, fakePartition.keys[index], fakePartition.values[index], fakePartition.timestamps[index]))
+         position = fakePartition.baseOffset + end
+         self.positions[(topic, partition)] = position
+         if position > fakePartition.readOffset:
+            fakePartition.readOffset = position
+      if msgs:
+         broker.condition.notify_all()
+      return msgs
+
+   def poll(self, timeout=-1):
+      msgs = self.consume(1, timeout)
+      if msgs:
+         return msgs[0]
+      return None
+
+   def pause(self, partitions):
+      with broker.condition:
+         self.paused |= set((tp.topic, tp.partition) for tp in partitions)
+
+   def resume(self, partitions):
+      with broker.condition:
+         self.paused -= set((tp.topic, tp.partition) for tp in partitions)
+         broker.condition.notify_all()
+
+   def seek(self, partition):
+      with broker.condition:
+         self.positions[(partition.topic, partition.partition)] = self.startOffset(partition.topic, partition.partition, partition.offset)
+
+   def position(self, partitions):
+      with broker.condition:
+         return [ TopicPartition(tp.topic, tp.partition, self.positions.get((tp.topic, tp.partition), OFFSET_INVALID)) for tp in partitions ]
+
+   def committed(self, partitions, timeout=-1):
+      with broker.condition:
+         return [ TopicPartition(tp.topic, tp.partition, broker.committed.get((self.group, tp.topic, tp.partition), OFFSET_INVALID)) for tp in partitions ]
+
+   def commit(self, message=None, offsets=None, asynchronous=True):
+      if message is not None:
+         offsets = [ TopicPartition(message.topic(), message.partition(), message.offset() + 1) ]
+      elif offsets is None:
+         offsets = [ TopicPartition(topic, partition, position) for (topic, partition), position in self.positions.items() ]
+      with broker.condition:
+         for tp in offsets:
+            broker.committed[(self.group, tp.topic, tp.partition)] = tp.offset
+      if asynchronous:
+
+         # the report of an asynchronous commit is served by the next consume, as with librdkafka
+
+         if self.onCommit is not None:
+            self.commitReports.append((None, offsets))
+         return None
+      return offsets
+
+   def offsets_for_times(self, partitions, timeout=-1):
+
+      # the offset of the first message at or after each partition's offset, read as a timestamp in ms, or -1 if there is none
+
+      results = []
+      with broker.condition:
+         for tp in partitions:
+            fakePartition = broker.partitionsOf(tp.topic)[tp.partition]
+            index = bisect.bisect_left(fakePartition.timeIndex, tp.offset)
+            if index < len(fakePartition.timeIndex):
+               results.append(TopicPartition(tp.topic, tp.partition, fakePartition.baseOffset + index))
+            else:
+               results.append(TopicPartition(tp.topic, tp.partition, OFFSET_END))
+      return results
+
+   def get_watermark_offsets(self, partition, timeout=None, cached=False):
+      with broker.condition:
+         fakePartition = broker.partitionsOf(partition.topic)[partition.partition]
+         return fakePartition.baseOffset, fakePartition.highOffset()
+
+   def list_topics(self, topic=None, timeout=-1):
+      return broker.metadata(topic)
+
+   def close(self):
+      if self.closed:
+         return
+      if self.subscription:
+         broker.leaveGroup(self.group, self)
+      self.closed = True
+
+##########################################################################
+#
+# Producer. Messages are appended as they are produced, and their delivery
+# callbacks are served by poll() and flush()
+#
+##########################################################################
+
+class Producer:
+
+   def __init__(self, config):
+      self.config = dict(config)
+      self.maxPending = int(config.get("queue.buffering.max.messages", 100000))
+      self.pending = collections.deque()
+      self.produced = threading.Event()
+      self.serving = threading.Lock()
+      self.nextPartition = 0
+
+   def produce(self, topic, value=None, key=None, partition=-1, on_delivery=None, callback=None, timestamp=0, headers=None):
+      if len(self.pending) >= self.maxPending:
+         raise BufferError("Local: Queue full")
+      if partition is None or partition < 0:
+         partitionCount = broker.partitionCount(topic)
+         if key is not None:
+            partition = zlib.crc32(key if isinstance(key, bytes) else str(key).encode("utf-8")) % partitionCount
+         else:
+            self.nextPartition = (self.nextPartition + 1) % partitionCount
+            partition = self.nextPartition
+      if isinstance(value, str):
+         value = value.encode("utf-8")
+      offset = broker.append(topic, partition, value, key, timestamp or None)
+      report = callback or on_delivery
+      if report is not None:
+         self.pending.append((report, Message(topic, partition, offset, key, value, timestamp)))
+         self.produced.set()
+
+   def poll(self, timeout=-1):
+      if not self.pending and timeout != 0:
+         self.produced.wait(None if timeout is None or timeout < 0 else timeout)
+      self.produced.clear()
+      return self.serve()
+
+   def serve(self):
+
+      # delivery reports are served by one thread at a time, so that a flush
+      # returns only once the reports another thread is serving have been run
+
+      served = 0
+      with self.serving:
+         while self.pending:
+            report, msg = self.pending.popleft()
+            report(None, msg)
+            served += 1
+      return served
+
+   def flush(self, timeout=-1):
+      self.serve()
+      return 0
+
+   def list_topics(self, topic=None, timeout=-1):
+      return broker.metadata(topic)
+
+   def __len__(self):
+      return len(self.pending)
+
+class AdminClient:
+
+   def __init__(self, config):
+      self.config = dict(config)
+
+   def list_topics(self, topic=None, timeout=-1):
+      return broker.metadata(topic)
+
+##########################################################################
+#
+# Replay. A thread appends messages to a topic, spread over its partitions
+# in turn, in chunks: at up to rate messages per second, or with rate 0 as
+# fast as the consumers read them, keeping at most maxBacklog unread
+# messages in the topic. The source is a list, or a callable returning an
+# iterable, so that it can be replayed more than once (loops 0 replays it
+# until stopped). With waitForConsumers it starts once a consumer group
+# member has been assigned the topic
+#
+##########################################################################
+
+def readRecording(filepath):
+
+   # returns a callable reading a recording of one message value per line, such as the output of sdb-kafka-reader.py,
+   # which prints each value as a python bytes literal
+
+   def lines():
+      if filepath.endswith(".gz"):
+         recording = gzip.open(filepath, "rb")
+      else:
+         recording = open(filepath, "rb")
+      with recording:
+         for line in recording:
+            line = line.rstrip(b"\r\n")
+            if line[:2] in (b"b'", b'b"') and line[-1:] == line[1:2]:
+               line = ast.literal_eval(line.decode("utf-8"))
+            if line:
+               yield line
+   return lines
+
+class Replay:
+
+   def __init__(self, topic, source, rate=0, maxBacklog=100000, loops=1, chunkSize=500, waitForConsumers=False, timestampOf=None):
+      self.topic = topic
+
+      # timestampOf maps a recorded message to the timestamp in ms it is appended with, or
+      # None to keep the previous message's. Without it messages are stamped as they are appended
+
+      self.timestampOf = timestampOf
+      self.lastTimestamp = None
+      self.waitForConsumers = waitForConsumers
+      self.source = source
+      self.rate = rate
+      self.maxBacklog = maxBacklog
+      self.loops = loops
+      self.chunkSize = chunkSize
+      self.replayed = 0
+      self.stopRequested = False
+      self.thread = threading.Thread(target=self.run, name="fakeKafkaReplay")
+      self.thread.daemon = True
+
+   def start(self):
+      self.thread.start()
+      return self
+
+   def stop(self):
+      self.stopRequested = True
+
+   def join(self, timeout=None):
+      self.thread.join(timeout)
+
+   def run(self):
+      if self.waitForConsumers:
+
+         # a consumer that starts at the latest offset would miss whatever was replayed before it was assigned the topic
+
+         with broker.condition:
+            while not broker.hasConsumers(self.topic) and not self.stopRequested:
+               broker.condition.wait(0.1)
+      partitionCount = broker.partitionCount(self.topic)
+      partition = 0
+      started = time.time()
+      loop = 0
+      while not self.stopRequested and (self.loops == 0 or loop < self.loops):
+         loop += 1
+         chunk = []
+         source = self.source() if callable(self.source) else self.source
+         for value in source:
+            chunk.append(value)
+            if len(chunk) >= self.chunkSize:
+               self.feed(partition, chunk, started)
+               partition = (partition + 1) % partitionCount
+               chunk = []
+            if self.stopRequested:
+               return
+         if chunk:
+            self.feed(partition, chunk, started)
+            partition = (partition + 1) % partitionCount
+
+   def feed(self, partition, chunk, started):
+      if self.rate > 0:
+         due = started + (self.replayed + len(chunk)) / self.rate
+         if due > time.time():
+            time.sleep(due - time.time())
+      elif self.maxBacklog > 0:
+         with broker.condition:
+            while broker.backlog(self.topic) >= self.maxBacklog and not self.stopRequested:
+               broker.condition.wait(0.1)
+      broker.appendBatch(self.topic, partition, chunk, timestamp=self.timestampsOf(chunk))
+      self.replayed += len(chunk)
+
+   def timestampsOf(self, chunk):
+      if self.timestampOf is None:
+         return None
+      timestamps = []
+      for value in chunk:
+         recorded = self.timestampOf(value)
+         if recorded is not None:
+            self.lastTimestamp = recorded
+         elif self.lastTimestamp is None:
+            self.lastTimestamp = int(time.time() * 1000)
+         timestamps.append(self.lastTimestamp)
+      return timestamps
+
+def replay(topic, source, rate=0, maxBacklog=100000, loops=1, waitForConsumers=False):
+
+   # starts replaying source into topic, and returns the Replay
+
+   return Replay(topic, source, rate, maxBacklog, loops, waitForConsumers=waitForConsumers).start()
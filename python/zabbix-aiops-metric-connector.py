@@ -14,10 +14,10 @@
 #
 
 import gzip
+import zlib
 import urllib.request, urllib.parse, urllib.error 
+import http.client
 import base64
-from avro.io import DatumReader
-#import avro.io
 import logging
 try: 
     import queue
@@ -29,11 +29,13 @@ import time
 import threading
 from datetime import datetime
 try:
-   from confluent_kafka import Consumer, KafkaError, Producer
+   from confluent_kafka import Consumer, KafkaError, Producer, TopicPartition
+   from confluent_kafka.admin import AdminClient
 except ImportError:
-   print("FATAL: Unable to load confluent_kafka. Make sure you have installed confluent-kafka package. It can be installed using pip as such:\n\tpip install confluent-kafka")
-   exit()
-from confluent_kafka.admin import AdminClient
+
+   # not required with kafkaClient = "fake", which is checked once the properties are loaded
+
+   Consumer = None
 #from confluent_kafka.schema_registry.avro import AvroDeserializer
 import io
 import json
@@ -42,18 +44,14 @@ import sys
 import re
 import time
 import signal
+import collections
+import multiprocessing
+import glob
+import struct
+import argparse
+import bisect
+import http.server
 
-
-def writeZipFile(fileName, metricData):
-
-   #myZipFile = zipfile.ZipFile(fileName + ".zip", mode='w')
-   #myZipFile.writestr(fileName, metricData)
-   #close(myZipFile) 
-
-   gz = gzip.open(fileName + ".gz", 'wb')
-   gz.write(metricData)
-   gz.close()
-   
 def shutdownHandler(*args):
    shutdownRequest = True
    raise SystemExit('Exiting')
@@ -118,99 +116,907 @@ def loadCounters(filepath, comment_char='#'):
             if l and not l.startswith(comment_char):
                counterMetrics.add(l)
 
+##################################################################
+#
+# Function to name a per-process file or directory under log/
+#
+##################################################################
+
+def instancePath(name, workerId, suffix=""):
+
+   # worker processes and a backfill run each get their own, so that they do not share them
+
+   if backfillMode:
+      return mediatorHome + "/log/" + name + "-backfill" + suffix
+   elif connectorWorkers > 1:
+      return mediatorHome + "/log/" + name + "-" + str(workerId) + suffix
+   else:
+      return mediatorHome + "/log/" + name + suffix
+
+##################################################################
+#
+# Function to read an optional numeric property, with a default
+#
+##################################################################
+
+def numericProperty(name, default, cast=int):
+
+   if name in datachannelProps:
+      try:
+         return cast(datachannelProps[name])
+      except ValueError:
+         logging.info("WARNING: property '" + name + "' is not numeric (" + datachannelProps[name] + "). Defaulting to " + str(default))
+   return default
+
+##########################################################################
+#
+# Statistics are counted per thread, without locking, into Counters that
+# are registered in statsRegistry. statsTotals() sums them when the
+# interval report is written or the metrics endpoint is scraped, and
+# statsSince() gives the counts since a previous total
+#
+##########################################################################
+
+def countStat(name, value=1):
+
+   try:
+      statsLocal.counts[name] += value
+   except AttributeError:
+      registerThreadStats()[name] += value
+
+def registerThreadStats():
+
+   counts = statsLocal.counts = collections.Counter()
+   with statsRegistryLock:
+      statsRegistry.append(counts)
+   return counts
+
+def statsTotals():
+
+   totals = collections.Counter()
+   with statsRegistryLock:
+      registry = list(statsRegistry)
+   for counts in registry:
+
+      # copying the dict is atomic, while iterating it as its thread adds a new name is not
+
+      totals.update(dict(counts))
+   return totals
+
+def statsSince(baseline):
+
+   # returns the statistics counted since the baseline totals, and moves the baseline forward
+
+   totals = statsTotals()
+   delta = collections.Counter()
+   for name, value in totals.items():
+      if value != baseline[name]:
+         delta[name] = value - baseline[name]
+   baseline.clear()
+   baseline.update(totals)
+   return delta
+
+def recordStageTime(stage, seconds, count=1):
+
+   ###########################################################################
+   #
+   # Records the time a pipeline stage took, as count items of seconds/count
+   # each, in the stage's log-bucketed histogram. Stage histograms are counted
+   # statistics, so they are summed across threads and worker processes
+   #
+   ###########################################################################
+
+   if count <= 0:
+      return
+   perItemMs = seconds * 1000 / count
+   countStat(stageTimingStatNames[stage][bisect.bisect_left(stageTimingBounds, perItemMs)], count)
+   countStat(stageTimingSumNames[stage], seconds * 1000)
+   countStat(stageTimingCountNames[stage], count)
+
+def histogramQuantile(counts, bounds, quantile):
+
+   # estimates a quantile from per-bucket counts as the upper bound of the bucket holding it
+
+   total = sum(counts)
+   if total == 0:
+      return 0
+   rank = quantile * total
+   seen = 0
+   for bucket, count in enumerate(counts):
+      seen += count
+      if seen >= rank:
+         if bucket < len(bounds):
+            return bounds[bucket]
+         return float("inf")
+   return float("inf")
+
+def maxStat(name, value):
+
+   # records the highest value of a statistic seen during the interval
+
+   if value > intervalMaxStats[name]:
+      intervalMaxStats[name] = value
+
+##########################################################################
+#
+# Drop accounting. A message that cannot be translated is counted by
+# recordDrop as the dropped_<reason> statistic, and tallied by host and
+# item for the interval, keeping the first dropReportExamples messages of
+# each reason as examples. Nothing is formatted when a message is dropped:
+# the interval report logs the counts, the dropReportTop hosts and items
+# and the examples once per interval, so that a flood of bad messages does
+# not make logging the bottleneck
+#
+##########################################################################
+
+def recordDrop(reason, event_dict, detail=None):
+
+   countStat(dropStatNames[reason])
+   host = None
+   item = None
+   if event_dict is not None:
+      hostField = event_dict.get("host")
+      if isinstance(hostField, dict):
+         host = hostField.get("host")
+      item = event_dict.get("name")
+   with dropLock:
+      tallyDrop(dropHosts, (reason, host), 1)
+      tallyDrop(dropItems, (reason, item), 1)
+      examples = dropExamples.get(reason)
+      if examples is None:
+         examples = dropExamples[reason] = []
+      if len(examples) < dropReportExamples:
+         examples.append((event_dict, detail))
+
+def tallyDrop(tally, key, count):
+
+   # beyond dropTrackedKeys hosts or items, the rest of a reason's drops are tallied together
+
+   if key in tally or len(tally) < dropTrackedKeys:
+      tally[key] += count
+   else:
+      tally[(key[0], dropOtherKey)] += count
+
+def takeDropReport(reset=True):
+
+   # returns the drops tallied by host and item, and the examples with their errors as text, since the last report
+
+   with dropLock:
+      examples = { reason: [ (event_dict, detail if detail is None or isinstance(detail, str) else type(detail).__name__ + ": " + str(detail)) for event_dict, detail in kept ] for reason, kept in dropExamples.items() }
+      report = { "hosts": collections.Counter(dropHosts), "items": collections.Counter(dropItems), "examples": examples }
+      if reset:
+         dropHosts.clear()
+         dropItems.clear()
+         dropExamples.clear()
+   return report
+
+def mergeDropReport(report):
+
+   # adds a worker's drop report to this process' tallies
+
+   with dropLock:
+      for key, count in report["hosts"].items():
+         tallyDrop(dropHosts, key, count)
+      for key, count in report["items"].items():
+         tallyDrop(dropItems, key, count)
+      for reason, examples in report["examples"].items():
+         kept = dropExamples.setdefault(reason, [])
+         kept.extend(examples[:dropReportExamples - len(kept)])
+
+def topDropped(tally, reason):
+
+   return collections.Counter({ key[1]: count for key, count in tally.items() if key[0] == reason }).most_common(dropReportTop)
+
+def dropKeyText(key):
+
+   if key is None:
+      return "(missing)"
+   return str(key)
+
+def logDropReport(intervalStats):
+
+   report = takeDropReport()
+   dropped = sorted(((name[len("dropped_"):], count) for name, count in intervalStats.items() if name.startswith("dropped_") and count > 0), key=lambda reason: -reason[1])
+   if not dropped:
+      return
+   logging.info('Dropped messages: ' + ', '.join(reason + ': ' + str(count) for reason, count in dropped))
+   for reason, count in dropped:
+      topHosts = topDropped(report["hosts"], reason)
+      topItems = topDropped(report["items"], reason)
+      if topHosts or topItems:
+         logging.info('Dropped ' + reason + ', top hosts: ' + ', '.join(dropKeyText(host) + ' (' + str(hostCount) + ')' for host, hostCount in topHosts) + '; top items: ' + ', '.join(dropKeyText(item) + ' (' + str(itemCount) + ')' for item, itemCount in topItems))
+      for event_dict, detail in report["examples"].get(reason, []):
+         example = json.dumps(event_dict, default=str) if event_dict is not None else "(not decoded)"
+         if len(example) > dropExampleMaxLength:
+            example = example[:dropExampleMaxLength] + "..."
+         logging.info('Dropped ' + reason + ' example' + (' (' + detail + ')' if detail is not None else '') + ': ' + example)
+
+##################################################
+#
+# Function to read the metric-aggregation.conf file
+#
+##################################################
+
+def loadAggregationFunctions(filepath, comment_char='#'):
+
+   if(os.path.exists(filepath)):
+      with open (filepath, "rt") as f:
+         for line in f:
+            l = line.strip()
+            if l and not l.startswith(comment_char) and "=" in l:
+               metric, function = [ part.strip() for part in l.split("=", 1) ]
+               if function.lower() in aggregationFunctionNames:
+                  aggregationFunctions[metric] = function.lower()
+               else:
+                  logging.info("WARNING: Unknown aggregation function '" + function + "' for metric '" + metric + "' in " + filepath + ". Must be one of " + str(aggregationFunctionNames))
+
 ###################################
 #
 # Producer acknowledgement function
 #
 ###################################
 
-def acked(err,msg):
+def acked(err,msg,tokens=(),metricCount=0,producedAt=None):
+   if producedAt is not None:
+      latency = time.time() - producedAt
+      countStat("kafkaDeliveryMs", int(latency * 1000))
+      maxStat("kafkaDeliveryMs", int(latency * 1000))
+      recordStageTime("kafkaDelivery", latency)
    if err is not None:
+      countStat("kafkaDeliveryFailures")
+      countStat("kafkaFailedMetrics", metricCount)
       logging.info("Failed to deliver message: %s: %s" % (str(msg), str(err)))
    else:
-      pass
+      countStat("kafkaDelivered")
+      releaseTokens(tokens)
       #print("Message produced: %s" % (str(msg)))
 
+##########################################################################
+#
+# Metric entries are serialized to compact JSON once, as soon as they are
+# final, and batch bodies are assembled by joining the serialized fragments
+#
+##########################################################################
+
+metricEncoder = json.JSONEncoder(separators=(",", ":"))
+
+def serializeMetric(waiopsMetric):
+
+   return metricEncoder.encode(waiopsMetric).encode("utf-8")
+
+def buildGroupsBody(fragments):
+
+   return b'{"groups":[' + b','.join(fragments) + b']}'
+
 #####################################
 #
 # Puts metric onto Watson kafka topic
 #
 #####################################
 
-def produceMetric(metricData):
+def produceMetric(metricData, partition, metricCount, tokens=()):
 
-   watsonProducer.produce(watsonKafkaTopicName,key="key",value=metricData, callback=acked)
-   watsonProducer.poll(0.001)
+   # the delivery callback is serviced by the kafkaPoller thread. A full local producer queue is waited out rather than dropped
 
-def postMetric(postedData):
+   producedAt = time.time()
+   while True:
+      try:
+         watsonProducer.produce(watsonKafkaTopicName, value=metricData, partition=partition, callback=lambda err, msg: acked(err, msg, tokens, metricCount, producedAt))
+         break
+      except BufferError:
+         countStat("kafkaProduceQueueFull")
+         time.sleep(0.05)
+   countStat("kafkaRecordsProduced")
+   countStat("kafkaMetricsProduced", metricCount)
+   countStat("kafkaBytesProduced", len(metricData))
+
+def postMetric(postedData, splittable=False, retryCount=4, spoolOnFailure=True):
+
+   # accepts a JSON payload and posts it to watson. Returns "posted", "saved" (to the spool), "rejected" (by the API
+   # as a bad payload, with 400, 413 or 422), "lost" (the spool could not be written) or "failed" (without
+   # spoolOnFailure), or "split" if the payload is splittable and the API rejected it as too large (413). A timed out
+   # post is retried and then spooled like any other failure, not split, as the API may already have accepted it
+
+   #global restMediationServiceHost
+   #global restMediationServicePort
+   #global watsonTopicName
+   #global restMediationServiceAuthentication
+
+   #encodedMetricData = metricData.encode('utf-8')
+   if isinstance(postedData, str):
+      encodedMetricData = postedData.encode('utf-8')
+   else:
+      encodedMetricData = postedData
 
-   # accepts a JSON payload and posts it to watson
+   #logging.debug("going to publish the following: " + str(encodedMetricData))
+   #######################################################
+   #
+   # Function to post metric to WAIOps for analysis
+   #
+   #######################################################
 
-   retryCount = 4
+   postedBody, postedHeaders = compressRestBody(encodedMetricData)
 
-   if 1 == 1: 
+   doRetry = True
+   retries = 1
 
-      #global restMediationServiceHost
-      #global restMediationServicePort
-      #global watsonTopicName
-      #global restMediationServiceAuthentication
-   
-      #encodedMetricData = metricData.encode('utf-8')
-      encodedMetricData = postedData.encode('utf-8')
-   
-      #logging.debug("going to publish the following: " + str(encodedMetricData))
-      #######################################################
-      #
-      # Function to post metric to WAIOps for analysis
-      #
-      #######################################################
-   
-      doRetry = True
-      retries = 1
-   
-      method = "POST"
+   logging.debug("requestURL is " + targetUrl + ", now going to post")
+
+   while doRetry == True:
+      try:
+         sendRestRequest(postedBody, headers=postedHeaders)
+         doRetry = False
    
-      logging.debug("requestURL is " + targetUrl + ", now going to post")
+      except (IOError, http.client.HTTPException) as e:
+         if splittable and getattr(e, 'code', None) == 413:
+            logging.info("Metric post of " + str(len(encodedMetricData)) + " bytes was rejected as too large (" + str(e) + "), splitting the batch")
+            return "split"
+         countStat("restPostErrors")
+         logging.info('Failed to open "%s".' % targetUrl)
+         if hasattr(e, 'code'):
+            logging.info('We failed with error code - %s.' % e.code)
+         if hasattr(e, 'reason'):
+            logging.info("The error object has the following 'reason' attribute :")
+            logging.info(e.reason)
+
+         if retries != retryCount and getattr(e, 'code', None) not in restPayloadErrorCodes:
+            retries = retries + 1
+            countStat("restPostRetries")
+            logging.info("going to retry, sleeping for " + str(retries * 3) + " seconds...")
+            time.sleep(retries * 3) 
+         else:
+
+            # only a refused payload is discarded, as sending it again will not help. Any other 4xx, such as
+            # a bad API key or tenant, is kept in the spool until the API accepts it
+
+            code = getattr(e, 'code', None)
+            if code in restPayloadErrorCodes:
+               logging.info("WARNING: metric post of " + str(len(encodedMetricData)) + " bytes was rejected by the API with code " + str(code) + ", discarding it")
+               return "rejected"
+            if code in (401, 403):
+               logging.info("FATAL: the metric API refused the credentials with code " + str(code) + ". Check watsonUser, watsonApiKey and watsonTenantId. Batches are kept in the spool until it accepts them")
+            elif code is not None and 400 <= code < 500:
+               logging.info("WARNING: the metric API refused the post with code " + str(code) + ". Batches are kept in the spool until it accepts them")
+            if not spoolOnFailure:
+               return "failed"
+            markRestUnreachable()
+            logging.info("max retries reached for metric post, writing it to the spool and continuing...")
+            if spoolAppend(encodedMetricData):
+               return "saved"
+            return "lost"
+
+   return "posted"
+
+def postMetricBatch(fragments):
+
+   ###########################################################################
+   #
+   # Posts a list of pre-serialized metric entries. A batch whose body is larger than
+   # restBatchMaxBytes, or that the API rejects with 413, is
+   # split in half and each half is posted, rather than the whole batch being
+   # saved. Successful posts feed the adaptive batch size. Returns False if
+   # any of the metrics were lost, so that their offsets are not committed
+   #
+   ###########################################################################
+
+   body = buildGroupsBody(fragments)
+
+   if len(body) > restBatchMaxBytes and len(fragments) > 1:
+      countStat("restOversizeSplits")
+      result = "split"
+   elif not restApiReachable:
+
+      # while the API is unreachable batches go straight to the spool, and the spool replayer probes the API
+
+      if spoolAppend(body):
+         result = "saved"
+      else:
+         result = "lost"
+   else:
+      start = time.perf_counter()
+      result = postMetric(body, splittable=len(fragments) > 1)
+      if result == "posted":
+         countStat("restSentBatches")
+         countStat("restSentMetrics", len(fragments))
+         adaptBatchSize(len(fragments), time.perf_counter() - start)
+   if result == "saved":
+      countStat("restSavedMetrics", len(fragments))
+   elif result == "rejected":
+      countStat("restRejectedMetrics", len(fragments))
+   elif result == "lost":
+      countStat("restLostMetrics", len(fragments))
+      return False
+   elif result == "split":
+      countStat("restBisections")
+      half = len(fragments) // 2
+      firstHalfDone = postMetricBatch(fragments[:half])
+      return postMetricBatch(fragments[half:]) and firstHalfDone
+   return True
+
+def adaptBatchSize(metricCount, seconds):
+
+   ##########################################################################
+   #
+   # Hill-climbs restTargetBatchSize toward the batch size that gives the
+   # best observed posting throughput (metrics per second of request time).
+   # Every restAdaptiveWindow posts the throughput is compared with that of
+   # the previous window; the size keeps moving in the same direction while
+   # throughput improves, and reverses direction when it gets worse
+   #
+   ##########################################################################
+
+   global restTargetBatchSize
+   global adaptiveDirection
+   global adaptiveLastThroughput
+   global adaptiveMetrics
+   global adaptiveSeconds
+   global adaptivePosts
+
+   if not restAdaptiveBatchSize:
+      return
+   with adaptiveLock:
+      adaptiveMetrics += metricCount
+      adaptiveSeconds += seconds
+      adaptivePosts += 1
+      if adaptivePosts < restAdaptiveWindow:
+         return
+      throughput = adaptiveMetrics / max(adaptiveSeconds, 0.001)
+      if throughput < adaptiveLastThroughput:
+         adaptiveDirection = -adaptiveDirection
+      adaptiveLastThroughput = throughput
+      adaptiveMetrics = 0
+      adaptiveSeconds = 0
+      adaptivePosts = 0
+      if adaptiveDirection > 0:
+         newSize = int(restTargetBatchSize * 1.25)
+      else:
+         newSize = int(restTargetBatchSize / 1.25)
+      newSize = max(restMinBatchSize, min(restBatchSize, newSize))
+      logging.debug("adaptive batch size: " + str(round(throughput, 1)) + " metrics/second at " + str(restTargetBatchSize) + ", moving to " + str(newSize))
+      restTargetBatchSize = newSize
+
+
+
+##############################################################################
+#
+# Keep-alive HTTP(S) connection pool used to post metrics. Connections to each
+# target host are kept open between posts (up to restConnectionsPerHost), TLS
+# sessions are reused when a connection has to be re-established, and the
+# static request headers are built once
+#
+##############################################################################
+
+class RestPostError(IOError):
+
+   # raised for a non-2xx response, with the same code/reason attributes as urllib's HTTPError
+
+   def __init__(self, code, reason):
+      IOError.__init__(self, "HTTP " + str(code) + " " + str(reason))
+      self.code = code
+      self.reason = reason
+
+class PooledHTTPConnection(http.client.HTTPConnection):
+
+   def connect(self):
+      start = time.perf_counter()
+      self.sock = socket.create_connection((self.host, self.port), self.timeout, self.source_address)
+      self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      self.connectMs = (time.perf_counter() - start) * 1000
+      self.tlsMs = 0
+
+class PooledHTTPSConnection(http.client.HTTPSConnection):
+
+   def connect(self):
+      start = time.perf_counter()
+      sock = socket.create_connection((self.host, self.port), self.timeout, self.source_address)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      connected = time.perf_counter()
+      self.sock = self._context.wrap_socket(sock, server_hostname=self.host, session=restTlsSessions.get((self.host, self.port)))
+      self.connectMs = (connected - start) * 1000
+      self.tlsMs = (time.perf_counter() - connected) * 1000
+      if self.sock.session_reused:
+         countStat("restTlsSessionsReused")
+      restTlsSessions[(self.host, self.port)] = self.sock.session
+
+def buildRestHeaders():
+
+   # static headers sent with every metric post
+
+   headers = {}
+   headers["Content-Type"] = "application/json"
+   if(watsonProductTarget == "pi"):
+      headers["X-TenantID"] = watsonTopicName
+   if(restMediationServiceAuthentication.lower() == "true"):
+      headers["Authorization"] = authHeader.decode("ascii")
+   if(watsonProductTarget == "aiops"):
+      headers["X-TenantID"] = watsonTenantId
+      headers["Authorization"] = "ZenApiKey " + zenApiKey.decode("ascii")
+   return headers
+
+def compressRestBody(body):
+
+   ###################################################################
+   #
+   # Compresses a request body with the configured Content-Encoding if
+   # it is at least restCompressionMinBytes long. Returns the body to
+   # send and the headers to send it with
+   #
+   ###################################################################
+
+   countStat("restUncompressedBytes", len(body))
+   if restCompression == "none" or len(body) < restCompressionMinBytes:
+      countStat("restWireBytes", len(body))
+      return body, restStaticHeaders
+   if restCompression == "gzip":
+      compressed = gzip.compress(body, compresslevel=restCompressionLevel)
+   else:
+      compressed = zlib.compress(body, restCompressionLevel)
+   countStat("restCompressedPosts")
+   countStat("restWireBytes", len(compressed))
+   return compressed, restCompressedHeaders
+
+def setupRestConnectionPool():
+
+   global restTarget
+   global restStaticHeaders
+   global restCompressedHeaders
+   global restTlsContext
+   global restConnectionPools
+   global restTlsSessions
+   global restPoolLock
+
+   # the route may be configured without a scheme, in which case https is assumed
+
+   if "://" in targetUrl:
+      parsedUrl = urllib.parse.urlsplit(targetUrl)
+   else:
+      parsedUrl = urllib.parse.urlsplit("https://" + targetUrl)
+   if parsedUrl.scheme == "https":
+      port = parsedUrl.port or 443
+   else:
+      port = parsedUrl.port or 80
+   path = parsedUrl.path or "/"
+   if parsedUrl.query:
+      path = path + "?" + parsedUrl.query
+   restTarget = (parsedUrl.scheme, parsedUrl.hostname, port, path)
+   restStaticHeaders = buildRestHeaders()
+   restCompressedHeaders = dict(restStaticHeaders)
+   restCompressedHeaders["Content-Encoding"] = restCompression
+   restTlsContext = ssl._create_default_https_context()
+   restConnectionPools = {}
+   restTlsSessions = {}
+   restPoolLock = threading.Lock()
+   logging.info("REST connection pool: " + parsedUrl.scheme + "://" + parsedUrl.hostname + ":" + str(port) + path + ", " + str(restConnectionsPerHost) + " connection(s) per host")
+
+def acquireRestConnection(target):
+
+   scheme, host, port, path = target
+   with restPoolLock:
+      if (host, port) not in restConnectionPools:
+         restConnectionPools[(host, port)] = (threading.BoundedSemaphore(restConnectionsPerHost), queue.LifoQueue())
+      slots, idle = restConnectionPools[(host, port)]
+   slots.acquire()
+   try:
+      return idle.get_nowait()
+   except queue.Empty:
+      if scheme == "https":
+         return PooledHTTPSConnection(host, port, timeout=restRequestTimeout, context=restTlsContext)
+      else:
+         return PooledHTTPConnection(host, port, timeout=restRequestTimeout)
+
+def releaseRestConnection(target, conn, reusable):
+
+   scheme, host, port, path = target
+   slots, idle = restConnectionPools[(host, port)]
+   if reusable:
+      idle.put(conn)
+   else:
+      conn.close()
+   slots.release()
+
+def sendRestRequest(body, target=None, headers=None):
+
+   ##############################################################
+   #
+   # Posts a request body over a pooled keep-alive connection.
+   # Raises RestPostError for a non-2xx response
+   #
+   ##############################################################
+
+   if target is None:
+      target = restTarget
+   if headers is None:
+      headers = restStaticHeaders
+
+   attempt = 0
+   while True:
+      attempt += 1
+      conn = acquireRestConnection(target)
+      reusable = False
+      newConnection = conn.sock is None
+      try:
+         if newConnection:
+            conn.connect()
+            countStat("restConnects")
+            countStat("restConnectMs", conn.connectMs)
+            countStat("restTlsMs", conn.tlsMs)
+         start = time.perf_counter()
+         conn.request("POST", target[3], body=body, headers=headers)
+         response = conn.getresponse()
+         response.read()
+         countStat("restPosts")
+         countStat("restRequestMs", (time.perf_counter() - start) * 1000)
+         recordStageTime("post", time.perf_counter() - start)
+         reusable = not response.will_close
+         if response.status < 200 or response.status >= 300:
+            raise RestPostError(response.status, response.reason)
+         return response.status
+      except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+
+         # a kept-alive connection may have been closed by the server while idle. Retry once on a new connection
+
+         if newConnection or attempt > 1:
+            raise
+         countStat("restStaleConnections")
+      finally:
+         releaseRestConnection(target, conn, reusable)
+
+##########################################################################
+#
+# Write-ahead spool. Batches that can not be posted are appended to segment
+# files in log/spool (log/spool-<worker> with connectorWorkers > 1, or
+# log/spool-backfill for a backfill) as
+# records of a 4 byte length, a 4 byte crc32 and the uncompressed request
+# body. The spoolWriter thread writes every pending record and then fsyncs
+# once for the whole group before releasing the senders waiting on them. A
+# segment is closed at spoolSegmentBytes or spoolSegmentMaxAge seconds, the
+# oldest segments are dropped beyond spoolMaxBytes or spoolRetention
+# seconds, and the spoolReplayer thread posts the closed segments back at
+# up to spoolReplayRate batches per second while the API is reachable and
+# a sender is idle, so live traffic goes first
+#
+##########################################################################
+
+def openSpool(workerId):
+
+   global spoolDir
+   global spoolSequence
+   global spoolBytes
+   global spoolPositionFileName
+   global spoolReplayPosition
+
+   spoolDir = instancePath("spool", workerId)
+   os.makedirs(spoolDir, exist_ok=True)
+   for segmentName in sorted(glob.glob(spoolDir + "/segment-*.spool")):
+      spoolSegments.append(segmentName)
+      spoolBytes += os.path.getsize(segmentName)
+      spoolSequence = int(os.path.basename(segmentName)[8:-6])
+   spoolPositionFileName = spoolDir + "/replay.pos"
+   try:
+      with open(spoolPositionFileName, "r") as positionFile:
+         segmentName, offset = positionFile.read().split()
+         spoolReplayPosition = (segmentName, int(offset))
+   except (IOError, ValueError):
+      spoolReplayPosition = (None, 0)
+   if spoolSegments:
+      logging.info("Spool " + spoolDir + " holds " + str(len(spoolSegments)) + " segment(s), " + str(spoolBytes) + " bytes, which will be replayed")
+
+   spoolWriterThread = threading.Thread(target=spoolWriter, name="spoolWriter")
+   spoolWriterThread.daemon = True
+   spoolWriterThread.start()
+   spoolReplayerThread = threading.Thread(target=spoolReplayer, name="spoolReplayer")
+   spoolReplayerThread.daemon = True
+   spoolReplayerThread.start()
+
+def spoolAppend(body):
+
+   # queues a request body for the spool writer, and waits until it is on disk. Returns False if it could not be written
+
+   done = [ threading.Event(), False ]
+   spoolQueue.put((body, done))
+   done[0].wait()
+   return done[1]
 
-      while doRetry == True:
+def markRestUnreachable():
+
+   global restApiReachable
+
+   if restApiReachable:
+      restApiReachable = False
+      logging.info("WARNING: the metric API at " + targetUrl + " is unreachable. Batches will be written to the spool until it recovers")
+
+def closeSpoolSegment():
+
+   global spoolActive
+   global spoolRollRequested
+
+   spoolActive.close()
+   if spoolActiveBytes > 0:
+      spoolSegments.append(spoolActiveName)
+   else:
+      os.remove(spoolActiveName)
+   spoolActive = None
+   spoolRollRequested = False
+
+def openSpoolSegment():
+
+   global spoolActive
+   global spoolActiveName
+   global spoolActiveBytes
+   global spoolActiveOpened
+   global spoolSequence
+
+   spoolSequence += 1
+   spoolActiveName = spoolDir + "/segment-" + str(spoolSequence).zfill(12) + ".spool"
+   spoolActive = open(spoolActiveName, "ab")
+   spoolActiveBytes = 0
+   spoolActiveOpened = time.time()
+
+def dropSpoolSegment(segmentName, reason):
+
+   # called with spoolLock held
+
+   global spoolBytes
+
+   spoolSegments.remove(segmentName)
+   try:
+      spoolBytes -= os.path.getsize(segmentName)
+      os.remove(segmentName)
+   except OSError:
+      pass
+   if reason is not None:
+      countStat("spoolDroppedSegments")
+      logging.info("WARNING: dropped spool segment " + segmentName + " without replaying it: " + reason)
+
+def enforceSpoolLimits():
+
+   with spoolLock:
+      while spoolSegments and spoolBytes > spoolMaxBytes:
+         dropSpoolSegment(spoolSegments[0], "the spool is larger than spoolMaxBytes (" + str(spoolMaxBytes) + ")")
+      now = time.time()
+      while spoolSegments and now - os.path.getmtime(spoolSegments[0]) > spoolRetention:
+         dropSpoolSegment(spoolSegments[0], "it is older than spoolRetention (" + str(spoolRetention) + " seconds)")
+
+def spoolWriter():
+
+   global spoolActiveBytes
+   global spoolBytes
+
+   while shutdownRequest != True:
+      try:
+         pending = [ spoolQueue.get(timeout=1) ]
+      except queue.Empty:
+         pending = []
+      while True:
          try:
-            request = urllib.request.Request(targetUrl, data=encodedMetricData)
-            request.add_header("Content-Type",'application/json')
-            if(watsonProductTarget == "pi"):
-               request.add_header("X-TenantID",watsonTopicName)
-            logging.debug("setting authentication header, if required")
-            if(restMediationServiceAuthentication.lower() == "true"):
-               request.add_header("Authorization",authHeader)
-            if(watsonProductTarget == "aiops"):
-               request.add_header("X-TenantID",watsonTenantId)
-               request.add_header("Authorization", "ZenApiKey ".encode("utf-8") + zenApiKey)
-            logging.debug("Posting with headers: " + str(request.headers))
-            request.get_method = lambda: method
-            response = urllib.request.urlopen(request)
-            doRetry = False
-      
-         except IOError as e:
-            logging.info('Failed to open "%s".' % targetUrl)
-            if hasattr(e, 'code'):
-               logging.info('We failed with error code - %s.' % e.code)
-            if hasattr(e, 'reason'):
-               logging.info("The error object has the following 'reason' attribute :")
-               logging.info(e.reason)
-
-            if retries != retryCount:
-               retries = retries + 1
-               logging.info("going to retry, sleeping for " + str(retries * 3) + " seconds...")
-               time.sleep(retries * 3) 
-            else:
-               logging.info("max retries reached for metric post, saving to file and continuing...")
-               savFileName = mediatorHome + "/log/metricsave__" + datetime.now().strftime("%Y-%m-%d_%H:%M:%S") + ".json"
-               wrz = threading.Thread(target=writeZipFile, args=(savFileName, encodedMetricData), kwargs={})
-               wrz.start()
-               #savFile = open(mediatorHome + "/log/metricsave__" + currTime + ".json", "w")
-               #savFile.write(encodedMetricData)
-               doRetry = False 
+            pending.append(spoolQueue.get_nowait())
+         except queue.Empty:
+            break
+
+      with spoolLock:
+         if spoolActive is not None and (spoolRollRequested or spoolActiveBytes >= spoolSegmentBytes or time.time() - spoolActiveOpened >= spoolSegmentMaxAge):
+            closeSpoolSegment()
+      if not pending:
+         enforceSpoolLimits()
+         continue
+
+      written = False
+      try:
+         with spoolLock:
+            if spoolActive is None:
+               openSpoolSegment()
+            for body, done in pending:
+               spoolActive.write(struct.pack(">II", len(body), zlib.crc32(body)) + body)
+               spoolActiveBytes += 8 + len(body)
+               spoolBytes += 8 + len(body)
+            spoolActive.flush()
+         os.fsync(spoolActive.fileno())
+         written = True
+         countStat("spoolCommits")
+         countStat("spoolRecordsWritten", len(pending))
+      except Exception as error:
+         countStat("spoolWriteErrors")
+         logging.info("WARNING: unable to write " + str(len(pending)) + " batch(es) to the spool " + spoolDir + ": " + str(error))
+      for body, done in pending:
+         done[1] = written
+         done[0].set()
+      enforceSpoolLimits()
+
+def saveSpoolPosition(segmentName, offset):
+
+   # the position is not synced to disk. After a crash at most the batches replayed since the last write are posted again
+
+   global spoolReplayPosition
+
+   spoolReplayPosition = (segmentName, offset)
+   with open(spoolPositionFileName + ".tmp", "w") as positionFile:
+      positionFile.write(segmentName + " " + str(offset))
+   os.replace(spoolPositionFileName + ".tmp", spoolPositionFileName)
+
+def replaySpoolSegment(segmentName):
+
+   ###########################################################################
+   #
+   # Posts the records of a closed segment, resuming at the saved position,
+   # and deletes the segment once every record has been posted. Returns
+   # False if the API could not be reached, in which case it is retried later
+   #
+   ###########################################################################
+
+   global restApiReachable
+
+   offset = 0
+   if spoolReplayPosition[0] == segmentName:
+      offset = spoolReplayPosition[1]
+   try:
+      segment = open(segmentName, "rb")
+   except IOError:
+      with spoolLock:
+         if segmentName in spoolSegments:
+            dropSpoolSegment(segmentName, None)
+      return True
+   with segment:
+      segment.seek(offset)
+      while shutdownRequest != True:
+         header = segment.read(8)
+         if not header:
+            break
+         body = b""
+         if len(header) == 8:
+            length, crc = struct.unpack(">II", header)
+            body = segment.read(length)
+         if len(header) < 8 or len(body) < length or zlib.crc32(body) != crc:
+            countStat("spoolCorruptRecords")
+            logging.info("WARNING: spool segment " + segmentName + " has an incomplete or corrupt record at offset " + str(offset) + ", skipping the rest of the segment")
+            break
+
+         # live traffic goes first: only replay while a sender is idle
+
+         while restInFlight >= restSenderThreads and shutdownRequest != True:
+            time.sleep(0.1)
+         start = time.time()
+         result = postMetric(body, retryCount=1, spoolOnFailure=False)
+         if result == "failed":
+            markRestUnreachable()
+            return False
+         if not restApiReachable:
+            restApiReachable = True
+            logging.info("The metric API at " + targetUrl + " is reachable again, replaying " + str(spoolBytes) + " spooled bytes")
+         if result == "posted":
+            countStat("spoolReplayedBatches")
+            countStat("spoolReplayedBytes", length)
+         else:
+            countStat("spoolRejectedBatches")
+         offset += 8 + length
+         saveSpoolPosition(segmentName, offset)
+         pause = 1.0 / spoolReplayRate - (time.time() - start)
+         if pause > 0:
+            time.sleep(pause)
+      else:
+         return True
+   with spoolLock:
+      if segmentName in spoolSegments:
+         dropSpoolSegment(segmentName, None)
+   return True
+
+def spoolReplayer():
 
+   global spoolRollRequested
 
+   while shutdownRequest != True:
+      segmentName = None
+      with spoolLock:
+         if spoolSegments:
+            segmentName = spoolSegments[0]
+         elif spoolActive is not None and spoolActiveBytes > 0 and spoolQueue.empty():
+
+            # the open segment is only replayed once the writer has closed it
+
+            spoolRollRequested = True
+      if segmentName is None:
+         time.sleep(1)
+      elif not replaySpoolSegment(segmentName):
+         time.sleep(spoolProbeInterval)
 
 def logTimeDelta(first):
 
@@ -248,258 +1054,2328 @@ def logTimeDelta(first):
    #   likely due to a performance issue with the PI Kafka server.
    # 
    #
-   ###############################################################
+   ###############################################################
+
+   while shutdownRequest != True:
+      if first:
+         secToInterval = (( 4 - datetime.now().minute % int(watsonTopicAggInterval)) * 60 ) + (60 - datetime.now().second)
+         logging.info("Starting datachannel, " + str(secToInterval) + " seconds to next interval...")
+         time.sleep(secToInterval)
+      currTime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+      first=False
+      intervalStats = statsSince(intervalStatsBaseline)
+      logging.info('==== INTERVAL STATISTICS FOR ' + currTime + '====')
+      ###############################################
+      #
+      # If indicator/resource logging is requested...
+      #
+      ###############################################
+      if(logUniqueIndicators.lower() == "true"):
+         logging.debug('Unique indicators seen during interval: ' + str(intervalMetricSet))
+      if(logUniqueResources.lower() == "true"):
+         logging.debug('Unique resources seen during interval: ' + str(intervalResourceSet))
+      logging.info('Longest kafka latency for interval is: ' + str(longestDelta / 1000) + ' seconds.')
+      logging.info('Number of unique metric/resources consumed (metric count): ' + str(intervalMetricCount) )
+      logging.info('Number of unique metric indicators: ' + str(len(intervalMetricSet)))
+      logging.info('Number of unique resources: ' + str(len(intervalResourceSet)))
+      for stage in stageNames:
+         samples = intervalStats[stageTimingCountNames[stage]]
+         if samples > 0:
+            stageCounts = [ intervalStats[name] for name in stageTimingStatNames[stage] ]
+            logging.info('Stage latency ' + stage + ': ' + str(int(samples)) + ' samples, mean ' + str(round(intervalStats[stageTimingSumNames[stage]] / samples, 3)) + ' ms, p50 <= ' + str(histogramQuantile(stageCounts, stageTimingBounds, 0.5)) + ' ms, p90 <= ' + str(histogramQuantile(stageCounts, stageTimingBounds, 0.9)) + ' ms, p99 <= ' + str(histogramQuantile(stageCounts, stageTimingBounds, 0.99)) + ' ms')
+      logDropReport(intervalStats)
+      delayCounts = [ intervalStats[name] for name in ingestDelayStatNames ]
+      if sum(delayCounts) > 0:
+         logging.info('Ingestion delay: p50 <= ' + str(histogramQuantile(delayCounts, ingestDelayBounds, 0.5)) + ' seconds, p90 <= ' + str(histogramQuantile(delayCounts, ingestDelayBounds, 0.9)) + ' seconds, p99 <= ' + str(histogramQuantile(delayCounts, ingestDelayBounds, 0.99)) + ' seconds')
+      if connectorWorkers > 1:
+         logging.info('Datachannel producer queue length: ' + str(sum(gauges["queueLength"] for gauges in workerGauges.values())))
+         for workerId in sorted(workerGauges):
+            logging.info('Worker ' + str(workerId) + ': metric count: ' + str(intervalStats["worker" + str(workerId) + "MetricCount"]) + ', producer queue length: ' + str(workerGauges[workerId]["queueLength"]) + ', size of metricGroup: ' + str(workerGauges[workerId]["metricGroupSize"]) + ', REST batches in flight: ' + str(workerGauges[workerId]["restInFlight"]))
+      else:
+         logging.info('Datachannel producer queue length: ' + str(publishQueue.qsize()))
+      logging.info('Publish queue peak occupancy: ' + str(intervalMaxStats["publishQueueLength"]) + '/' + str(publishQueueMaxSize) + ' entries, consumer paused ' + str(intervalStats["consumerPauses"]) + ' time(s) for ' + str(intervalStats["consumerPausedMs"] / 1000) + ' seconds, blocked puts: ' + str(intervalStats["publishQueueFullWaits"]))
+      if(intervalStats["consumeBatches"] > 0):
+         avgBatch = intervalStats["consumedMessages"] / intervalStats["consumeBatches"]
+         logging.info('Kafka consume batches: ' + str(intervalStats["consumeBatches"]) + ', messages: ' + str(intervalStats["consumedMessages"]) + ', average batch fill: ' + str(round(avgBatch, 1)) + '/' + str(kafkaConsumeBatchSize) + ' (' + str(round(avgBatch * 100 / kafkaConsumeBatchSize, 1)) + '%), empty polls: ' + str(intervalStats["consumeEmptyPolls"]))
+      if(intervalStats["jsonDecodeErrors"] > 0):
+         logging.info('JSON messages not decoded: ' + str(intervalStats["jsonDecodeErrors"]))
+      if(intervalStats["avroDecodeErrors"] > 0 or intervalStats["avroUnknownSchemaId"] > 0):
+         logging.info('Avro messages not decoded: ' + str(intervalStats["avroDecodeErrors"]) + ' decode errors, ' + str(intervalStats["avroUnknownSchemaId"]) + ' with an unknown schema id')
+      if(intervalStats["restPosts"] > 0):
+         logging.info('REST posts: ' + str(intervalStats["restPosts"]) + ', average request time: ' + str(round(intervalStats["restRequestMs"] / intervalStats["restPosts"], 1)) + ' ms')
+      if(intervalStats["restUncompressedBytes"] > 0):
+         logging.info('REST bytes posted: ' + str(intervalStats["restWireBytes"]) + ' on the wire, ' + str(intervalStats["restUncompressedBytes"]) + ' uncompressed (' + str(round(intervalStats["restUncompressedBytes"] / max(intervalStats["restWireBytes"], 1), 1)) + 'x), compressed posts: ' + str(intervalStats["restCompressedPosts"]))
+      if(intervalStats["restConnects"] > 0):
+         logging.info('REST connections opened: ' + str(intervalStats["restConnects"]) + ', average connect time: ' + str(round(intervalStats["restConnectMs"] / intervalStats["restConnects"], 1)) + ' ms, average TLS handshake time: ' + str(round(intervalStats["restTlsMs"] / intervalStats["restConnects"], 1)) + ' ms, TLS sessions reused: ' + str(intervalStats["restTlsSessionsReused"]) + ', stale keep-alive connections: ' + str(intervalStats["restStaleConnections"]))
+      if aggregateMetrics and connectorWorkers == 1:
+         logging.info('Aggregation: ' + str(intervalStats["aggregationEntriesIn"]) + ' entries in, ' + str(intervalStats["aggregationEntriesOut"]) + ' entries out, late points dropped: ' + str(intervalStats["aggregationLatePoints"]) + ', open buckets: ' + str(len(aggregationBuckets)) + ', open series: ' + str(sum(len(bucket) for bucket in list(aggregationBuckets.values()))))
+      elif(intervalStats["aggregationEntriesIn"] > 0):
+         logging.info('Aggregation: ' + str(intervalStats["aggregationEntriesIn"]) + ' entries in, ' + str(intervalStats["aggregationEntriesOut"]) + ' entries out, late points dropped: ' + str(intervalStats["aggregationLatePoints"]))
+      if(intervalStats["counterRatesOut"] + intervalStats["counterBaselines"] > 0):
+         logging.info('Counter conversion: ' + str(intervalStats["counterRatesOut"]) + ' rates out, baselines: ' + str(intervalStats["counterBaselines"]) + ', wraps: ' + str(intervalStats["counterWraps"]) + ', resets: ' + str(intervalStats["counterResets"]) + ', out of order: ' + str(intervalStats["counterOutOfOrder"]) + ', series expired: ' + str(intervalStats["counterSeriesExpired"]) + ', evicted: ' + str(intervalStats["counterSeriesEvicted"]) + ', series tracked: ' + str(len(counterSeries)))
+      if(intervalStats["coalesceEntriesIn"] > 0):
+         logging.info('Coalescing: ' + str(intervalStats["coalesceEntriesIn"]) + ' entries in, ' + str(intervalStats["coalesceEntriesOut"]) + ' entries out (' + str(round(intervalStats["coalesceEntriesIn"] / max(intervalStats["coalesceEntriesOut"], 1), 1)) + ' metrics per entry)')
+      if(intervalStats["kafkaRecordsProduced"] > 0):
+         deliveries = intervalStats["kafkaDelivered"] + intervalStats["kafkaDeliveryFailures"]
+         logging.info('Kafka records produced: ' + str(intervalStats["kafkaRecordsProduced"]) + ' holding ' + str(intervalStats["kafkaMetricsProduced"]) + ' metrics (' + str(round(intervalStats["kafkaMetricsProduced"] / intervalStats["kafkaRecordsProduced"], 1)) + ' per record), ' + str(intervalStats["kafkaBytesProduced"]) + ' bytes before compression, local queue full waits: ' + str(intervalStats["kafkaProduceQueueFull"]))
+         logging.info('Kafka records delivered: ' + str(intervalStats["kafkaDelivered"]) + ', failed: ' + str(intervalStats["kafkaDeliveryFailures"]) + ' (' + str(intervalStats["kafkaFailedMetrics"]) + ' metrics), average delivery latency: ' + str(round(intervalStats["kafkaDeliveryMs"] / max(deliveries, 1), 1)) + ' ms, longest: ' + str(intervalMaxStats["kafkaDeliveryMs"]) + ' ms')
+      if(intervalStats["offsetCommits"] + intervalStats["offsetCommitErrors"] > 0):
+         logging.info('Kafka offset commits: ' + str(intervalStats["offsetCommits"]) + ' (' + str(intervalStats["offsetCommitPartitions"]) + ' partition offsets), failed: ' + str(intervalStats["offsetCommitErrors"]))
+      if rawTapEnabled:
+         logging.info('Raw metric tap: written: ' + str(intervalStats["rawTapWritten"]) + ', rate limited: ' + str(intervalStats["rawTapRateLimited"]) + ', dropped (writer behind): ' + str(intervalStats["rawTapDropped"]))
+      if(publishType.lower() == "rest" and connectorWorkers == 1):
+         logging.info('Size of metricGroup now: ' + str(sum(len(batch) for batch in restBatches)))
+         logging.info('REST batches in flight: ' + str(restInFlight) + ', peak: ' + str(intervalMaxStats["restInFlight"]) + '/' + str(restSenderThreads))
+      if(intervalStats["restSenderErrors"] > 0):
+         logging.info('REST sender errors: ' + str(intervalStats["restSenderErrors"]))
+      restFlushes = intervalStats["restFlush_full"] + intervalStats["restFlush_bytes"] + intervalStats["restFlush_age"] + intervalStats["restFlush_interval"]
+      if(restFlushes > 0):
+         logging.info('REST batch flushes: ' + str(intervalStats["restFlush_full"]) + ' full, ' + str(intervalStats["restFlush_bytes"]) + ' on byte size, ' + str(intervalStats["restFlush_age"]) + ' on max age, ' + str(intervalStats["restFlush_interval"]) + ' on interval boundary. Average batch age: ' + str(round(intervalStats["restFlushBatchAgeMs"] / restFlushes / 1000, 1)) + ' seconds, oldest: ' + str(intervalMaxStats["restFlushBatchAgeMs"] / 1000) + ' seconds')
+      if(publishType.lower() == "rest" and connectorWorkers == 1):
+         logging.info('REST target batch size: ' + str(restTargetBatchSize) + ' metrics (max ' + str(restBatchSize) + '), average ' + str(int(intervalStats["restFlushBytes"] / max(intervalStats["restFlushMetrics"], 1))) + ' bytes per metric, batch splits: ' + str(intervalStats["restBisections"]) + ' (' + str(intervalStats["restOversizeSplits"]) + ' over restBatchMaxBytes), metrics spooled: ' + str(intervalStats["restSavedMetrics"]) + ', rejected: ' + str(intervalStats["restRejectedMetrics"]) + ', lost: ' + str(intervalStats["restLostMetrics"]))
+         logging.info('Spool: ' + str(spoolBytes) + ' bytes in ' + str(len(spoolSegments) + (spoolActive is not None)) + ' segment(s), API reachable: ' + str(restApiReachable) + ', batches written: ' + str(intervalStats["spoolRecordsWritten"]) + ' in ' + str(intervalStats["spoolCommits"]) + ' fsync(s), replayed: ' + str(intervalStats["spoolReplayedBatches"]) + ' (' + str(intervalStats["spoolReplayedBytes"]) + ' bytes), segments dropped: ' + str(intervalStats["spoolDroppedSegments"]) + ', corrupt records: ' + str(intervalStats["spoolCorruptRecords"]) + ', write errors: ' + str(intervalStats["spoolWriteErrors"]))
+      if(intervalStats["restSentBatches"] > 0):
+         logging.info('REST batches sent: ' + str(intervalStats["restSentBatches"]) + ', metrics sent: ' + str(intervalStats["restSentMetrics"]) + ' (' + str(round(intervalStats["restSentMetrics"] / (int(watsonTopicAggInterval) * 60), 1)) + ' metrics/second)')
+      intervalMetricSet.clear()
+      intervalResourceSet.clear()
+      intervalMaxStats.clear()
+      intervalMetricCount = 0
+      longestDelta = 0
+      time.sleep(int(watsonTopicAggInterval) * 60)
+
+def logTimeDeltaCron(callback_func, first=True):
+
+   #################################################################
+   #
+   # Sets up a "cron" type job that logs perf stats every 60 seconds
+   #
+   #################################################################
+   
+   if first:
+      secToInterval = (( 4 - datetime.now().minute % int(watsonTopicAggInterval)) * 60 ) + (60 - datetime.now().second)
+      time.sleep(secToInterval)
+   callback_func()
+   time.sleep(int(watsonTopicAggInterval) * 60)
+   logTimeDeltaCron(callback_func, False)
+
+
+###############################################################
+#
+# Functions to load the schema id -> schema cache used to decode
+# Avro messages in the Confluent wire format
+#
+###############################################################
+
+def loadAvroSchema(schemaId):
+
+   schemaFile = avroSchemaDir + "/" + str(schemaId) + ".json"
+   if(os.path.exists(schemaFile)):
+      try:
+         with open(schemaFile, "rt") as f:
+            avroSchemaCache[schemaId] = fastavro.parse_schema(json.loads(f.read()))
+         logging.info("Loaded Avro schema id " + str(schemaId) + " from " + schemaFile)
+         return avroSchemaCache[schemaId]
+      except Exception as e:
+         logging.info("WARNING: Unable to parse Avro schema file " + schemaFile + ": " + str(e))
+   else:
+      logging.info("WARNING: No Avro schema file found for schema id " + str(schemaId) + " at " + schemaFile)
+
+   # remember unknown ids so that the file system is not checked for every message
+
+   avroSchemaCache[schemaId] = None
+   return None
+
+def loadAvroSchemaCache(dirpath):
+
+   if(os.path.isdir(dirpath)):
+      for fileName in sorted(os.listdir(dirpath)):
+         if fileName.endswith(".json") and fileName[:-5].isdigit():
+            loadAvroSchema(int(fileName[:-5]))
+   logging.info("Avro schema cache contains " + str(len(avroSchemaCache)) + " schema(s) from " + dirpath)
+
+def fastAvroDecode(msg_value):
+
+   #############################################################################################
+   #
+   # This function decodes the SevOne avro message, and returns a PI mapped/converted dictionary
+   #
+   #############################################################################################
+
+   return readAvroMessage(io.BytesIO(msg_value), msg_value, 0)
+
+def readAvroMessage(reader, msg_value, start):
+
+   #############################################################################################
+   #
+   # Decodes msg_value, which reader holds at offset start
+   #
+   # Messages in the Confluent wire format start with a zero magic byte followed by a 4 byte
+   # big-endian schema id, and are decoded with the cached schema for that id
+   #
+   #############################################################################################
+
+   if avroWireFormat != "raw" and len(msg_value) > 5 and msg_value[0] == 0:
+      schemaId = int.from_bytes(msg_value[1:5], "big")
+      if schemaId in avroSchemaCache:
+         writerSchema = avroSchemaCache[schemaId]
+      else:
+         writerSchema = loadAvroSchema(schemaId)
+      if writerSchema is not None:
+         reader.seek(start + 5)
+         return fastavro.schemaless_reader(reader, writerSchema)
+      elif avroWireFormat == "confluent":
+         countStat("avroUnknownSchemaId")
+         return None
+   reader.seek(start)
+   return fastavro.schemaless_reader(reader, parsed_schema)
+
+def fastAvroDecodeBatch(values):
+
+   ###########################################################
+   #
+   # Decodes a batch of Avro message values from a single
+   # reader over the whole batch. Entries that can not be
+   # decoded, or whose record does not end where the message
+   # ends, are returned as None
+   #
+   ###########################################################
+
+   global avroDecodeErrorInterval
+
+   reader = io.BytesIO(b"".join(values))
+   events = []
+   start = 0
+   for value in values:
+      end = start + len(value)
+      try:
+         event_dict = readAvroMessage(reader, value, start)
+         if event_dict is not None and reader.tell() != end:
+            raise ValueError("the record is " + str(reader.tell() - start) + " bytes long, but the message is " + str(len(value)) + " bytes")
+      except Exception as error:
+
+         # fastavro raises several exception types on a corrupt record, and any of them only drops that record
+
+         countStat("avroDecodeErrors")
+         interval = int(time.time()) // (int(watsonTopicAggInterval) * 60)
+         if interval != avroDecodeErrorInterval:
+            avroDecodeErrorInterval = interval
+            logging.info("WARNING: unable to decode an Avro message of " + str(len(value)) + " bytes: " + type(error).__name__ + ": " + str(error) + ". Further decode errors this interval are only counted")
+         event_dict = None
+      events.append(event_dict)
+      start = end
+   return events
+
+def jsonDecodeBatch(values):
+
+   ###########################################################
+   #
+   # Decodes a batch of JSON message values. Entries that can
+   # not be decoded, or that are not JSON objects, are
+   # returned as None
+   #
+   ###########################################################
+
+   events = []
+   for value in values:
+      try:
+         event_dict = json.loads(value)
+      except (TypeError, ValueError):
+         event_dict = None
+      if not isinstance(event_dict, dict):
+         countStat("jsonDecodeErrors")
+         event_dict = None
+      events.append(event_dict)
+   return events
+
+
+def translateToWatsonMetric(event_dict):
+
+   ################################################################################################
+   #
+   # This is the translation function to translate the SevOne json format to the Watson json format.
+   # Returns the metric entry, which publishEntries later serializes into a fragment of the groups
+   # body. A message that cannot be translated is passed to recordDrop with the reason, and "NULL"
+   # is returned
+   #
+   ################################################################################################
+
+   # Build WAIOps json
+   if("name" not in event_dict):
+      recordDrop("noName", event_dict)
+      return("NULL")
+   elif(event_dict["name"] in ignoreMetrics):
+
+      # ignored metrics are only counted, they are not malformed
+
+      countStat(dropStatNames["ignored"])
+      return("NULL")
+   try:
+      host = event_dict.get("host")
+      if(not isinstance(host, dict) or "host" not in host):
+         recordDrop("noHost", event_dict)
+         return("NULL")
+      if("item_tags" not in event_dict):
+         recordDrop("noItemTags", event_dict)
+         return("NULL")
+      component = None
+      metricname = None
+      for tag in event_dict["item_tags"]:
+         if tag["tag"] == "KafkaSubcomponent":
+            component = tag["value"]
+         elif tag["tag"] == "KafkaMetric":
+            metricname = tag["value"]
+      if(metricname is None):
+         recordDrop("noMetricTag", event_dict)
+         return("NULL")
+      if(component is None):
+         recordDrop("noComponentTag", event_dict)
+         return("NULL")
+      if("value" not in event_dict):
+         recordDrop("noValue", event_dict)
+         return("NULL")
+      if("clock" not in event_dict):
+         recordDrop("noClock", event_dict)
+         return("NULL")
+      try:
+         value = float(event_dict["value"])
+      except (TypeError, ValueError):
+         recordDrop("nonNumericValue", event_dict)
+         return("NULL")
+      waiopsMetric = dict()
+      waiopsMetric["attributes"] = dict()
+      waiopsMetric["metrics"] = dict()
+      waiopsMetric["attributes"]["node"] = host["host"]
+      waiopsMetric["metrics"][metricname] = value
+      waiopsMetric["attributes"]["component"] = component
+      waiopsMetric["attributes"]["group"] = watsonMetricGroup
+      if(event_dict["name"] in counterMetrics):
+         waiopsMetric["attributes"]["accumulators"] = event_dict["name"]
+      waiopsMetric["timestamp"] = str(int(event_dict["clock"] * 1000))
+      waiopsMetric["tenantID"] = watsonTopicName
+      waiopsMetric["resourceID"] = host["host"] + ":" + component
+      return(waiopsMetric)
+   except Exception as error:
+      recordDrop("translationError", event_dict, error)
+      return("NULL")
+
+##############################################################################
+#
+# Raw metric tap. Translated metrics that pass the host/metric filters are
+# sampled (1-in-N and/or at most N per second) onto a bounded queue, and are
+# serialized and written to log/rawJson.log by a background writer thread so
+# the reader thread never waits on disk
+#
+##############################################################################
+
+def tapRawMetric(waiopsMetric, fragment):
+
+   global rawTapSeen
+   global rawTapWindowStart
+   global rawTapWindowCount
+
+   if rawTapHostRegex is not None and not rawTapHostRegex.search(waiopsMetric["attributes"].get("node", "")):
+      return
+   if rawTapMetricRegex is not None:
+      for metricName in waiopsMetric["metrics"]:
+         if rawTapMetricRegex.search(metricName):
+            break
+      else:
+         return
+   rawTapSeen += 1
+   if rawTapSampleRate > 1 and rawTapSeen % rawTapSampleRate != 0:
+      return
+   if rawTapMaxPerSecond > 0:
+      now = int(time.time())
+      if now != rawTapWindowStart:
+         rawTapWindowStart = now
+         rawTapWindowCount = 0
+      if rawTapWindowCount >= rawTapMaxPerSecond:
+         countStat("rawTapRateLimited")
+         return
+      rawTapWindowCount += 1
+   try:
+      rawTapQueue.put_nowait(fragment)
+   except queue.Full:
+      countStat("rawTapDropped")
+
+def writeRawJson(rawJson):
+
+   global jsonLogFileLocation
+   global rawTapFileBytes
+
+   if isinstance(rawJson, bytes):
+      line = rawJson + b"\n"
+   else:
+      line = json.dumps(rawJson).encode("utf-8") + b"\n"
+   jsonLogFileLocation.write(line)
+   rawTapFileBytes += len(line)
+   if rawTapFileBytes >= rawTapMaxFileSize:
+
+      # rotate the raw JSON log, keeping one previous file
+
+      jsonLogFileLocation.close()
+      os.replace(rawTapFileName, rawTapFileName + ".1")
+      jsonLogFileLocation = open(rawTapFileName, "wb")
+      rawTapFileBytes = 0
+
+def rawTapWriter():
+
+   while shutdownRequest != True:
+      rawJson = rawTapQueue.get()
+      writeRawJson(rawJson)
+      countStat("rawTapWritten")
+      if rawTapQueue.empty():
+         jsonLogFileLocation.flush()
+
+def startRawTap(workerId):
+
+   global jsonLogFileLocation
+   global rawTapFileName
+   global rawTapFileBytes
+
+   rawTapFileName = instancePath("rawJson", workerId, ".log")
+   jsonLogFileLocation = open(rawTapFileName, "wb")
+   rawTapFileBytes = 0
+   logging.info("Raw metric tap writing to " + rawTapFileName + ", sampling 1 in " + str(rawTapSampleRate) + ", max per second: " + str(rawTapMaxPerSecond))
+
+   rawTapThread = threading.Thread(target=rawTapWriter, name="rawTapWriter")
+   rawTapThread.daemon = True
+   rawTapThread.start()
+
+def publishMetric():
+
+   ##########################################################################
+   #
+   # Kafka publisher thread function. Metrics are assigned to a partition of
+   # the Watson topic by a crc32 of their resourceID, so each resource keeps
+   # to one partition, and packed into per-partition records of up to
+   # watsonKafkaRecordBytes. A record is produced when it is full, or once
+   # its oldest metric has waited watsonKafkaRecordMaxAge seconds
+   #
+   ##########################################################################
+
+   global shutdownRequest
+
+   # block until a message hits the publish queue
+
+   while shutdownRequest != True:
+      now = time.time()
+      deadline = now + 1
+      for startTime in kafkaRecordStartTimes.values():
+         deadline = min(deadline, startTime + watsonKafkaRecordMaxAge)
+      try:
+         item = publishQueue.get(timeout=max(deadline - now, 0.01))
+      except queue.Empty:
+         item = None
+
+      with kafkaRecordLock:
+         now = time.time()
+         if item is not None:
+            if "queuedAt" in item:
+               recordStageTime("queueWait", time.perf_counter() - item["queuedAt"])
+            tokens = item["tokens"]
+            for resourceID, fragment in item["metrics"]:
+               partition = zlib.crc32(resourceID.encode("utf-8")) % watsonKafkaPartitions
+               if partition in kafkaRecords:
+                  if kafkaRecordBytes[partition] + len(fragment) + 13 > watsonKafkaRecordBytes:
+                     produceRecord(partition)
+               if partition not in kafkaRecords:
+                  kafkaRecords[partition] = []
+                  kafkaRecordBytes[partition] = 0
+                  kafkaRecordStartTimes[partition] = now
+                  kafkaRecordTokens[partition] = set()
+               kafkaRecords[partition].append(fragment)
+               kafkaRecordBytes[partition] += len(fragment) + 1
+               for token in tokens:
+                  if token not in kafkaRecordTokens[partition]:
+                     kafkaRecordTokens[partition].add(token)
+                     holdTokens((token,))
+            releaseTokens(tokens)
+            publishQueue.task_done()
+         for partition in list(kafkaRecords):
+            if kafkaDrainRequested or now - kafkaRecordStartTimes[partition] >= watsonKafkaRecordMaxAge:
+               produceRecord(partition)
+
+def produceRecord(partition):
+
+   # called with kafkaRecordLock held
+
+   fragments = kafkaRecords.pop(partition)
+   del kafkaRecordBytes[partition]
+   del kafkaRecordStartTimes[partition]
+   produceMetric(buildGroupsBody(fragments), partition, len(fragments), tuple(kafkaRecordTokens.pop(partition)))
+
+def kafkaPoller():
+
+   # services producer delivery callbacks, so the publisher never has to
+
+   while shutdownRequest != True:
+      watsonProducer.poll(0.1)
+
+def flushKafkaProducer(timeout):
+
+   # produces the partly filled records and waits for every record to be delivered
+
+   with kafkaRecordLock:
+      for partition in list(kafkaRecords):
+         produceRecord(partition)
+   remaining = watsonProducer.flush(timeout)
+   if remaining > 0:
+      logging.info("WARNING: " + str(remaining) + " kafka record(s) were not delivered within " + str(timeout) + " seconds")
+
+def restSender(senderId, sendQueue):
+
+   ########################################################################
+   #
+   # REST sender thread function. Each sender posts one batch at a time, so
+   # up to restSenderThreads batches are in flight while restQueueReader
+   # keeps accumulating the next ones
+   #
+   ########################################################################
+
+   global restInFlight
+
+   while shutdownRequest != True:
+      groups, tokens, queuedAt = sendQueue.get()
+      recordStageTime("sendQueueWait", time.perf_counter() - queuedAt)
+      with restInFlightLock:
+         restInFlight += 1
+         maxStat("restInFlight", restInFlight)
+      try:
+         if postMetricBatch(groups):
+            releaseTokens(tokens)
+      except Exception as error:
+
+         # the sender keeps running. The batch is saved to the spool if it can be, otherwise it is lost and its
+         # offsets are held back, as for a batch that could neither be posted nor saved
+
+         countStat("restSenderErrors")
+         logging.info("WARNING: REST sender " + str(senderId) + " failed on a batch of " + str(len(groups)) + " metrics: " + type(error).__name__ + ": " + str(error))
+         if saveFailedBatch(groups):
+            releaseTokens(tokens)
+      finally:
+         with restInFlightLock:
+            restInFlight -= 1
+         sendQueue.task_done()
+
+def saveFailedBatch(fragments):
+
+   # writes a batch a sender failed on to the spool. Returns False if it could not be written
+
+   try:
+      saved = spoolAppend(buildGroupsBody(fragments))
+   except Exception as error:
+      logging.info("WARNING: unable to spool the failed batch: " + type(error).__name__ + ": " + str(error))
+      saved = False
+   if saved:
+      countStat("restSavedMetrics", len(fragments))
+   else:
+      countStat("restLostMetrics", len(fragments))
+   return saved
+
+def startRestSenders():
+
+   ###########################################################################
+   #
+   # When restPreserveOrder is "true", metrics are sharded by resourceID into
+   # one batch per sender, and each sender has its own queue, so metrics for a
+   # resource are always posted in order by the same sender. Otherwise, all
+   # senders share a single batch and queue
+   #
+   ###########################################################################
+
+   global restShardCount
+   global restSendQueues
+   global restInFlight
+   global restInFlightLock
+
+   restInFlight = 0
+   restInFlightLock = threading.Lock()
+   if restPreserveOrder:
+      restShardCount = restSenderThreads
+      restSendQueues = [ queue.Queue(maxsize=2) for shard in range(restShardCount) ]
+   else:
+      restShardCount = 1
+      restSendQueues = [ queue.Queue(maxsize=restSenderThreads * 2) ]
+   for senderId in range(restSenderThreads):
+      senderThread = threading.Thread(target=restSender, args=(senderId, restSendQueues[senderId % len(restSendQueues)]), name="restSender-" + str(senderId))
+      senderThread.daemon = True
+      senderThread.start()
+   logging.info("Started " + str(restSenderThreads) + " REST sender thread(s), preserve order per resource: " + str(restPreserveOrder))
+
+def setupAdaptiveBatchSize():
+
+   global restTargetBatchSize
+   global adaptiveLock
+   global adaptiveDirection
+   global adaptiveLastThroughput
+   global adaptiveMetrics
+   global adaptiveSeconds
+   global adaptivePosts
+
+   restTargetBatchSize = restBatchSize
+   adaptiveLock = threading.Lock()
+   adaptiveDirection = -1
+   adaptiveLastThroughput = 0
+   adaptiveMetrics = 0
+   adaptiveSeconds = 0
+   adaptivePosts = 0
+
+def flushRestBatch(shard, reason):
+
+   # hands the shard's batch to its sender queue. This blocks only when all senders are busy and their queues are full
+
+   batch = restBatches[shard]
+   batchAge = time.time() - restBatchStartTimes[shard]
+   countStat("restFlush_" + reason)
+   countStat("restFlushBatchAgeMs", int(batchAge * 1000))
+   countStat("restFlushMetrics", len(batch))
+   countStat("restFlushBytes", restBatchBytes[shard])
+   maxStat("restFlushBatchAgeMs", int(batchAge * 1000))
+   logging.debug("publishing batch of " + str(len(batch)) + " metrics, flush reason: " + reason + ", batch age: " + str(round(batchAge, 1)) + " seconds")
+   restSendQueues[shard].put((batch, restBatchTokens[shard], time.perf_counter()))
+   restBatchTokens[shard] = set()
+   restBatches[shard] = []
+   restBatchBytes[shard] = 0
+   restBatchStartTimes[shard] = None
+
+def nextIntervalFlushTime(now):
+
+   # the next watsonTopicAggInterval boundary, plus restIntervalFlushDelay to let the last metrics of the interval arrive
+
+   intervalSeconds = int(watsonTopicAggInterval) * 60
+   return (int(now - restIntervalFlushDelay) // intervalSeconds + 1) * intervalSeconds + restIntervalFlushDelay
+
+def restQueueReader():
+
+   ##########################################################################
+   #
+   # Accumulates metrics from the publish queue into REST batches. A batch
+   # is flushed when it is full (restTargetBatchSize metrics, or
+   # restBatchMaxBytes of serialized JSON), when its oldest metric has waited
+   # restBatchMaxAge seconds, or at each AIOps aggregation interval boundary
+   # (if restIntervalFlush is enabled), so that all metrics for an interval
+   # are posted together. The queue is read with a timeout so that flushes
+   # happen on time even when traffic is quiet
+   #
+   ##########################################################################
+
+   global shutdownRequest
+
+   global restBatches
+   global restBatchBytes
+   global restBatchStartTimes
+   global restBatchTokens
+
+   restBatchTokens = [ set() for shard in range(restShardCount) ]
+   restBatches = [ [] for shard in range(restShardCount) ]
+   restBatchBytes = [ 0 ] * restShardCount
+   restBatchStartTimes = [ None ] * restShardCount
+
+   # block until a message hits the publish queue
+
+   print("Starting queue reader for REST publishing")
+   intervalFlushTime = nextIntervalFlushTime(time.time())
+   while shutdownRequest != True:
+
+      # wait no longer than the next age or interval flush deadline
+
+      now = time.time()
+      deadline = now + 1
+      if restIntervalFlush:
+         deadline = min(deadline, intervalFlushTime)
+      for startTime in restBatchStartTimes:
+         if startTime is not None:
+            deadline = min(deadline, startTime + restBatchMaxAge)
+      try:
+         item = publishQueue.get(timeout=max(deadline - now, 0.01))
+      except queue.Empty:
+         item = None
+
+      now = time.time()
+      if item is not None:
+         if "queuedAt" in item:
+            recordStageTime("queueWait", time.perf_counter() - item["queuedAt"])
+         tokens = item["tokens"]
+         for resourceID, fragment in item["metrics"]:
+            if restShardCount == 1:
+               shard = 0
+            else:
+               shard = hash(resourceID) % restShardCount
+
+            # flush before the body (fragments, separators and the '{"groups":[]}' wrapper) would exceed restBatchMaxBytes
+
+            if(restBatchBytes[shard] > 0 and restBatchBytes[shard] + len(fragment) + 13 > restBatchMaxBytes):
+               flushRestBatch(shard, "bytes")
+            if restBatchStartTimes[shard] is None:
+               restBatchStartTimes[shard] = now
+            restBatches[shard].append(fragment)
+            restBatchBytes[shard] += len(fragment) + 1
+            for token in tokens:
+               if token not in restBatchTokens[shard]:
+                  restBatchTokens[shard].add(token)
+                  holdTokens((token,))
+            if(len(restBatches[shard]) >= restTargetBatchSize):
+               flushRestBatch(shard, "full")
+         releaseTokens(tokens)
+         publishQueue.task_done()
+
+      if restIntervalFlush and now >= intervalFlushTime:
+         for shard in range(restShardCount):
+            if(len(restBatches[shard]) > 0):
+               flushRestBatch(shard, "interval")
+         intervalFlushTime = nextIntervalFlushTime(now)
+
+      for shard in range(restShardCount):
+         if restBatchStartTimes[shard] is not None and now - restBatchStartTimes[shard] >= restBatchMaxAge:
+            flushRestBatch(shard, "age")
+
+      if restDrainRequested:
+         for shard in range(restShardCount):
+            if(len(restBatches[shard]) > 0):
+               flushRestBatch(shard, "drain")
+
+
+def processMessageBatch(msgs):
+
+   ##########################################################################
+   #
+   # Decodes and translates a batch of consumed kafka messages, and places
+   # all of the resulting metrics on the publish queue as a single entry
+   #
+   ##########################################################################
+
+   global intervalMetricCount
+   global longestDelta
+   global stageTimingBatches
+
+   entries = []
+   lastMessage = "NULL"
+   avroFormat = sevOneKafkaDataFormat.lower() == "avro"
+   currTime = int(time.time() * 1000)
+
+   # stage timing is taken for one batch in every stageTimingSampleRate
+
+   stageTimingBatches += 1
+   timed = stageTimingSampleRate > 0 and stageTimingBatches % stageTimingSampleRate == 0
+   if timed:
+      stageStart = time.perf_counter()
+
+   tokens = trackBatchOffsets(msgs)
+   values = []
+   for msg in msgs:
+      if msg.error():
+         if msg.error().code() == KafkaError._PARTITION_EOF:
+            logging.info('Kafka error: end of partition reached')
+         else:
+            logging.info('Kafka error occured')
+         continue
+      values.append(msg.value())
+
+   if avroFormat:
+      events = fastAvroDecodeBatch(values)
+   else:
+      events = jsonDecodeBatch(values)
+   if timed:
+      decoded = time.perf_counter()
+      recordStageTime("decode", decoded - stageStart, len(values))
+
+   delayBuckets = collections.Counter()
+   delaySum = 0
+   for event_dict in events:
+      if event_dict is None:
+         recordDrop("decodeError", None)
+         continue
+      waiopsMetric = translateToWatsonMetric(event_dict)
+      lastMessage = waiopsMetric
+      if(waiopsMetric == "NULL"):
+         continue
+
+      # translated metrics always carry a timestamp, messages without a clock are dropped by translateToWatsonMetric
+
+      entries.append(waiopsMetric)
+      deltaTime = currTime - int(waiopsMetric["timestamp"])
+      if(deltaTime > longestDelta):
+         longestDelta = deltaTime
+      delayBuckets[bisect.bisect_left(ingestDelayBounds, deltaTime / 1000)] += 1
+      delaySum += deltaTime
+      intervalMetricSet.update(waiopsMetric["metrics"])
+      intervalResourceSet.add(waiopsMetric["resourceID"])
+   if timed:
+      recordStageTime("translate", time.perf_counter() - decoded, len(events))
+   countStat("translatedEntries", len(entries))
+   for bucket, count in delayBuckets.items():
+      countStat(ingestDelayStatNames[bucket], count)
+   if delayBuckets:
+      countStat(ingestDelaySumName, delaySum)
+
+   if convertCounters:
+      entries = convertCounterEntries(entries)
+
+   if(len(entries) > 0):
+      intervalMetricCount += len(entries)
+      if aggregateMetrics:
+         aggregateEntries(entries, tokens)
+      else:
+         emitEntries(entries, time.time(), tokens)
+
+   # the stages holding metrics from the batch have taken their own holds on its ack token
+
+   releaseTokens(tokens)
+   return lastMessage
+
+def emitEntries(entries, now, tokens=()):
+
+   # passes final metric entries to the coalescing stage, or straight to the publish queue
+
+   if coalesceMetrics:
+      coalesceEntries(entries, now, tokens)
+   else:
+      publishEntries(entries, tokens)
+
+def pipelineTick(now):
+
+   # called after every consume, so that the aggregation and coalescing stages flush on time when the topic is quiet
+
+   if convertCounters:
+      expireCounterSeries(now)
+      if now - counterStateSavedAt >= counterStateFrequency:
+         saveCounterState()
+   if aggregateMetrics:
+      closeAggregationBuckets(now)
+   if coalesceMetrics:
+      flushCoalesced(now)
+
+def flushPipelineStages():
+
+   # force-closes the open aggregation buckets and flushes the coalescing buffer onto the publish queue.
+   # Returns True if either stage held any metrics
+
+   with pipelineLock:
+      held = len(aggregationBuckets) + len(coalesceBuffer) > 0
+      now = time.time()
+      if aggregateMetrics:
+         closeAggregationBuckets(now, force=True)
+      if coalesceMetrics:
+         flushCoalesced(now, force=True)
+   return held
+
+def shutdownPipeline():
+
+   # final housekeeping for the pipeline stages when the reader stops or the process exits. Metrics still held
+   # by the aggregation and coalescing stages are published before the final flush and offset commit
+
+   if flushPipelineStages():
+      drainPublisher()
+   if convertCounters:
+      saveCounterState()
+   if publishType.lower() == "kafka" and "watsonProducer" in globals():
+      flushKafkaProducer(10)
+   if commitOffsets and "c" in globals():
+      commitAckedOffsets(c, asynchronous=False)
+
+##########################################################################
+#
+# Counter to rate conversion. Items listed in conf/counter-metrics.conf are
+# converted to per-second rates using the previous value and timestamp of
+# the same series, held in an OrderedDict in least recently updated order
+#
+#    counterSeries[(resourceID, itemName, metric)] = [ value, ts, seenAt ]
+#
+# The first point of a series only sets its baseline. A value lower than
+# the previous one is taken as a 32 or 64 bit counter wrap when the wrapped
+# delta is less than half the counter range, otherwise as a counter reset,
+# which sets a new baseline. Series that have not reported for
+# counterSeriesTimeout seconds, or beyond counterMaxSeries, are evicted.
+# The table is saved to log/counter-state*.json every counterStateFrequency
+# seconds and at shutdown, and reloaded on start
+#
+##########################################################################
+
+def counterDelta(lastValue, value):
+
+   if value >= lastValue:
+      return value - lastValue
+   if lastValue < 2 ** 32:
+      counterRange = 2 ** 32
+   else:
+      counterRange = 2 ** 64
+   delta = value + counterRange - lastValue
+   if delta < counterRange / 2:
+      countStat("counterWraps")
+      return delta
+   return None
+
+def convertCounterEntries(entries):
+
+   now = time.time()
+   converted = []
+   rates = 0
+   with counterStateLock:
+      for entry in entries:
+         itemName = entry["attributes"].get("accumulators")
+         if itemName is None:
+            converted.append(entry)
+            continue
+         ts = int(entry["timestamp"]) / 1000
+         metric, value = next(iter(entry["metrics"].items()))
+         key = (entry["resourceID"], itemName, metric)
+         state = counterSeries.get(key)
+         if state is None:
+            counterSeries[key] = [ value, ts, now ]
+            countStat("counterBaselines")
+            continue
+         counterSeries.move_to_end(key)
+         if ts <= state[1]:
+            countStat("counterOutOfOrder")
+            continue
+         delta = counterDelta(state[0], value)
+         elapsed = ts - state[1]
+         state[0] = value
+         state[1] = ts
+         state[2] = now
+         if delta is None:
+            countStat("counterResets")
+            continue
+         del entry["attributes"]["accumulators"]
+         entry["metrics"][metric] = delta / elapsed
+         converted.append(entry)
+         rates += 1
+      countStat("counterRatesOut", rates)
+      while len(counterSeries) > counterMaxSeries:
+         counterSeries.popitem(last=False)
+         countStat("counterSeriesEvicted")
+   return converted
+
+def expireCounterSeries(now):
+
+   # series are kept in least recently updated order, so only the front of the table needs checking
+
+   with counterStateLock:
+      while counterSeries:
+         key, state = next(iter(counterSeries.items()))
+         if now - state[2] < counterSeriesTimeout:
+            break
+         del counterSeries[key]
+         countStat("counterSeriesExpired")
+
+def saveCounterState():
+
+   global counterStateSavedAt
+
+   counterStateSavedAt = time.time()
+   if counterStateFileName is None:
+      return
+   with counterStateLock:
+      series = [ [ key[0], key[1], key[2], state[0], state[1] ] for key, state in counterSeries.items() ]
+   try:
+      tmpFileName = counterStateFileName + ".tmp"
+      with open(tmpFileName, "w") as stateFile:
+         json.dump({ "savedAt": counterStateSavedAt, "series": series }, stateFile)
+         stateFile.flush()
+         os.fsync(stateFile.fileno())
+      os.replace(tmpFileName, counterStateFileName)
+      logging.debug("Saved " + str(len(series)) + " counter series to " + counterStateFileName)
+   except Exception as error:
+      logging.info("WARNING: unable to save counter state to " + counterStateFileName + ": " + str(error))
+
+def loadCounterState(workerId):
+
+   # every state file is read, since a series may have been handled by a different worker before a restart or rebalance.
+   # A backfill starts from empty state and does not save it, as its series are historical
+
+   global counterStateFileName
+
+   if backfillMode:
+      return
+   counterStateFileName = instancePath("counter-state", workerId, ".json")
+   now = time.time()
+   loaded = 0
+   for stateFileName in sorted(glob.glob(mediatorHome + "/log/counter-state*.json")):
+      try:
+         with open(stateFileName, "r") as stateFile:
+            state = json.load(stateFile)
+      except Exception as error:
+         logging.info("WARNING: unable to read counter state file " + stateFileName + ": " + str(error))
+         continue
+      if now - state["savedAt"] >= counterSeriesTimeout:
+         logging.info("Ignoring counter state file " + stateFileName + ", it is older than counterSeriesTimeout")
+         continue
+      for resourceID, itemName, metric, value, ts in state["series"]:
+         key = (resourceID, itemName, metric)
+         if key not in counterSeries or counterSeries[key][1] < ts:
+            counterSeries[key] = [ value, ts, now ]
+            loaded += 1
+   logging.info("Loaded " + str(loaded) + " counter series from saved state")
+
+##########################################################################
+#
+# Aggregation stage. Points are aggregated per resourceID and metric into
+# watsonTopicAggInterval buckets with the function configured for the
+# metric name in conf/metric-aggregation.conf (avg, max, min, sum or last,
+# defaulting to aggregationDefaultFunction), and one point per bucket is
+# emitted. Buckets are held as
+#
+#    aggregationBuckets[bucketStart][(resourceID, accumulators)] =
+#       [ attributes, { metric: [ count, sum, min, max, last, lastTs ] } ]
+#
+# and a bucket is emitted once the clock passes its end plus
+# aggregationLateness seconds. Points for an already emitted bucket are
+# dropped. The clock is the wall clock, or the newest point timestamp seen
+# when aggregationEventTime is set (historical backfill)
+#
+##########################################################################
+
+aggregationFunctionNames = [ "avg", "max", "min", "sum", "last" ]
+
+def aggregateEntries(entries, tokens=()):
+
+   global aggregationWatermark
+
+   intervalSeconds = int(watsonTopicAggInterval) * 60
+   countStat("aggregationEntriesIn", len(entries))
+   touched = set()
+   for entry in entries:
+      ts = int(entry["timestamp"]) // 1000
+      if aggregationEventTime and ts > aggregationWatermark:
+         aggregationWatermark = ts
+      bucketStart = ts - ts % intervalSeconds
+      if bucketStart <= aggregationClosedThrough:
+         countStat("aggregationLatePoints", len(entry["metrics"]))
+         continue
+      bucket = aggregationBuckets.get(bucketStart)
+      if bucket is None:
+         bucket = aggregationBuckets[bucketStart] = {}
+         aggregationBucketTokens[bucketStart] = set()
+      if tokens:
+         touched.add(bucketStart)
+      attributes = entry["attributes"]
+      key = (entry["resourceID"], attributes.get("accumulators"))
+      series = bucket.get(key)
+      if series is None:
+         series = bucket[key] = [ attributes, {} ]
+      for metric, value in entry["metrics"].items():
+         state = series[1].get(metric)
+         if state is None:
+            series[1][metric] = [ 1, value, value, value, value, ts ]
+         else:
+            state[0] += 1
+            state[1] += value
+            if value < state[2]:
+               state[2] = value
+            if value > state[3]:
+               state[3] = value
+            if ts >= state[5]:
+               state[4] = value
+               state[5] = ts
+
+   # each open bucket holds the ack tokens of the batches that contributed to it until it is emitted
+
+   for bucketStart in touched:
+      for token in tokens:
+         if token not in aggregationBucketTokens[bucketStart]:
+            aggregationBucketTokens[bucketStart].add(token)
+            holdTokens((token,))
+
+def aggregatedValue(metric, state):
+
+   function = aggregationFunctions.get(metric, aggregationDefaultFunction)
+   if function == "avg":
+      return state[1] / state[0]
+   elif function == "sum":
+      return state[1]
+   elif function == "min":
+      return state[2]
+   elif function == "max":
+      return state[3]
+   else:
+      return state[4]
+
+def closeAggregationBuckets(now, force=False):
+
+   global aggregationClosedThrough
+
+   intervalSeconds = int(watsonTopicAggInterval) * 60
+   if aggregationEventTime:
+      clock = aggregationWatermark
+   else:
+      clock = now
+   for bucketStart in sorted(aggregationBuckets):
+      if not force and clock < bucketStart + intervalSeconds + aggregationLateness:
+         break
+      bucket = aggregationBuckets.pop(bucketStart)
+      bucketTokens = aggregationBucketTokens.pop(bucketStart)
+      if bucketStart > aggregationClosedThrough:
+         aggregationClosedThrough = bucketStart
+      timestamp = str(bucketStart * 1000)
+      entries = []
+      for (resourceID, accumulators), series in bucket.items():
+         waiopsMetric = dict()
+         waiopsMetric["attributes"] = series[0]
+         waiopsMetric["metrics"] = { metric: aggregatedValue(metric, state) for metric, state in series[1].items() }
+         waiopsMetric["timestamp"] = timestamp
+         waiopsMetric["tenantID"] = watsonTopicName
+         waiopsMetric["resourceID"] = resourceID
+         entries.append(waiopsMetric)
+      countStat("aggregationEntriesOut", len(entries))
+      logging.debug("Closing aggregation bucket " + timestamp + " with " + str(len(entries)) + " entries")
+      emitEntries(entries, now, tuple(bucketTokens))
+      releaseTokens(bucketTokens)
+
+##########################################################################
+#
+# Coalescing stage. Entries for the same resourceID and timestamp (e.g. the
+# 30 items of a host:component collected at the same clock) are merged into
+# one entry whose metrics dict holds all of their values. Entries wait in
+# the buffer for at most coalesceWindow seconds after the first item for
+# their key arrived
+#
+##########################################################################
+
+def coalesceEntries(entries, now, tokens=()):
+
+   # each buffered entry holds the ack tokens of the batches merged into it
+
+   countStat("coalesceEntriesIn", len(entries))
+   holds = collections.Counter()
+   for entry in entries:
+
+      # counter items carry an 'accumulators' attribute, and are only merged with entries that have the same one
+
+      key = (entry["resourceID"], entry["timestamp"], entry["attributes"].get("accumulators"))
+      pending = coalesceBuffer.get(key)
+      if pending is None:
+         coalesceBuffer[key] = [entry, now, set(tokens)]
+         holds.update(tokens)
+      else:
+         pending[0]["metrics"].update(entry["metrics"])
+         for token in tokens:
+            if token not in pending[2]:
+               pending[2].add(token)
+               holds[token] += 1
+   holdTokenCounts(holds)
+   flushCoalesced(now)
+
+def flushCoalesced(now, force=False):
+
+   # the buffer is insertion ordered, so the oldest entries come first
+
+   ready = []
+   overLimit = len(coalesceBuffer) - coalesceMaxEntries
+   for key, pending in coalesceBuffer.items():
+      if not force and now - pending[1] < coalesceWindow and len(ready) >= overLimit:
+         break
+      ready.append(key)
+   if(len(ready) > 0):
+      entries = []
+      releases = collections.Counter()
+      for key in ready:
+         pending = coalesceBuffer.pop(key)
+         entries.append(pending[0])
+         releases.update(pending[2])
+      countStat("coalesceEntriesOut", len(entries))
+      publishEntries(entries, tuple(releases))
+      releaseTokenCounts(releases)
+
+def publishEntries(entries, tokens=()):
+
+   ########################################################################
+   #
+   # Serializes final metric entries to JSON fragments and places them on
+   # the publish queue as a single entry, holding the ack tokens of the
+   # batches they came from until the sink has delivered them
+   #
+   ########################################################################
+
+   global stageTimingItems
+
+   holdTokens(tokens)
+   stageTimingItems += 1
+   timed = stageTimingSampleRate > 0 and stageTimingItems % stageTimingSampleRate == 0
+   if timed:
+      stageStart = time.perf_counter()
+   item = {}
+   item["metrics"] = [ (entry["resourceID"], serializeMetric(entry)) for entry in entries ]
+   item["tokens"] = tokens
+   if timed:
+      item["queuedAt"] = time.perf_counter()
+      recordStageTime("serialize", item["queuedAt"] - stageStart, len(entries))
+   if rawTapEnabled:
+      for entry, metric in zip(entries, item["metrics"]):
+         tapRawMetric(entry, metric[1])
+   try:
+      publishQueue.put_nowait(item)
+   except queue.Full:
+      countStat("publishQueueFullWaits")
+      publishQueue.put(item)
+
+##########################################################################
+#
+# At-least-once offset commits. Every consumed batch gets an AckToken,
+# which is queued behind the earlier batches of each of its partitions in
+# ackPartitions. Each pipeline stage holding metrics from a batch (an
+# aggregation bucket, a coalesced entry, a publish queue item, a REST batch
+# or a Kafka record) holds the batch's token, and releases it once the
+# metrics are passed on, posted, spooled or delivered. Every
+# offsetCommitInterval seconds the reader asynchronously commits, per
+# partition, the offset after the last batch of the longest run of
+# released batches, so a restart resumes after the last delivered message
+#
+##########################################################################
+
+class AckToken(object):
+
+   __slots__ = ("pending",)
+
+   def __init__(self):
+
+      # held by the reader until the batch has been processed
+
+      self.pending = 1
+
+def trackBatchOffsets(msgs):
+
+   # returns the ack tokens for a consumed batch: a single token, or none if offsets are not committed
+
+   if not commitOffsets:
+      return ()
+   token = AckToken()
+   nextOffsets = {}
+   for msg in msgs:
+      if msg.error():
+         continue
+      key = (msg.topic(), msg.partition())
+      if msg.offset() >= nextOffsets.get(key, 0):
+         nextOffsets[key] = msg.offset() + 1
+   with ackLock:
+      for key, offset in nextOffsets.items():
+         if key not in ackPartitions:
+            ackPartitions[key] = collections.deque()
+         ackPartitions[key].append((token, offset))
+   return (token,)
+
+def holdTokens(tokens):
+
+   if tokens:
+      with ackLock:
+         for token in tokens:
+            token.pending += 1
+
+def releaseTokens(tokens):
+
+   if tokens:
+      with ackLock:
+         for token in tokens:
+            token.pending -= 1
+
+def holdTokenCounts(counts):
+
+   if counts:
+      with ackLock:
+         for token, count in counts.items():
+            token.pending += count
+
+def releaseTokenCounts(counts):
+
+   if counts:
+      with ackLock:
+         for token, count in counts.items():
+            token.pending -= count
+
+def commitAckedOffsets(consumer, asynchronous=True, partitions=None):
+
+   ###########################################################################
+   #
+   # Commits the offsets of the partitions (all, or those in partitions)
+   # that have advanced since their last commit. A failed commit is retried
+   # with the next one
+   #
+   ###########################################################################
+
+   global lastOffsetCommit
+
+   lastOffsetCommit = time.time()
+   offsets = []
+   with ackLock:
+      for key, pending in ackPartitions.items():
+         while pending and pending[0][0].pending <= 0:
+            ackedOffsets[key] = pending.popleft()[1]
+      for key, offset in ackedOffsets.items():
+         if partitions is not None and key not in partitions:
+            continue
+         if offset > committedOffsets.get(key, -1):
+            offsets.append(TopicPartition(key[0], key[1], offset))
+            committedOffsets[key] = offset
+   if not offsets:
+      return
+   try:
+      consumer.commit(offsets=offsets, asynchronous=asynchronous)
+      countStat("offsetCommits")
+      countStat("offsetCommitPartitions", len(offsets))
+   except Exception as error:
+      offsetCommitFailed(offsets)
+      logging.info("WARNING: unable to commit kafka offsets: " + str(error))
+
+def offsetCommitFailed(offsets):
+
+   countStat("offsetCommitErrors")
+   with ackLock:
+      for tp in offsets:
+         if committedOffsets.get((tp.topic, tp.partition)) == tp.offset:
+            del committedOffsets[(tp.topic, tp.partition)]
+
+def onOffsetsCommitted(err, partitions):
+
+   # delivery report of an asynchronous commit
+
+   if err is not None:
+      logging.info("WARNING: kafka offset commit failed: " + str(err))
+      offsetCommitFailed(partitions)
+
+def onPartitionsRevoked(consumer, partitions):
+
+   # commits what has been delivered before a rebalance takes the partitions away, and stops tracking them
+
+   revoked = partitionKeys(partitions)
+   commitAckedOffsets(consumer, asynchronous=False, partitions=revoked)
+   with ackLock:
+      for key in revoked:
+         ackPartitions.pop(key, None)
+         ackedOffsets.pop(key, None)
+         committedOffsets.pop(key, None)
+
+#########################################################################
+#
+# Backpressure: when the publish queue reaches its high watermark, the
+# consumer's assigned partitions are paused, and they are resumed once the
+# queue has drained to the low watermark
+#
+#########################################################################
+
+def partitionKeys(partitions):
+
+   return set((tp.topic, tp.partition) for tp in partitions)
+
+def checkBackpressure():
+
+   global consumerPaused
+   global pausedPartitions
+   global pauseCheckTime
+
+   queueLength = publishQueue.qsize()
+   maxStat("publishQueueLength", queueLength)
+
+   if consumerPaused:
+      now = time.time()
+      countStat("consumerPausedMs", int((now - pauseCheckTime) * 1000))
+      pauseCheckTime = now
+      if queueLength <= publishQueueLowWatermark:
+         c.resume(c.assignment())
+         consumerPaused = False
+         logging.info("Publish queue drained to " + str(queueLength) + " entries, resuming kafka consumption")
+      else:
+
+         # partitions assigned by a rebalance while paused must be paused as well
+
+         assignment = c.assignment()
+         if partitionKeys(assignment) != pausedPartitions:
+            c.pause(assignment)
+            pausedPartitions = partitionKeys(assignment)
+   elif queueLength >= publishQueueHighWatermark:
+      assignment = c.assignment()
+      c.pause(assignment)
+      pausedPartitions = partitionKeys(assignment)
+      consumerPaused = True
+      pauseCheckTime = time.time()
+      countStat("consumerPauses")
+      logging.info("Publish queue reached " + str(queueLength) + " entries, pausing kafka consumption of " + str(len(assignment)) + " partition(s)")
+
+def sdbReader():
+
+   ########################################
+   #
+   # SevOne Data Bus reader thread function
+   #
+   ########################################
+
+    shutdownRequest = False
+    lastMessage = "NULL"
+    try:
+        while shutdownRequest != True:
+            checkBackpressure()
+            msgs = c.consume(kafkaConsumeBatchSize, kafkaConsumeMaxWait)
+            now = time.time()
+            with pipelineLock:
+                pipelineTick(now)
+            if commitOffsets and now - lastOffsetCommit >= offsetCommitInterval:
+                commitAckedOffsets(c)
+            if not msgs:
+                countStat("consumeEmptyPolls")
+                continue
+            countStat("consumeBatches")
+            countStat("consumedMessages", len(msgs))
+            with pipelineLock:
+                lastMessage = processMessageBatch(msgs)
+    
+    except Exception as error:
+       logging.info("An exception occurred: " + str(error))
+       shutdownRequest = True
+       now = datetime.now()
+       ts = now.strftime("%d/%m/%Y %H-%M-%S")
+       logging.info('Mediator shut down at: ' + ts)
+       if(lastMessage):
+          logging.info('Last message: ' + json.dumps(lastMessage))
+       if(publishThread is not None and publishThread.is_alive()):
+          
+          logging.debug("publishThread is still alive")
+       if("perfStatThread" in globals() and perfStatThread.is_alive()):
+          logging.debug("perfStatThread is still alive")
+       c.close()
+       sys.stdout.close()
+
+def startPublisher(workerId):
+
+   ####################################################
+   #
+   # Connect to Watson Kafka bus if publishing to kafka,
+   # or start the REST queue reader if publishing to REST
+   #
+   ####################################################
+
+   global watsonProducer
+   global watsonKafkaPartitions
+   global restQueueThread
+
+   if publishType.lower() == "kafka":
+
+      logging.debug("connecting to watsonKafkaServers: " + watsonKafkaServers)
+      
+      watsonKafkaConfig = {
+           'bootstrap.servers': watsonKafkaServers,
+           'client.id': "SevOneDatachannel@" + socket.gethostname(),
+           'linger.ms': watsonKafkaLingerMs,
+           'batch.size': watsonKafkaBatchBytes,
+           'compression.type': watsonKafkaCompression}
+      
+      if watsonKafkaSSL.lower() == "true":
+         kafkasslsettings = {
+            'security.protocol' : 'SSL',
+            'ssl.ca.location': watsonSSLCaLocation,
+            'ssl.certificate.location': watsonSSLCertificateLocation,
+            'ssl.key.location': watsonSSLKeyLocation }
+         watsonKafkaConfig.update(kafkasslsettings)
+      else:
+         logging.debug("Watson Kafka connection does not require SSL")
+      
+      watsonProducer = Producer(watsonKafkaConfig)
+      
+      watson_admin_client = AdminClient(watsonKafkaConfig)
+      topics = watson_admin_client.list_topics().topics
+      if not topics:
+         logging.info("FATAL: Unable to verify connectivity and topics in the Watson kafka bus at " + watsonKafkaServers + ". Verify kafka configuration, reconfigure, and retry.")
+         print(("FATAL: Unable to verify connectivity and topics in the Watson kafka bus at " + watsonKafkaServers + ". Verify kafka configuration, reconfigure, and retry."))
+         exit()
+      elif watsonKafkaTopicName not in topics:
+         print(("FATAL: Watson kafka topic name (" + watsonKafkaTopicName + ") does not exist in the Watson kafka. Available topics: " + str(list(topics)) + ". Ensure proper topic configuration."))
+         exit()
+      
+      watsonKafkaPartitions = len(topics[watsonKafkaTopicName].partitions)
+      logging.info("Publishing to " + str(watsonKafkaPartitions) + " partition(s) of Watson kafka topic " + watsonKafkaTopicName + ", compression: " + watsonKafkaCompression + ", linger: " + str(watsonKafkaLingerMs) + " ms, record size: " + str(watsonKafkaRecordBytes) + " bytes")
+      
+      logging.debug("Watson AIOps Kafka topic available.")
+
+      kafkaPollerThread = threading.Thread(target=kafkaPoller, name="kafkaPoller")
+      kafkaPollerThread.daemon = True
+      kafkaPollerThread.start()
+
+   elif publishType.lower() == "rest":
+
+      # start up a thread to pick up the queue messages and add them to the restMetricGroup["groups"] 
+      logging.debug("publishType is \'rest\', let's start a restQueueThread")
+      
+      setupRestConnectionPool()
+      setupAdaptiveBatchSize()
+
+      # the spool replayer checks the senders' in-flight count, so they are started first
+
+      startRestSenders()
+      openSpool(workerId)
+      restQueueThread = threading.Thread(target=restQueueReader, name="restQueueReader")
+      restQueueThread.daemon = True
+      restQueueThread.start()
+
+def sevOneKafkaSettings(groupId, clientId):
+
+   # consumer settings for the SevOne Kafka bus
+
+   kafkasettings = {
+       'bootstrap.servers': sevOneKafkaServers,
+       'group.id': groupId,
+       'client.id': clientId,
+       'enable.auto.commit': False,
+       'session.timeout.ms': 6000,
+       'socket.timeout.ms': 3000,
+       'default.topic.config': {'auto.offset.reset': 'latest'}
+   }
+   
+   if sevOneKafkaSSL.lower() == "true":
+      kafkasslsettings = {
+         'security.protocol' : 'SSL',
+         'ssl.ca.location': sevOneSSLCaLocation,
+         'ssl.certificate.location': sevOneSSLCertificateLocation,
+         'ssl.key.location': sevOneSSLKeyLocation }
+      kafkasettings.update(kafkasslsettings)
+   else:
+      logging.debug("SevOne SDB Kafka connection does not require SSL")
+
+   return kafkasettings
+
+def connectSevOneKafka(workerId):
+
+   #############################
+   #
+   # Connect to SevOne Kafka bus
+   #
+   #############################
+
+   kafkasettings = sevOneKafkaSettings('waiopsMetric-Restgroup', 'waiopsMetric-Restclient-' + str(workerId) + '@' + socket.gethostname())
+   
+   logging.debug("kafka settings are: " + str(kafkasettings))
+   
+   consumer = Consumer(dict(kafkasettings, on_commit=onOffsetsCommitted))    # is this version buggy? thinks this is a Producer
+   
+   logging.debug("Verifying SevOne kafka topic - listing topics")
+   logging.info("==============================================")
+   logging.info("= IGNORE FOLLOWING PRODUCER WARNINGS         =")
+   logging.info("==============================================")
+   
+   admin_client = AdminClient(kafkasettings)
+   topics = admin_client.list_topics().topics
+   if not topics:
+      logging.info("FATAL: Unable to verify connectivity and topics in SevOne kafka bus at " + sevOneKafkaServers + ". Verify kafka configuration, reconfigure, and retry.")
+      print(("FATAL: Unable to verify connectivity and topics in SevOne kafka bus at " + sevOneKafkaServers + ". Verify kafka configuration, reconfigure, and retry."))
+      exit()
+   elif sevOneKafkaTopicName not in topics:
+      print(("FATAL: SevOne kafka topic name does not exist in SevOne kafka. Available topics: " + str(list(topics)) + ". Ensure proper topic configuration."))
+      exit()
+   
+   logging.debug("Successfully listed topics in SevOne kafka. Topics returned: " + str(topics))
+   
+   logging.debug("Subscribing to SevOne kafka topic")
+   try:
+      consumer.subscribe([sevOneKafkaTopicName], on_revoke=onPartitionsRevoked)
+   except Exception as e:
+      logging.info("FATAL: Unable to connect to SevOne Kafka bus at " + sevOneKafkaServers + ". Verify Kafka configuration, reconfigure, and retry.")
+      print(("FATAL: Unable to connect to SevOne Kafka bus at " + sevOneKafkaServers + ". Verify Kafka configuration, reconfigure, and retry."))
+      exit()
+      
+   logging.debug("SevOne Kafka Topic available.")
+
+   return consumer
+
+def startPipelineThreads(workerId, readerTarget=None):
+
+   global sdbReaderThread
+   global publishThread
+
+   if rawTapEnabled:
+      startRawTap(workerId)
+
+   if convertCounters:
+      loadCounterState(workerId)
+
+   # Start a reader thread to connect to the SevOne kafka bus and receive messages
+
+   if readerTarget is None:
+      readerTarget = sdbReader
+   sdbReaderThread = threading.Thread(target=readerTarget, name=readerTarget.__name__)
+   sdbReaderThread.daemon = True
+   sdbReaderThread.start()
+
+   # Start a publisher thread that will pick up transformed metric JSON and place it on the Watson kafka topic
+
+   publishThread = None
+   if(publishType.lower() == "kafka"):
+      publishThread = threading.Thread(target=publishMetric, name="publishMetric")
+      publishThread.daemon = True
+      publishThread.start()
+
+##########################################################################
+#
+# Sampling profiler. While it is on, a thread takes the stack of every
+# other thread profilerSampleRate times a second, from
+# sys._current_frames(), and counts the stacks by thread name. The counts
+# are written as folded stacks, "thread;outer frame;...;inner frame
+# count" per line, which flamegraph.pl and speedscope read. It is turned
+# on and off with SIGUSR2 or the admin endpoint's /profile, and stops by
+# itself after profilerMaxDuration. While it is off no thread runs. With
+# worker processes, the supervisor sets the requested state shared with
+# the workers and signals them, and each worker writes its own profile
+#
+##########################################################################
+
+def profileSampler(stopEvent, counts, fileName):
+
+   global profilerSamples
+
+   interval = 1.0 / profilerSampleRate
+   ownIdent = threading.get_ident()
+   threadNames = {}
+   namesRefreshed = 0
+   started = lastWrite = time.time()
+   while not stopEvent.wait(interval):
+      now = time.time()
+
+      # thread names are looked up once a second rather than on every sample
+
+      if now - namesRefreshed >= 1:
+         threadNames = { thread.ident: thread.name for thread in threading.enumerate() }
+         namesRefreshed = now
+      for ident, frame in sys._current_frames().items():
+         if ident == ownIdent:
+            continue
+         threadName = threadNames.get(ident, "thread-" + str(ident))
+         if profilerThreads and not threadName.startswith(profilerThreads):
+            continue
+
+         # the code objects are kept, and only turned into names when the profile is written
+
+         codes = []
+         while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+         stack = (threadName, tuple(codes))
+         counts[stack] = counts.get(stack, 0) + 1
+      profilerSamples += 1
+      if profilerMaxDuration > 0 and now - started >= profilerMaxDuration:
+         logging.info("Profiler reached profilerMaxDuration (" + str(profilerMaxDuration) + " seconds), stopping")
+         break
+      if now - lastWrite >= profilerWriteInterval:
+         writeProfile(counts, fileName)
+         lastWrite = now
+   writeProfile(counts, fileName)
+
+def foldedStacks(counts):
+
+   # returns the stack counts as folded stack lines, outermost frame first
+
+   lines = []
+   for (threadName, codes), count in sorted(dict(counts).items(), key=lambda stack: -stack[1]):
+      frames = [ threadName ]
+      for code in reversed(codes):
+         frames.append(codeModuleName(code.co_filename) + ":" + code.co_name)
+      lines.append(";".join(frames).replace(" ", "_") + " " + str(count))
+   return "\n".join(lines) + "\n" if lines else ""
+
+def codeModuleName(filename):
+
+   # threading.py becomes threading, and logging/__init__.py becomes logging
+
+   if filename not in profilerModuleNames:
+      name = os.path.splitext(os.path.basename(filename))[0]
+      if name == "__init__":
+         name = os.path.basename(os.path.dirname(filename))
+      profilerModuleNames[filename] = name
+   return profilerModuleNames[filename]
+
+def writeProfile(counts, fileName):
+
+   # the profile is rewritten in full and renamed into place, so that it can be read while the profiler runs
+
+   try:
+      with open(fileName + ".tmp", "w") as profileFile:
+         profileFile.write(foldedStacks(counts))
+      os.replace(fileName + ".tmp", fileName)
+   except OSError as error:
+      logging.info("WARNING: unable to write the profile " + fileName + ": " + str(error))
+
+def profilerForwarding():
+
+   # the supervisor of worker processes does not profile itself, it passes requests on to the workers
+
+   return profilerRequest is not None and profilerWorkerId == 0
+
+def startProfiler():
+
+   global profilerThread
+   global profilerStopEvent
+   global profilerCounts
+   global profilerFile
+   global profilerSamples
+
+   with profilerLock:
+      if profilerForwarding():
+         profilerRequest.value = 1
+         signalWorkers(signal.SIGUSR2)
+         return "Profiler started in the worker processes"
+      if profilerThread is not None and profilerThread.is_alive():
+         return "Profiler already running, writing " + profilerFile
+      profilerStopEvent = threading.Event()
+      profilerCounts = {}
+      profilerSamples = 0
+      profilerFile = instancePath("profile-" + datetime.now().strftime("%Y%m%d-%H%M%S"), profilerWorkerId, ".folded")
+      profilerThread = threading.Thread(target=profileSampler, args=(profilerStopEvent, profilerCounts, profilerFile), name="profiler")
+      profilerThread.daemon = True
+      profilerThread.start()
+      logging.info("Profiler started, sampling " + str(profilerSampleRate) + " times a second" + (" the threads named " + ", ".join(profilerThreads) + "*" if profilerThreads else "") + ", writing " + profilerFile)
+      return "Profiler started, writing " + profilerFile
+
+def stopProfiler():
+
+   with profilerLock:
+      if profilerForwarding():
+         profilerRequest.value = 0
+         signalWorkers(signal.SIGUSR2)
+         return "Profiler stopped in the worker processes"
+      if profilerThread is None or not profilerThread.is_alive():
+         return "Profiler is not running"
+      profilerStopEvent.set()
+      profilerThread.join()
+      logging.info("Profiler stopped after " + str(profilerSamples) + " samples, wrote " + profilerFile)
+      return "Profiler stopped after " + str(profilerSamples) + " samples, wrote " + profilerFile
+
+def profilerRunning():
+
+   if profilerForwarding():
+      return profilerRequest.value == 1
+   return profilerThread is not None and profilerThread.is_alive()
+
+def toggleProfilerHandler(*args):
+
+   # SIGUSR2 turns the profiler on, or off when it is running. A worker follows the state the supervisor requested
+
+   if profilerRequest is not None and profilerWorkerId > 0:
+      wanted = profilerRequest.value == 1
+   else:
+      wanted = not profilerRunning()
+   if wanted:
+      startProfiler()
+   else:
+      stopProfiler()
+
+def signalWorkers(signalNumber):
+
+   for worker in workerProcesses.values():
+      if worker.is_alive():
+         os.kill(worker.pid, signalNumber)
+
+def profilePage(query):
+
+   # /profile?action=start or ?action=stop, and without an action the status and the stacks sampled so far
+
+   action = query.get("action", [ "" ])[0]
+   if action == "start":
+      status = startProfiler()
+   elif action == "stop":
+      status = stopProfiler()
+   elif action == "":
+      if profilerForwarding():
+         status = "Profiler " + ("running" if profilerRunning() else "stopped") + " in the worker processes, which write their own profiles"
+      elif profilerRunning():
+         status = "Profiler running, " + str(profilerSamples) + " samples, writing " + profilerFile
+      elif profilerFile is not None:
+         status = "Profiler stopped, last profile in " + profilerFile
+      else:
+         status = "Profiler stopped"
+   else:
+      raise ValueError("unknown action " + action + ", use start or stop")
+   body = status + "\n"
+   if action == "" and profilerCounts:
+      body += "\n" + foldedStacks(profilerCounts)
+   return "text/plain; charset=utf-8", body.encode("utf-8")
+
+##########################################################################
+#
+# Admin HTTP endpoint, on metricsPort. GET /metrics serves the statistics
+# in the Prometheus text format: every counted statistic as a counter
+# (dropped_<reason> as zabbix_connector_dropped_total{reason=...}), the
+# ingestion delay as a histogram, and pipeline gauges. The endpoint runs
+# in the supervisor when there are worker processes, and reports their
+# merged statistics
+#
+##########################################################################
+
+class AdminRequestHandler(http.server.BaseHTTPRequestHandler):
+
+   def do_GET(self):
+
+      url = urllib.parse.urlsplit(self.path)
+      route = adminRoutes.get(url.path)
+      if route is None:
+         self.send_error(404, "Unknown path, available: " + ", ".join(sorted(adminRoutes)))
+         return
+      try:
+         contentType, body = route(urllib.parse.parse_qs(url.query))
+      except Exception as error:
+         logging.info("WARNING: admin endpoint request for " + url.path + " failed: " + str(error))
+         self.send_error(500, str(error))
+         return
+      self.send_response(200)
+      self.send_header("Content-Type", contentType)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, format, *args):
+
+      logging.debug("admin endpoint: " + (format % args))
+
+def metricName(statName):
+
+   # consumedMessages becomes zabbix_connector_consumed_messages
+
+   return "zabbix_connector_" + re.sub(r"([a-z0-9])([A-Z])", r"\1_\2", statName).lower()
+
+def appendMetric(lines, name, metricType, helpText, samples):
+
+   lines.append("# HELP " + name + " " + helpText)
+   lines.append("# TYPE " + name + " " + metricType)
+   for labels, value in samples:
+      lines.append(name + labels + " " + repr(float(value)))
+
+def metricsPage(query):
+
+   totals = statsTotals()
+   lines = []
+
+   dropped = [ ("{reason=\"" + name[8:] + "\"}", value) for name, value in sorted(totals.items()) if name.startswith("dropped_") ]
+   appendMetric(lines, "zabbix_connector_dropped_total", "counter", "Messages and points dropped, by reason", dropped)
+
+   cumulative = 0
+   buckets = []
+   for bound, name in zip(ingestDelayBounds + [ "+Inf" ], ingestDelayStatNames):
+      cumulative += totals[name]
+      buckets.append(("{le=\"" + str(bound) + "\"}", cumulative))
+   lines.append("# HELP zabbix_connector_ingestion_delay_seconds Time from the Zabbix item clock to the connector reading it")
+   lines.append("# TYPE zabbix_connector_ingestion_delay_seconds histogram")
+   for labels, value in buckets:
+      lines.append("zabbix_connector_ingestion_delay_seconds_bucket" + labels + " " + str(value))
+   lines.append("zabbix_connector_ingestion_delay_seconds_sum " + repr(totals[ingestDelaySumName] / 1000))
+   lines.append("zabbix_connector_ingestion_delay_seconds_count " + str(cumulative))
+
+   lines.append("# HELP zabbix_connector_stage_seconds Time taken per item by each pipeline stage, sampled")
+   lines.append("# TYPE zabbix_connector_stage_seconds histogram")
+   for stage in stageNames:
+      cumulative = 0
+      for bound, name in zip(stageTimingBounds + [ "+Inf" ], stageTimingStatNames[stage]):
+         cumulative += totals[name]
+         if bound != "+Inf":
+            bound = bound / 1000
+         lines.append("zabbix_connector_stage_seconds_bucket{stage=\"" + stage + "\",le=\"" + str(bound) + "\"} " + str(cumulative))
+      lines.append("zabbix_connector_stage_seconds_sum{stage=\"" + stage + "\"} " + repr(totals[stageTimingSumNames[stage]] / 1000))
+      lines.append("zabbix_connector_stage_seconds_count{stage=\"" + stage + "\"} " + str(cumulative))
+
+   for name, value in sorted(totals.items()):
+      if name.startswith("dropped_") or name.startswith("stageTime") or name in ingestDelayStatNames or name == ingestDelaySumName:
+         continue
+      appendMetric(lines, metricName(name) + "_total", "counter", "Connector statistic " + name, [ ("", value) ])
+
+   if connectorWorkers > 1:
+      queueLength = sum(gauges["queueLength"] for gauges in workerGauges.values())
+      inFlight = sum(gauges["restInFlight"] for gauges in workerGauges.values())
+   else:
+      queueLength = publishQueue.qsize()
+      inFlight = restInFlight if "restInFlight" in globals() else 0
+   appendMetric(lines, "zabbix_connector_publish_queue_depth", "gauge", "Entries waiting on the publish queue", [ ("", queueLength) ])
+   appendMetric(lines, "zabbix_connector_publish_queue_capacity", "gauge", "Capacity of the publish queue", [ ("", publishQueueMaxSize) ])
+   if publishType.lower() == "rest":
+      appendMetric(lines, "zabbix_connector_rest_in_flight", "gauge", "REST batches being posted", [ ("", inFlight) ])
+      if connectorWorkers == 1:
+         appendMetric(lines, "zabbix_connector_rest_target_batch_size", "gauge", "Current REST batch size target in metrics", [ ("", restTargetBatchSize) ])
+         appendMetric(lines, "zabbix_connector_spool_bytes", "gauge", "Bytes of batches waiting in the spool", [ ("", spoolBytes) ])
+         appendMetric(lines, "zabbix_connector_rest_api_reachable", "gauge", "1 while the metric API is reachable", [ ("", int(restApiReachable)) ])
+   if connectorWorkers == 1:
+      appendMetric(lines, "zabbix_connector_consumer_paused", "gauge", "1 while kafka consumption is paused by backpressure", [ ("", int(consumerPaused)) ])
+   return "text/plain; version=0.0.4; charset=utf-8", ("\n".join(lines) + "\n").encode("utf-8")
+
+def dropsPage(query):
+
+   # the messages dropped by reason since the start, with the top hosts and items and the examples of the current interval
+
+   totals = statsTotals()
+   report = takeDropReport(reset=False)
+   drops = {}
+   for reason in dropReasons:
+      if totals[dropStatNames[reason]] > 0:
+         drops[reason] = {
+            "total": totals[dropStatNames[reason]],
+            "topHosts": topDropped(report["hosts"], reason),
+            "topItems": topDropped(report["items"], reason),
+            "examples": [ { "message": event_dict, "error": detail } for event_dict, detail in report["examples"].get(reason, []) ]
+         }
+   return "application/json", json.dumps(drops, default=str).encode("utf-8")
+
+def startAdminServer():
+
+   if metricsPort <= 0:
+      return
+   try:
+      server = http.server.ThreadingHTTPServer((metricsBindAddress, metricsPort), AdminRequestHandler)
+   except OSError as error:
+      logging.info("WARNING: unable to start the admin endpoint on " + metricsBindAddress + ":" + str(metricsPort) + ": " + str(error))
+      return
+   server.daemon_threads = True
+   adminThread = threading.Thread(target=server.serve_forever, name="adminServer")
+   adminThread.daemon = True
+   adminThread.start()
+   logging.info("Admin endpoint listening on " + metricsBindAddress + ":" + str(metricsPort) + ", serving " + ", ".join(sorted(adminRoutes)))
+
+def drainPublisher():
+
+   # flushes the aggregation and coalescing stages, and waits until everything on the publish queue has been
+   # handed to the sink and posted
+
+   global restDrainRequested
+   global kafkaDrainRequested
+
+   flushPipelineStages()
+   if publishType.lower() == "rest":
+      publishQueue.join()
+      restDrainRequested = True
+      while any(restBatches):
+         time.sleep(0.1)
+      for sendQueue in restSendQueues:
+         sendQueue.join()
+   elif publishThread is not None:
+      publishQueue.join()
+      kafkaDrainRequested = True
+      flushKafkaProducer(60)
+
+def recordedTimestamp(value):
+
+   ###########################################################################
+   #
+   # Returns the Zabbix clock of a recorded message in ms, which a backfill
+   # replay appends it with so that the window selects it by collection time,
+   # or None if the message can not be decoded
+   #
+   ###########################################################################
 
-   while shutdownRequest != True:
-      if first:
-         secToInterval = (( 4 - datetime.now().minute % int(watsonTopicAggInterval)) * 60 ) + (60 - datetime.now().second)
-         logging.info("Starting datachannel, " + str(secToInterval) + " seconds to next interval...")
-         time.sleep(secToInterval)
-      currTime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-      first=False
-      logging.info('==== INTERVAL STATISTICS FOR ' + currTime + '====')
-      ###############################################
-      #
-      # If indicator/resource logging is requested...
-      #
-      ###############################################
-      if(logUniqueIndicators.lower() == "true"):
-         logging.debug('Unique indicators seen during interval: ' + str(intervalMetricSet))
-      if(logUniqueResources.lower() == "true"):
-         logging.debug('Unique resources seen during interval: ' + str(intervalResourceSet))
-      logging.info('Longest kafka latency for interval is: ' + str(longestDelta / 1000) + ' seconds.')
-      logging.info('Number of unique metric/resources consumed (metric count): ' + str(intervalMetricCount) )
-      logging.info('Number of unique metric indicators: ' + str(len(intervalMetricSet)))
-      logging.info('Number of unique resources: ' + str(len(intervalResourceSet)))
-      logging.info('Datachannel producer queue length: ' + str(publishQueue.qsize()))
-      if(publishType.lower() == "rest"):
-         logging.info('Size of metricGroup now: ' + str(len(restMetricGroup["groups"] )))
-      intervalMetricSet.clear()
-      intervalResourceSet.clear()
-      intervalMetricCount = 0
-      longestDelta = 0
-      time.sleep(int(watsonTopicAggInterval) * 60)
+   try:
+      if sevOneKafkaDataFormat.lower() == "avro":
+         event_dict = fastAvroDecode(value)
+      else:
+         event_dict = json.loads(value)
+      return int(float(event_dict["clock"]) * 1000)
+   except Exception:
+      return None
 
-def logTimeDeltaCron(callback_func, first=True):
+def startFakeKafkaReplay():
 
-   #################################################################
+   ###########################################################################
    #
-   # Sets up a "cron" type job that logs perf stats every 60 seconds
+   # Feeds the fake broker's SevOne topic from the recording in
+   # fakeKafkaReplayFile (one message per line, e.g. the output of
+   # sdb-kafka-reader.py), at fakeKafkaReplayRate messages per second, or as
+   # fast as the pipeline reads it. A live datachannel is fed once it has
+   # been assigned the topic's partitions, and a backfill once the whole
+   # recording has been loaded
    #
-   #################################################################
-   
-   if first:
-      secToInterval = (( 4 - datetime.now().minute % int(watsonTopicAggInterval)) * 60 ) + (60 - datetime.now().second)
-      time.sleep(secToInterval)
-   callback_func()
-   time.sleep(int(watsonTopicAggInterval) * 60)
-   logTimeDeltaCron(callback_func, False)
+   ###########################################################################
+
+   if 'fakeKafkaReplayFile' not in datachannelProps:
+      logging.info("WARNING: kafkaClient is \"fake\", but no fakeKafkaReplayFile is set. The SevOne topic will stay empty")
+      return None
+   replayFile = datachannelProps['fakeKafkaReplayFile']
+   if not os.path.isabs(replayFile):
+      replayFile = mediatorHome + "/" + replayFile
+   if not os.path.exists(replayFile):
+      logging.info("FATAL: fakeKafkaReplayFile " + replayFile + " does not exist")
+      exit()
+   logging.info("Replaying " + replayFile + " into the fake kafka topic " + sevOneKafkaTopicName + " at " + (str(fakeKafkaReplayRate) + " messages/second" if fakeKafkaReplayRate > 0 else "the pipeline's pace") + ", " + (str(fakeKafkaReplayLoops) + " time(s)" if fakeKafkaReplayLoops > 0 else "until stopped"))
+   if not backfillMode:
+      return fakekafka.Replay(sevOneKafkaTopicName, fakekafka.readRecording(replayFile), fakeKafkaReplayRate, fakeKafkaReplayBacklog, fakeKafkaReplayLoops, waitForConsumers=True).start()
 
+   # a backfill plans from what is in the topic when it starts, so the recording is loaded whole, once,
+   # with each message timestamped by its recorded clock rather than by when it was loaded
 
-def fastAvroDecode(msg_value):
+   if fakeKafkaReplayLoops != 1:
+      logging.info("WARNING: a backfill replays the recording once, fakeKafkaReplayLoops is ignored")
+   replay = fakekafka.Replay(sevOneKafkaTopicName, fakekafka.readRecording(replayFile), 0, 0, 1, timestampOf=recordedTimestamp).start()
+   replay.join()
+   return replay
 
-   #############################################################################################
+##########################################################################
+#
+# Historical backfill. Started with --backfill START END, the connector
+# reads the Zabbix topic from START to END under its own consumer group
+# (backfillConsumerGroup) instead of following it live. Each partition is
+# positioned with offsets_for_times, and the partitions are spread over
+# backfillReaderThreads consumers which fetch in parallel and feed the
+# normal translate/aggregate/publish pipeline, one batch at a time, at up
+# to backfillMaxRate messages per second. Aggregation follows event time.
+# Once every partition has reached END the pipeline is flushed and the
+# process exits
+#
+##########################################################################
+
+def parseBackfillTime(value):
+
+   # accepts epoch seconds or a local "YYYY-MM-DD HH:MM[:SS]" time, and returns epoch milliseconds
+
+   if value.isdigit():
+      return int(value) * 1000
+   for timeFormat in [ "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d" ]:
+      try:
+         return int(datetime.strptime(value, timeFormat).timestamp() * 1000)
+      except ValueError:
+         pass
+   raise argparse.ArgumentTypeError("'" + value + "' is neither epoch seconds nor a 'YYYY-MM-DD HH:MM:SS' time")
+
+def planBackfill():
+
+   # returns { partition: (startOffset, endOffset) } for every partition holding messages between the start and end times
+
+   consumer = Consumer(sevOneKafkaSettings(backfillConsumerGroup, 'waiopsMetric-Backfill@' + socket.gethostname()))
+   topic = consumer.list_topics(sevOneKafkaTopicName, timeout=30).topics.get(sevOneKafkaTopicName)
+   if topic is None or topic.error is not None or not topic.partitions:
+      logging.info("FATAL: Unable to list the partitions of the SevOne kafka topic " + sevOneKafkaTopicName + " at " + sevOneKafkaServers + ". Verify Kafka configuration, reconfigure, and retry.")
+      exit()
+   partitions = sorted(topic.partitions)
+   starts = consumer.offsets_for_times([ TopicPartition(sevOneKafkaTopicName, partition, backfillStart) for partition in partitions ], timeout=30)
+   ends = consumer.offsets_for_times([ TopicPartition(sevOneKafkaTopicName, partition, backfillEnd) for partition in partitions ], timeout=30)
+   plan = {}
+   for start, end in zip(starts, ends):
+
+      # a negative offset means there is no message at or after the requested time
+
+      if start.offset < 0:
+         continue
+      endOffset = end.offset
+      if endOffset < 0:
+         low, endOffset = consumer.get_watermark_offsets(TopicPartition(sevOneKafkaTopicName, start.partition), timeout=30)
+      if endOffset > start.offset:
+         plan[start.partition] = (start.offset, endOffset)
+   consumer.close()
+   return plan
+
+def throttleBackfill(count):
+
+   global backfillNextTime
+
+   if backfillMaxRate <= 0:
+      return
+   with backfillThrottleLock:
+      now = time.time()
+      start = max(backfillNextTime, now)
+      backfillNextTime = start + count / backfillMaxRate
+   if start > now:
+      time.sleep(start - now)
+
+def backfillReader(readerId, partitions):
+
+   ###########################################################################
    #
-   # This function decodes the SevOne avro message, and returns a PI mapped/converted dictionary
+   # Reads the assigned partitions from their start offsets up to their end
+   # offsets. Fetching runs in parallel across readers, while processing is
+   # serialized on pipelineLock as the pipeline stages are not
+   # thread safe
    #
-   #############################################################################################
+   ###########################################################################
 
-   message_bytes = io.BytesIO(msg_value)
-   event_dict = fastavro.schemaless_reader(message_bytes, fastavro.parse_schema(schema))
-   return event_dict
+   global backfillMessages
 
+   consumer = Consumer(sevOneKafkaSettings(backfillConsumerGroup, 'waiopsMetric-Backfill-' + str(readerId) + '@' + socket.gethostname()))
+   consumer.assign([ TopicPartition(sevOneKafkaTopicName, partition, backfillPlan[partition][0]) for partition in partitions ])
+   remaining = set(partitions)
+   try:
+      while remaining and shutdownRequest != True:
+         msgs = consumer.consume(kafkaConsumeBatchSize, kafkaConsumeMaxWait)
+         inWindow = []
+         for msg in msgs:
+            if msg.error():
+               continue
+            partition = msg.partition()
+            if partition not in remaining:
+               continue
+            endOffset = backfillPlan[partition][1]
+            if msg.offset() < endOffset:
+               inWindow.append(msg)
+            if msg.offset() + 1 >= endOffset:
+               remaining.discard(partition)
+               consumer.pause([ TopicPartition(sevOneKafkaTopicName, partition) ])
+               logging.info("Backfill of partition " + str(partition) + " complete")
+         if not inWindow:
+            continue
+         throttleBackfill(len(inWindow))
+         with pipelineLock:
+            countStat("consumeBatches")
+            countStat("consumedMessages", len(inWindow))
+            processMessageBatch(inWindow)
+            pipelineTick(time.time())
+            backfillMessages += len(inWindow)
+   finally:
+      consumer.close()
+
+def backfillReaders():
+
+   # starts a reader per group of partitions and waits for all of them to reach the end time
+
+   partitions = sorted(backfillPlan)
+   readerCount = min(backfillReaderThreads, len(partitions))
+   readers = []
+   for readerId in range(readerCount):
+      reader = threading.Thread(target=backfillReader, args=(readerId + 1, partitions[readerId::readerCount]), name="backfillReader-" + str(readerId + 1))
+      reader.daemon = True
+      reader.start()
+      readers.append(reader)
+   for reader in readers:
+      reader.join()
+
+def runBackfill():
+
+   ###########################################################################
+   #
+   # Entry point of a backfill run. Returns once the backfill is complete
+   #
+   ###########################################################################
 
-def translateToWatsonMetric(event_dict):
+   global backfillPlan
+   global aggregationEventTime
+   global perfStatThread
 
-   ################################################################################################
+   startText = datetime.fromtimestamp(backfillStart / 1000).strftime("%Y-%m-%d %H:%M:%S")
+   endText = datetime.fromtimestamp(backfillEnd / 1000).strftime("%Y-%m-%d %H:%M:%S")
+   logging.info("Backfilling topic " + sevOneKafkaTopicName + " from " + startText + " to " + endText + " with consumer group " + backfillConsumerGroup + ", " + str(backfillReaderThreads) + " reader thread(s), max rate: " + str(backfillMaxRate) + " messages/second")
+
+   backfillPlan = planBackfill()
+   if not backfillPlan:
+      logging.info("No messages found in topic " + sevOneKafkaTopicName + " between " + startText + " and " + endText + ", nothing to backfill")
+      return
+   logging.info("Backfilling " + str(sum(end - start for start, end in backfillPlan.values())) + " messages from " + str(len(backfillPlan)) + " partition(s)")
+
+   # buckets are closed by the newest event time read rather than the wall clock
+
+   aggregationEventTime = True
+   started = time.time()
+   startPublisher(1)
+   startPipelineThreads(1, backfillReaders)
+
+   perfStatThread = threading.Thread(target=logTimeDelta, args=(True,), name="logTimeDelta")
+   perfStatThread.daemon = True
+   perfStatThread.start()
+
+   while sdbReaderThread.is_alive():
+      time.sleep(0.1)
+
+   logging.info("Backfill readers finished, flushing the pipeline")
+   drainPublisher()
+   elapsed = time.time() - started
+   logging.info("Backfill complete: " + str(backfillMessages) + " messages in " + str(round(elapsed, 1)) + " seconds (" + str(round(backfillMessages / max(elapsed, 0.001), 1)) + " messages/second)")
+   if publishType.lower() == "rest" and spoolBytes > 0:
+      logging.info("WARNING: " + str(spoolBytes) + " bytes of batches that could not be posted remain in " + spoolDir + ". They will be replayed by the next backfill run")
+
+##########################################################################
+#
+# Multi-process worker mode. The supervisor forks connectorWorkers worker
+# processes, each of which joins the consumer group and runs its own
+# decode/translate/publish pipeline. Workers periodically send their
+# statistics to the supervisor, which merges them into the interval report
+#
+##########################################################################
+
+def takeStatsSnapshot():
+
+   ################################################################
    #
-   # This is the translation function to translate the SevOne json format to the Watson json format
+   # Returns this process' statistics since the last snapshot, and
+   # resets them
    #
-   ################################################################################################
+   ################################################################
 
-   # Build WAIOps json
-   if("name" not in event_dict):
-      logging.info("WARNING: payload is missing indicatorName field. Will not process metric. JSON: " + json.dumps(event_dict) )
-      return("NULL")
-   elif(event_dict["name"] in ignoreMetrics):
-      return("NULL")
+   global intervalMetricCount
+   global longestDelta
+
+   snapshot = {}
+   snapshot["metricCount"] = intervalMetricCount
+   snapshot["longestDelta"] = longestDelta
+   snapshot["maxStats"] = collections.Counter(intervalMaxStats)
+   snapshot["metricSet"] = set(intervalMetricSet)
+   snapshot["resourceSet"] = set(intervalResourceSet)
+   snapshot["stats"] = statsSince(workerStatsBaseline)
+   snapshot["drops"] = takeDropReport()
+   snapshot["queueLength"] = publishQueue.qsize()
+   if(publishType.lower() == "rest" and "restBatches" in globals()):
+      snapshot["metricGroupSize"] = sum(len(batch) for batch in restBatches)
+      snapshot["restInFlight"] = restInFlight
    else:
-      try:
-         waiopsMetric = dict()
-         waiopsMetric["attributes"] = dict()
-         waiopsMetric["metrics"] = dict()
-         if("host" in event_dict["host"]):
-            waiopsMetric["attributes"]["node"] = event_dict["host"]["host"]
-         else:
-            logging.info("WARNING: payload is missing host field. Will not process metric. JSON: " + json.dumps(event_dict) )
-         if("item_tags" in event_dict):
-            foundComponentTag = 0
-            foundMetricTag = 0
-            component = ""
-            metricname = ""
-            for tag in event_dict["item_tags"]:
-               logging.debug("evaluating tag: " + tag["tag"])
-               if tag["tag"] == "KafkaSubcomponent":
-                  component = tag["value"]
-                  foundComponentTag = 1
-               if tag["tag"] == "KafkaMetric":
-                  metricname = tag["value"]
-                  foundMetricTag = 1
-            if(foundComponentTag !=1 or foundMetricTag != 1):
-               logging.info("Missing either the metric tag or component found for the following metric JSON entry. Will not process metric: " + json.dumps(event_dict))
-               return("NULL")
-         else:
-            logging.info("No 'item_tags' found in the payload. Will not process this metric. JSON: " + json.dumps(event_dict))
-         if("value" in event_dict):
-            waiopsMetric["metrics"][metricname] = float(event_dict["value"])
-         else:
-            logging.info("WARNING: payload is missing 'name' field. Will not process metric. JSON: " + json.dumps(event_dict) )
-            return("NULL")
-         waiopsMetric["attributes"]["component"] = component
-         waiopsMetric["attributes"]["group"] = watsonMetricGroup
-         if(event_dict["name"] in counterMetrics):
-            waiopsMetric["attributes"]["accumulators"] = event_dict["name"]
-         if("clock" in event_dict):
-            ts = str(int(event_dict["clock"] * 1000))
-            waiopsMetric["timestamp"] = ts
-         else:
-            logging.info("WARNING: payload is missing 'clock' field. Will not process metric. JSON: " + json.dumps(event_dict) )
-         waiopsMetric["tenantID"] = watsonTopicName
-         waiopsMetric["resourceID"] = event_dict["host"]["host"] + ":" + component
-         waiopsGroup = {}
-         waiopsGroup["groups"] = []
-         waiopsGroup["groups"].append(waiopsMetric)
-         #logging.debug("posting metric: " + json.dumps(waiopsGroup, indent=4))
-         return(waiopsGroup)
-      except Exception as error:
-         logging.info("An exception occurred: " + error)
-         logging.info("Unable to process message: " + json.dumps(event_dict))
-         return("NULL")
+      snapshot["metricGroupSize"] = 0
+      snapshot["restInFlight"] = 0
+   intervalMetricSet.clear()
+   intervalResourceSet.clear()
+   intervalMaxStats.clear()
+   intervalMetricCount = 0
+   longestDelta = 0
+   return snapshot
 
-def writeRawJson(rawJson):
+def mergeStatsSnapshot(workerId, snapshot):
+
+   global intervalMetricCount
+   global longestDelta
 
-   jsonLogFileLocation.write(json.dumps(rawJson, indent=4) + "\n") 
+   intervalMetricCount += snapshot["metricCount"]
+   if(snapshot["longestDelta"] > longestDelta):
+      longestDelta = snapshot["longestDelta"]
+   for name, value in snapshot["maxStats"].items():
+      maxStat(name, value)
+   intervalMetricSet.update(snapshot["metricSet"])
+   intervalResourceSet.update(snapshot["resourceSet"])
+   for name, value in snapshot["stats"].items():
+      countStat(name, value)
+   mergeDropReport(snapshot["drops"])
+   countStat("worker" + str(workerId) + "MetricCount", snapshot["metricCount"])
+   workerGauges[workerId] = { "queueLength": snapshot["queueLength"], "metricGroupSize": snapshot["metricGroupSize"], "restInFlight": snapshot["restInFlight"] }
+
+def workerStatsReporter(workerId, statsQueue):
 
-def publishMetric():
+   while shutdownRequest != True:
+      time.sleep(workerStatsFrequency)
+      statsQueue.put((workerId, takeStatsSnapshot()))
+
+def workerStatsCollector(statsQueue):
 
-   ###########################
+   while shutdownRequest != True:
+      workerId, snapshot = statsQueue.get()
+      mergeStatsSnapshot(workerId, snapshot)
+
+def resetInheritedState():
+
+   ###########################################################################
    #
-   # Publisher thread function
+   # A worker restarted by the supervisor is forked while the supervisor's
+   # statistics collector and interval report threads run. It drops the
+   # statistics it inherited from them, which the supervisor has already
+   # counted, and replaces the locks those threads may have held at the fork.
    #
-   ###########################
-
-   global shutdownRequest
+   # Any module-level lock or statistics accumulator added to the connector
+   # must be reset here as well
+   #
+   ###########################################################################
+
+   global statsLocal
+   global statsRegistry
+   global statsRegistryLock
+   global dropLock
+   global profilerLock
+   global pipelineLock
+   global intervalMetricCount
+   global longestDelta
 
-   # block until a message hits the publish queue
+   statsLocal = threading.local()
+   statsRegistry = []
+   statsRegistryLock = threading.Lock()
+   intervalStatsBaseline.clear()
+   workerStatsBaseline.clear()
+   intervalMaxStats.clear()
+   intervalMetricSet.clear()
+   intervalResourceSet.clear()
+   intervalMetricCount = 0
+   longestDelta = 0
+   dropLock = threading.Lock()
+   dropHosts.clear()
+   dropItems.clear()
+   dropExamples.clear()
+   profilerLock = threading.Lock()
+   pipelineLock = threading.Lock()
+   workerGauges.clear()
+   workerProcesses.clear()
+
+def connectorWorker(workerId, statsQueue):
+
+   ##################################################
+   #
+   # Entry point of a forked connector worker process
+   #
+   ##################################################
 
-   while shutdownRequest != True:
-      item = publishQueue.get()
-      produceMetric(json.dumps(item))
-#      if(logRawJson):
-#         writeRawJson(json.dumps(item))
-      publishQueue.task_done()
+   global c
+   global profilerWorkerId
 
-def restQueueReader():
+   resetInheritedState()
+   for handler in logging.getLogger().handlers:
+      handler.setFormatter(logging.Formatter("%(asctime)-15s %(levelname)-8s worker-" + str(workerId) + " %(message)s"))
+   logging.info("Connector worker " + str(workerId) + " started with pid " + str(os.getpid()))
 
-   global shutdownRequest
-   restBatchSize = 10000
-   publishFrequency = 60
+   signal.signal(signal.SIGINT, shutdownHandler)
+   signal.signal(signal.SIGTERM, shutdownHandler)
+   signal.signal(signal.SIGUSR2, toggleProfilerHandler)
 
-   global restMetricGroup 
+   # a worker restarted while the profiler is on starts profiling too
 
-   restMetricGroup = {}
-   restMetricGroup["groups"] = []
+   profilerWorkerId = workerId
+   if profilerRequest.value == 1:
+      startProfiler()
 
-   # block until a message hits the publish queue
+   startPublisher(workerId)
+   c = connectSevOneKafka(workerId)
+   startPipelineThreads(workerId)
 
-   print("Starting queue reader for REST publishing")
-   lastPublishTime = int(time.time())
-   while shutdownRequest != True:
-      item = publishQueue.get()
-      #print("got an item: " + json.dumps(item, indent=4))
-      for metric in item["groups"]:
-         #print("metric: " + str(metric))
-         restMetricGroup["groups"].append(metric)
-      if(len(restMetricGroup["groups"]) == restBatchSize):
-         logging.debug("publishing batch of 10000")
-         postMetric(json.dumps(restMetricGroup))
-         restMetricGroup.clear()
-         restMetricGroup["groups"] = []
-         lastPublishTime = int(time.time())
-      elif( int(time.time()) - lastPublishTime > publishFrequency  and len(restMetricGroup["groups"]) > 0 ):
-         logging.debug("publishing " + str(len(restMetricGroup["groups"])) + " metrics on publishFrequency of " + str(publishFrequency))
-         postMetric(json.dumps(restMetricGroup))
-         restMetricGroup.clear()
-         restMetricGroup["groups"] = []
-         lastPublishTime = int(time.time())
-      publishQueue.task_done()
+   statsThread = threading.Thread(target=workerStatsReporter, args=(workerId, statsQueue), name="workerStatsReporter")
+   statsThread.daemon = True
+   statsThread.start()
 
+   try:
+      while sdbReaderThread.is_alive():
+         time.sleep(0.1)
+      logging.info("Connector worker " + str(workerId) + " reader stopped, exiting")
+   finally:
+      shutdownPipeline()
 
-def sdbReader():
+def runSupervisor():
 
-   ########################################
+   ###############################################################
    #
-   # SevOne Data Bus reader thread function
+   # Starts the worker processes, merges their statistics, and
+   # restarts any worker that exits unexpectedly
    #
-   ########################################
+   ###############################################################
 
-    global intervalMetricCount
-    global longestDelta
+   global perfStatThread
+   global profilerRequest
 
-    shutdownRequest = False
-    lastMessage = "NULL"
-    try:
-        while shutdownRequest != True:
-            msg = c.poll(0.1)
-            if msg is None:
-                continue
-            elif not msg.error():
-               if sevOneKafkaDataFormat.lower() == "avro":
-                  metricJson = translateToWatsonMetric(fastAvroDecode(msg.value()))
-               else:
-                  metricJson = translateToWatsonMetric(json.loads(msg.value()))
-               lastMessage = metricJson
-               if(metricJson == "NULL"):
-                  pass
-               else:
-                  print(json.dumps(metricJson))
-                  if 'timestamp' in metricJson["groups"][0]:
-                     publishQueue.put(metricJson)
-                     intervalMetricCount += 1
-                     currTime = int(time.time() * 1000)
-                     deltaTime = currTime - int(metricJson["groups"][0]["timestamp"])
-                     if(deltaTime > longestDelta):
-                        longestDelta = deltaTime
-                     for key in metricJson["groups"][0]["metrics"]:
-                        intervalMetricSet.add(key)
-                     if 'resourceID' in metricJson["groups"][0]:
-                        intervalResourceSet.add(metricJson["groups"][0]["resourceID"])
-                  else:
-                     logging.info("WARNING: Message received contains no timestamp field. Message is: " + json.dumps(metricJson))
-                
-            elif msg.error().code() == KafkaError._PARTITION_EOF:
-                logging.info('Kafka error: end of partition reached')
-                #logging.info('Kafka error: end of partition reached {0}/{1}'
-                #      .format(msg.topic(), msg.partition()))
-            else:
-                #logging.info('Kafka error occured: {0}'.format(msg.error().str()))
-                logging.info('Kafka error occured')
-    
-    except Exception as error:
-       logging.info("An exception occurred: " + error)
-       shutdownRequest = True
-       now = datetime.now()
-       ts = now.strftime("%d/%m/%Y %H-%M-%S")
-       logging.info('Mediator shut down at: ' + ts)
-       if(lastMessage):
-          logging.info('Last message: ' + json.dumps(lastMessage))
-       if(publishThread.is_alive()):
-          
-          logging.debug("publishThread is still alive")
-       if(perfStatThread.is_alive()):
-          logging.debug("perfStatThread is still alive")
-       c.close()
-       sys.stdout.close()
+   logging.info("Starting " + str(connectorWorkers) + " connector worker processes. Note that workers beyond the partition count of the '" + sevOneKafkaTopicName + "' topic will be idle")
+
+   mpContext = multiprocessing.get_context("fork")
+   statsQueue = mpContext.Queue()
+   profilerRequest = mpContext.Value("b", 0)
+   workers = workerProcesses
+   workerStartTimes = {}
+
+   def startWorker(workerId):
+      worker = mpContext.Process(target=connectorWorker, args=(workerId, statsQueue), name="connectorWorker-" + str(workerId))
+      worker.daemon = True
+      worker.start()
+      workers[workerId] = worker
+      workerStartTimes[workerId] = time.time()
+
+   for workerId in range(1, connectorWorkers + 1):
+      startWorker(workerId)
+
+   collectorThread = threading.Thread(target=workerStatsCollector, args=(statsQueue,), name="workerStatsCollector")
+   collectorThread.daemon = True
+   collectorThread.start()
+
+   perfStatThread = threading.Thread(target=logTimeDelta, args=(True,), name="logTimeDelta")
+   perfStatThread.daemon = True
+   perfStatThread.start()
+   startAdminServer()
+
+   try:
+      while shutdownRequest != True:
+         time.sleep(1)
+         for workerId, worker in list(workers.items()):
+            if not worker.is_alive():
+               if(time.time() - workerStartTimes[workerId] < workerRestartMinUptime):
+                  logging.info("FATAL: connector worker " + str(workerId) + " exited with code " + str(worker.exitcode) + " within " + str(workerRestartMinUptime) + " seconds of starting. Check the worker log entries above for the cause.")
+                  return
+               logging.info("WARNING: connector worker " + str(workerId) + " (pid " + str(worker.pid) + ") exited with code " + str(worker.exitcode) + ", restarting it")
+               startWorker(workerId)
+   finally:
+      for worker in workers.values():
+         if worker.is_alive():
+            worker.terminate()
+      for worker in workers.values():
+         worker.join(10)
 
 def setupFilePaths():
    
@@ -541,14 +3417,20 @@ def setupLogging():
    
       # Redirect stdout to log/datachannel.out
 
-      print(("Redirecting stdout to " + logHome + "datachannel.out"))
-      print(("Redirecting stderr to " + logHome + "datachannel.err"))
-      sys.stdout = open(logHome + "datachannel.out", "w")
-      sys.stderr = open(logHome + "datachannel.err", "w")
-      LOG_FILENAME=logHome + "sevone-datachannel.log"
+      # a backfill run logs to its own files, so it can run alongside the live datachannel
+
+      if backfillMode:
+         logSuffix = "-backfill"
+      else:
+         logSuffix = ""
+      print(("Redirecting stdout to " + logHome + "datachannel" + logSuffix + ".out"))
+      print(("Redirecting stderr to " + logHome + "datachannel" + logSuffix + ".err"))
+      sys.stdout = open(logHome + "datachannel" + logSuffix + ".out", "w")
+      sys.stderr = open(logHome + "datachannel" + logSuffix + ".err", "w")
+      LOG_FILENAME=logHome + "sevone-datachannel" + logSuffix + ".log"
       now = datetime.now()
       ts = now.strftime("%d/%m/%Y %H:%M:%S")
-      print(("opening log file " + logHome + "/sevone-datachannel.log"))
+      print(("opening log file " + LOG_FILENAME))
       try:
          if loggingLevel.upper() == "INFO" or loggingLevel.upper() == "DEBUG":
             if loggingLevel.upper() == "INFO":
@@ -576,8 +3458,16 @@ def configProperties():
    
    global ignoreMetrics
    global counterMetrics
+   global aggregationFunctions
    global sevOneKafkaServers
+   global sevOneKafkaSSL
    global watsonKafkaServers
+   global watsonKafkaSSL
+   global watsonKafkaCompression
+   global watsonKafkaLingerMs
+   global watsonKafkaBatchBytes
+   global watsonKafkaRecordBytes
+   global watsonKafkaRecordMaxAge
    global watsonTopicAggInterval
    global watsonKafkaTopicName
    global sevOneKafkaTopicName
@@ -589,11 +3479,33 @@ def configProperties():
    global restMediationServiceAuthentication
    global authHeader
    global targetUrl
+   global kafkaConsumeBatchSize
+   global kafkaConsumeMaxWait
+   global connectorWorkers
+   global workerStatsFrequency
+   global workerRestartMinUptime
+   global restConnectionsPerHost
+   global restRequestTimeout
+   global restCompression
+   global restCompressionLevel
+   global restCompressionMinBytes
+   global restSenderThreads
+   global restPreserveOrder
+   global restBatchMaxAge
+   global restBatchSize
+   global restBatchMaxBytes
+   global restAdaptiveBatchSize
+   global restMinBatchSize
+   global restAdaptiveWindow
+   global restIntervalFlush
+   global restIntervalFlushDelay
    
    ignoreMetrics = set()
    loadMetricsIgnore(mediatorHome + "/conf/metrics-ignore.conf")
    counterMetrics = set()
    loadCounters(mediatorHome + "/conf/counter-metrics.conf")
+   aggregationFunctions = {}
+   loadAggregationFunctions(mediatorHome + "/conf/metric-aggregation.conf")
    
    if(os.path.exists(mediatorHome + "/conf/sevone-watson-datachannel.props")):
       props = loadProperties(mediatorHome + "/conf/sevone-watson-datachannel.props")
@@ -659,7 +3571,7 @@ def configProperties():
          logging.info("INFO: publishType not set but watsonProductTarget is \'aiops\', defaulting to \'rest\'")
          publishType = "rest"
 
-   if( publishType.lower == "kafka" ):
+   if( publishType.lower() == "kafka" ):
 
       if watsonProductTarget.lower() == "aiops":
          logging.info("FATAL: publishType is set to \'kafka'\, but watsonProductTarget is \'aiops\'. This is an unsupported configuration. For watsonProductTarget of \'aiops\' you must use \'rest\'")
@@ -704,7 +3616,7 @@ def configProperties():
       # configure SSL for Watson Kafka, if required
    
       if watsonKafkaSSL == "true":
-         if(os.path.exists(mediatorHome + "/conf/sevone-kafka-ssl.props")):
+         if(os.path.exists(mediatorHome + "/conf/watson-kafka-ssl.props")):
             watsonKafkaSSLProps = loadProperties(mediatorHome + "/conf/watson-kafka-ssl.props")
             logging.debug("SevOne Kafka SSL Properties: = " + json.dumps(watsonKafkaSSLProps))
             globals().update(watsonKafkaSSLProps)
@@ -730,6 +3642,18 @@ def configProperties():
       else:
          logging.info("Watson Data Bus Kafka SSL not requested")
 
+      # Configure the Watson kafka producer: record compression, batching, and how many metrics are packed into each record
+
+      watsonKafkaCompression = datachannelProps.get('watsonKafkaCompression', "lz4").lower()
+      if watsonKafkaCompression not in [ "none", "gzip", "snappy", "lz4", "zstd" ]:
+         logging.info("WARNING: Unknown watsonKafkaCompression property set. Should be \"none\", \"gzip\", \"snappy\", \"lz4\" or \"zstd\". Defaulting to \"lz4\"")
+         watsonKafkaCompression = "lz4"
+      watsonKafkaLingerMs = numericProperty('watsonKafkaLingerMs', 50)
+      watsonKafkaBatchBytes = numericProperty('watsonKafkaBatchBytes', 1000000)
+      watsonKafkaRecordBytes = numericProperty('watsonKafkaRecordBytes', 900000)
+      watsonKafkaRecordMaxAge = numericProperty('watsonKafkaRecordMaxAge', 1, float)
+      logging.debug("watsonKafkaCompression = " + watsonKafkaCompression + ", linger " + str(watsonKafkaLingerMs) + " ms, batch " + str(watsonKafkaBatchBytes) + " bytes, record " + str(watsonKafkaRecordBytes) + " bytes")
+
    elif( publishType == "rest" ):
 
       if 'restMediationServiceAuthentication' in datachannelProps:
@@ -764,6 +3688,83 @@ def configProperties():
       watsonTopicAggInterval = datachannelProps['watsonTopicAggInterval']
       logging.debug("watsonTopicAggInterval = " + watsonTopicAggInterval)
    
+   # Configure batched consumption from the SevOne Data Bus Kafka topic
+
+   kafkaConsumeBatchSize = numericProperty('kafkaConsumeBatchSize', 500)
+   if kafkaConsumeBatchSize < 1:
+      logging.info("WARNING: kafkaConsumeBatchSize must be at least 1. Defaulting to 500")
+      kafkaConsumeBatchSize = 500
+   kafkaConsumeMaxWait = numericProperty('kafkaConsumeMaxWait', 0.5, float)
+   logging.debug("kafkaConsumeBatchSize = " + str(kafkaConsumeBatchSize) + ", kafkaConsumeMaxWait = " + str(kafkaConsumeMaxWait))
+
+   # Configure the REST connection pool
+
+   restConnectionsPerHost = numericProperty('restConnectionsPerHost', 4)
+   if restConnectionsPerHost < 1:
+      restConnectionsPerHost = 1
+   restRequestTimeout = numericProperty('restRequestTimeout', 60, float)
+
+   # Configure the REST sender pool
+
+   restSenderThreads = numericProperty('restSenderThreads', 4)
+   if restSenderThreads < 1:
+      restSenderThreads = 1
+   if 'restPreserveOrder' in datachannelProps:
+      restPreserveOrder = datachannelProps['restPreserveOrder'].lower() != "false"
+   else:
+      restPreserveOrder = True
+
+   # Configure REST batch sizing. Batches are limited by metric count and by estimated JSON size, and the count can
+   # adapt toward the size that gives the best posting throughput
+
+   restBatchSize = numericProperty('restBatchSize', 10000)
+   restBatchMaxBytes = numericProperty('restBatchMaxBytes', 4194304)
+   if 'restAdaptiveBatchSize' in datachannelProps:
+      restAdaptiveBatchSize = datachannelProps['restAdaptiveBatchSize'].lower() == "true"
+   else:
+      restAdaptiveBatchSize = False
+   restMinBatchSize = min(numericProperty('restMinBatchSize', 500), restBatchSize)
+   restAdaptiveWindow = numericProperty('restAdaptiveWindow', 10)
+
+   # Configure REST batch flushing
+
+   restBatchMaxAge = numericProperty('restBatchMaxAge', 60, float)
+   if 'restIntervalFlush' in datachannelProps:
+      restIntervalFlush = datachannelProps['restIntervalFlush'].lower() == "true"
+   else:
+      restIntervalFlush = True
+   restIntervalFlushDelay = numericProperty('restIntervalFlushDelay', 5, float)
+
+   # Configure REST request body compression
+
+   if 'restCompression' in datachannelProps:
+      restCompression = datachannelProps['restCompression'].lower()
+      if restCompression not in [ "none", "gzip", "deflate" ]:
+         logging.info("WARNING: Unknown 'restCompression' property set. Should be \"none\", \"gzip\" or \"deflate\". Defaulting to \"none\"")
+         restCompression = "none"
+   else:
+      restCompression = "none"
+   restCompressionLevel = numericProperty('restCompressionLevel', 6)
+   if restCompressionLevel < 1 or restCompressionLevel > 9:
+      logging.info("WARNING: restCompressionLevel must be between 1 and 9. Defaulting to 6")
+      restCompressionLevel = 6
+   restCompressionMinBytes = numericProperty('restCompressionMinBytes', 1024)
+   logging.debug("restCompression = " + restCompression + ", level " + str(restCompressionLevel) + ", minimum bytes " + str(restCompressionMinBytes))
+
+   # Configure the number of connector worker processes. More than one worker starts a supervisor that forks
+   # the workers, each with its own consumer in the consumer group and its own publishing pipeline
+
+   connectorWorkers = numericProperty('connectorWorkers', 1)
+   if connectorWorkers < 1:
+      logging.info("WARNING: connectorWorkers must be at least 1. Defaulting to 1")
+      connectorWorkers = 1
+   workerStatsFrequency = numericProperty('workerStatsFrequency', 10)
+   workerRestartMinUptime = numericProperty('workerRestartMinUptime', 30)
+   if backfillMode and connectorWorkers > 1:
+      logging.info("Backfill runs in a single process with backfillReaderThreads readers, ignoring connectorWorkers")
+      connectorWorkers = 1
+   logging.debug("connectorWorkers = " + str(connectorWorkers))
+
    # Verify the SevOne Data Bus Kafka topic name
 
    if 'sevOneKafkaTopicName' not in datachannelProps:
@@ -911,6 +3912,17 @@ def configProperties():
 #
 #############
 
+# Command line arguments. With --backfill the connector replays the topic between two times and exits, instead of following it live
+
+argParser = argparse.ArgumentParser(description="Zabbix to Watson AIOps metric connector")
+argParser.add_argument("--backfill", nargs=2, type=parseBackfillTime, metavar=("START", "END"), help="replay the topic from START to END (epoch seconds or 'YYYY-MM-DD HH:MM:SS' local time) and exit")
+args = argParser.parse_args()
+backfillMode = args.backfill is not None
+if backfillMode:
+   backfillStart, backfillEnd = args.backfill
+   if backfillEnd <= backfillStart:
+      argParser.error("the backfill END time must be later than its START time")
+
 setupFilePaths()
 configProperties()
 
@@ -931,6 +3943,39 @@ intervalResourceSet = set()
 longestDelta = 0
 intervalNumber = 0
 intervalMetricCount = 0
+statsLocal = threading.local()
+statsRegistry = []
+statsRegistryLock = threading.Lock()
+intervalStatsBaseline = collections.Counter()
+workerStatsBaseline = collections.Counter()
+intervalMaxStats = collections.Counter()
+
+# ingestion delay histogram buckets, from 0.1 seconds doubling up to about 3.6 hours, and beyond
+
+ingestDelayBounds = [ round(0.1 * 2 ** bucket, 1) for bucket in range(18) ]
+ingestDelayStatNames = [ "ingestDelayBucket" + str(bucket) for bucket in range(len(ingestDelayBounds) + 1) ]
+ingestDelaySumName = "ingestDelayMs"
+
+# pipeline stage timing histogram buckets IN MILLISECONDS, from 10 microseconds doubling up to about 10 seconds, and beyond
+
+stageNames = [ "decode", "translate", "serialize", "queueWait", "sendQueueWait", "post", "kafkaDelivery" ]
+stageTimingBounds = [ 0.01 * 2 ** bucket for bucket in range(21) ]
+stageTimingStatNames = { stage: [ "stageTime_" + stage + "_" + str(bucket) for bucket in range(len(stageTimingBounds) + 1) ] for stage in stageNames }
+stageTimingSumNames = { stage: "stageTimeMs_" + stage for stage in stageNames }
+stageTimingCountNames = { stage: "stageTimeSamples_" + stage for stage in stageNames }
+stageTimingBatches = 0
+
+# drop reasons of recordDrop, tallied by host and item for the interval report
+
+dropReasons = [ "decodeError", "ignored", "noName", "noHost", "noItemTags", "noMetricTag", "noComponentTag", "noValue", "nonNumericValue", "noClock", "translationError" ]
+dropStatNames = { reason: "dropped_" + reason for reason in dropReasons }
+dropOtherKey = "(other)"
+dropLock = threading.Lock()
+dropHosts = collections.Counter()
+dropItems = collections.Counter()
+dropExamples = {}
+stageTimingItems = 0
+workerGauges = {}
 
 
 if 'sevOneKafkaDataFormat' in datachannelProps:
@@ -941,12 +3986,6 @@ if 'sevOneKafkaDataFormat' in datachannelProps:
       except ImportError:
          print("FATAL: Unable to load required Python package 'fastavro'. It can be installed using pip as such:\n\tpip install fastavro\n")
          exit()
-      try:
-         #import avro.io
-         import avro.schema
-      except ImportError:
-         print("FATAL: Unable to load required Python package 'avro'. It can be installed using pip as such:\n\tpip install avro\n")
-         exit()
    elif sevOneKafkaDataFormat.lower() != "json":
       logging.info("Unknown sevOneKafkaDataFormat value. Should be set to \"Avro\" or \"JSON\". Defaulting to \"Avro\".")
 else:
@@ -968,13 +4007,197 @@ else:
    if datachannelProps['logUniqueResources'] != "false" or datachannelProps['logUniqueResources'] != "true":
       logUniqueResources = "false"
 
-if 'logRawJson' not in datachannelProps:
-   if datachannelProps['logRawJson'] != "false" or datachannelProps['logRawJson'] != "true":
-      logRawJson = "false"
+if 'logRawJson' not in datachannelProps or datachannelProps['logRawJson'].lower() not in [ "true", "false" ]:
+   logRawJson = "false"
+
+# Configure the raw metric tap. logRawJson = "true" without any sampling properties taps every metric
+
+rawTapSampleRate = numericProperty('rawTapSampleRate', 0)
+rawTapMaxPerSecond = numericProperty('rawTapMaxPerSecond', 0)
+rawTapMaxFileSize = numericProperty('rawTapMaxFileSize', 100) * 1024 * 1024
+if(logRawJson.lower() == "true" and rawTapSampleRate < 1):
+   rawTapSampleRate = 1
+rawTapEnabled = rawTapSampleRate > 0 or rawTapMaxPerSecond > 0
+if 'rawTapHostFilter' in datachannelProps and datachannelProps['rawTapHostFilter'] != "":
+   rawTapHostRegex = re.compile(datachannelProps['rawTapHostFilter'])
+else:
+   rawTapHostRegex = None
+if 'rawTapMetricFilter' in datachannelProps and datachannelProps['rawTapMetricFilter'] != "":
+   rawTapMetricRegex = re.compile(datachannelProps['rawTapMetricFilter'])
+else:
+   rawTapMetricRegex = None
+rawTapQueue = queue.Queue(maxsize=10000)
+rawTapSeen = 0
+rawTapWindowStart = 0
+rawTapWindowCount = 0
+
+# Configure the admin endpoint serving the statistics to Prometheus. A backfill does not start it
+
+stageTimingSampleRate = numericProperty('stageTimingSampleRate', 10)
+metricsPort = numericProperty('metricsPort', 0)
+if 'metricsBindAddress' in datachannelProps:
+   metricsBindAddress = datachannelProps['metricsBindAddress']
+else:
+   metricsBindAddress = "0.0.0.0"
+dropReportTop = numericProperty('dropReportTop', 5)
+dropReportExamples = numericProperty('dropReportExamples', 3)
+dropExampleMaxLength = numericProperty('dropExampleMaxLength', 2000)
+dropTrackedKeys = numericProperty('dropTrackedKeys', 10000)
+adminRoutes = { "/metrics": metricsPage, "/profile": profilePage, "/drops": dropsPage }
+
+profilerSampleRate = numericProperty('profilerSampleRate', 100, float)
+if profilerSampleRate <= 0:
+   logging.info("WARNING: profilerSampleRate must be above 0, defaulting to 100")
+   profilerSampleRate = 100
+profilerMaxDuration = numericProperty('profilerMaxDuration', 600)
+profilerWriteInterval = numericProperty('profilerWriteInterval', 10)
+if 'profilerThreads' in datachannelProps:
+   profilerThreads = tuple(name.strip() for name in datachannelProps['profilerThreads'].split(",") if name.strip())
+else:
+   profilerThreads = ()
+profilerLock = threading.Lock()
+profilerThread = None
+profilerStopEvent = None
+profilerCounts = None
+profilerFile = None
+profilerSamples = 0
+profilerWorkerId = 0
+profilerModuleNames = {}
+profilerRequest = None
+workerProcesses = {}
+
+# Select the kafka client. kafkaClient = "fake" replaces confluent_kafka with the in-memory broker in
+# python/fakekafka.py, fed from a recording, so that the datachannel can be benchmarked and profiled without a
+# kafka cluster
+
+if 'kafkaClient' in datachannelProps and datachannelProps['kafkaClient'].lower() == "fake":
+   kafkaClient = "fake"
+else:
+   kafkaClient = "confluent"
+if kafkaClient == "fake":
+   import fakekafka
+   from fakekafka import Consumer, KafkaError, Producer, TopicPartition, AdminClient
+   fakeKafkaPartitions = numericProperty('fakeKafkaPartitions', 6)
+   fakeKafkaRetention = numericProperty('fakeKafkaRetention', 100000)
+   fakeKafkaReplayRate = numericProperty('fakeKafkaReplayRate', 0, float)
+   fakeKafkaReplayLoops = numericProperty('fakeKafkaReplayLoops', 1)
+   fakeKafkaReplayBacklog = numericProperty('fakeKafkaReplayBacklog', 100000)
+   fakekafka.broker.createTopic(sevOneKafkaTopicName, fakeKafkaPartitions)
+   if publishType.lower() == "kafka":
+      fakekafka.broker.createTopic(watsonKafkaTopicName, fakeKafkaPartitions, retention=fakeKafkaRetention)
+   if connectorWorkers > 1:
+      logging.info("WARNING: the fake kafka broker only exists within one process, and can not feed worker processes. Setting connectorWorkers to 1")
+      connectorWorkers = 1
+   logging.info("Using the in-memory fake kafka broker, " + str(fakeKafkaPartitions) + " partition(s) per topic")
+elif Consumer is None:
+   print("FATAL: Unable to load confluent_kafka. Make sure you have installed confluent-kafka package. It can be installed using pip as such:\n\tpip install confluent-kafka")
+   exit()
+
+# Configure the historical backfill
+
+if 'backfillConsumerGroup' in datachannelProps:
+   backfillConsumerGroup = datachannelProps['backfillConsumerGroup']
+else:
+   backfillConsumerGroup = "waiopsMetric-Backfill"
+backfillReaderThreads = max(numericProperty('backfillReaderThreads', 4), 1)
+backfillMaxRate = numericProperty('backfillMaxRate', 20000, float)
+backfillThrottleLock = threading.Lock()
+backfillNextTime = 0
+backfillMessages = 0
+restDrainRequested = False
+kafkaDrainRequested = False
+kafkaRecordLock = threading.Lock()
+kafkaRecords = {}
+kafkaRecordBytes = {}
+kafkaRecordStartTimes = {}
+kafkaRecordTokens = {}
+
+# Configure at-least-once offset commits. A backfill reads by time under its own group, and does not commit
+
+if 'commitOffsets' in datachannelProps:
+   commitOffsets = datachannelProps['commitOffsets'].lower() == "true"
+else:
+   commitOffsets = True
+if backfillMode:
+   commitOffsets = False
+offsetCommitInterval = numericProperty('offsetCommitInterval', 5, float)
+ackLock = threading.Lock()
+ackPartitions = {}
+ackedOffsets = {}
+committedOffsets = {}
+lastOffsetCommit = 0
+
+# Configure the write-ahead spool for batches that can not be posted
+
+spoolSegmentBytes = numericProperty('spoolSegmentBytes', 67108864)
+spoolSegmentMaxAge = numericProperty('spoolSegmentMaxAge', 60)
+spoolMaxBytes = numericProperty('spoolMaxBytes', 10737418240)
+spoolRetention = numericProperty('spoolRetention', 86400)
+spoolReplayRate = numericProperty('spoolReplayRate', 10, float)
+spoolProbeInterval = numericProperty('spoolProbeInterval', 30)
+spoolQueue = queue.Queue()
+spoolLock = threading.Lock()
+spoolSegments = collections.deque()
+spoolActive = None
+spoolActiveBytes = 0
+spoolSequence = 0
+spoolBytes = 0
+spoolRollRequested = False
+restApiReachable = True
+
+# API responses that refuse the payload itself, whose batches are discarded rather than spooled
+
+restPayloadErrorCodes = (400, 413, 422)
+
+# The pipeline stages are not thread safe. Readers hold pipelineLock while they run them, as does a drain
+# or shutdown that flushes them
+
+pipelineLock = threading.Lock()
+
+# Configure coalescing of metrics per resource and timestamp
+
+if 'coalesceMetrics' in datachannelProps:
+   coalesceMetrics = datachannelProps['coalesceMetrics'].lower() == "true"
+else:
+   coalesceMetrics = False
+coalesceWindow = numericProperty('coalesceWindow', 2, float)
+coalesceMaxEntries = numericProperty('coalesceMaxEntries', 100000)
+coalesceBuffer = {}
+
+# Configure local aggregation to the AIOps topic interval
+
+if 'aggregateMetrics' in datachannelProps:
+   aggregateMetrics = datachannelProps['aggregateMetrics'].lower() == "true"
+else:
+   aggregateMetrics = False
+if 'aggregationDefaultFunction' in datachannelProps and datachannelProps['aggregationDefaultFunction'].lower() in aggregationFunctionNames:
+   aggregationDefaultFunction = datachannelProps['aggregationDefaultFunction'].lower()
 else:
-   if(logRawJson.lower() == "true"):
-      jsonLogFileLocation = open(mediatorHome + "/log/rawJson.log", "w")
-      jsonLogFileLocation.write("Starting logging")
+   aggregationDefaultFunction = "avg"
+aggregationLateness = numericProperty('aggregationLateness', 60)
+aggregationEventTime = False
+aggregationWatermark = 0
+aggregationClosedThrough = 0
+aggregationBuckets = {}
+aggregationBucketTokens = {}
+if aggregateMetrics:
+   logging.info("Aggregating metrics to " + str(watsonTopicAggInterval) + " minute intervals, default function '" + aggregationDefaultFunction + "', " + str(len(aggregationFunctions)) + " metric specific function(s), lateness allowance " + str(aggregationLateness) + " seconds")
+
+# Configure conversion of counter metrics to per-second rates
+
+if 'convertCounters' in datachannelProps:
+   convertCounters = datachannelProps['convertCounters'].lower() == "true"
+else:
+   convertCounters = False
+counterMaxSeries = numericProperty('counterMaxSeries', 1000000)
+counterSeriesTimeout = numericProperty('counterSeriesTimeout', 3600)
+counterStateFrequency = numericProperty('counterStateFrequency', 300)
+counterSeries = collections.OrderedDict()
+counterStateLock = threading.Lock()
+counterStateFileName = None
+counterStateSavedAt = time.time()
+if convertCounters:
+   logging.info("Converting " + str(len(counterMetrics)) + " counter metric(s) to per-second rates, tracking at most " + str(counterMaxSeries) + " series, series timeout " + str(counterSeriesTimeout) + " seconds")
    
 ################################
 #
@@ -998,17 +4221,35 @@ if sevOneKafkaDataFormat.lower() == "avro":
       logging.info("Please obtain the SevOne Avro schema in the SevOne data bus config and place the JSON in the sevone-avro-schema.json file.")
       exit()
 
+   # The schema is parsed once here, and the compiled schema is reused for every message
+
    print(("Going to parse avro schema: " + json.dumps(schema)))
    try:
-      parsed_schema = avro.schema.parse(json.dumps(schema))
+      parsed_schema = fastavro.parse_schema(schema)
    except Exception as e:
       logging.info("FATAL: Unable to parse Avro schema. Verify that the schema definition is correct.")
       print("FATAL: Unable to parse avro schema. Verify that the schema definition is correct.")
       print(e)
       exit()
-   #reader = avro.io.DatumReader(parsed_schema)
-   reader = DatumReader(parsed_schema)
    print("Avro schema parsed successfully")
+
+   # Schemas for messages in the Confluent wire format (magic byte + schema id) are read from
+   # conf/avro-schemas/<schema id>.json
+
+   if 'avroWireFormat' in datachannelProps:
+      avroWireFormat = datachannelProps['avroWireFormat'].lower()
+      if avroWireFormat not in [ "raw", "confluent", "auto" ]:
+         logging.info("WARNING: Unknown 'avroWireFormat' property set. Should be \"raw\", \"confluent\" or \"auto\". Defaulting to \"raw\"")
+         avroWireFormat = "raw"
+   else:
+      avroWireFormat = "raw"
+   logging.debug("avroWireFormat = " + avroWireFormat)
+
+   avroSchemaDir = mediatorHome + "/conf/avro-schemas"
+   avroSchemaCache = {}
+   avroDecodeErrorInterval = None
+   if avroWireFormat != "raw":
+      loadAvroSchemaCache(avroSchemaDir)
    print("Properties loaded successfully")
 
 
@@ -1029,15 +4270,19 @@ if (not os.environ.get('PYTHONHTTPSVERIFY', '') and getattr(ssl, '_create_unveri
    
 # Define a publisher queue that will be used to publish metrics to Watson
 
-publishQueue = queue.Queue()
+publishQueueMaxSize = numericProperty('publishQueueMaxSize', 2000)
+publishQueueHighWatermark = numericProperty('publishQueueHighWatermark', int(publishQueueMaxSize * 0.8))
+publishQueueLowWatermark = numericProperty('publishQueueLowWatermark', int(publishQueueMaxSize * 0.4))
+if not (0 <= publishQueueLowWatermark < publishQueueHighWatermark <= publishQueueMaxSize):
+   logging.info("WARNING: publish queue watermarks must satisfy publishQueueLowWatermark < publishQueueHighWatermark <= publishQueueMaxSize. Using 40% and 80% of publishQueueMaxSize")
+   publishQueueHighWatermark = int(publishQueueMaxSize * 0.8)
+   publishQueueLowWatermark = int(publishQueueMaxSize * 0.4)
+publishQueue = queue.Queue(maxsize=publishQueueMaxSize)
+consumerPaused = False
+pausedPartitions = set()
+pauseCheckTime = 0
    
 
-####################################################
-#
-# Connect to Watson Kafka bus if publishing to kafka
-#
-####################################################
-
 logging.debug("Validate publisher type and if Kafka, configure Kafka properties, and if REST, start a restQueueThread")
 
 if( "publishType" not in globals()):
@@ -1045,126 +4290,12 @@ if( "publishType" not in globals()):
    logging.info("FATAL: publishType not set in sevone-watson-datachannel.props. Please set it to \"kafka\" or \"rest\"")
    exit()
 
-if publishType.lower() == "kafka":
-
-   logging.debug("connecting to watsonKafkaServers: " + watsonKafkaServers)
-   
-   watsonKafkaConfig = {
-        'bootstrap.servers': watsonKafkaServers,
-        'client.id': "SevOneDatachannel@" + socket.gethostname(),
-        'queue.buffering.max.ms': 5}
-   
-   if watsonKafkaSSL.lower() == "true":
-      kafkasslsettings = {
-         'security.protocol' : 'SSL',
-         'ssl.ca.location': watsonSSLCaLocation,
-         'ssl.certificate.location': watsonSSLCertificateLocation,
-         'ssl.key.location': watsonSSLKeyLocation }
-      watsonKafkaConfig.update(kafkasslsettings)
-   else:
-      logging.debug("Watson Kafka connection does not require SSL")
-   
-   watsonProducer = Producer(watsonKafkaConfig)
-   
-   watson_admin_client = AdminClient(watsonKafkaConfig)
-   topics = watson_admin_client.list_topics().topics
-   if not topics:
-      logging.info("FATAL: Unable to verify connectivity and topics in the Watson kafka bus at " + watsonKafkaServers + ". Verify kafka configuration, reconfigure, and retry.")
-      print(("FATAL: Unable to verify connectivity and topics in the Watson kafka bus at " + watsonKafkaServers + ". Verify kafka configuration, reconfigure, and retry."))
-      exit()
-   elif watsonKafkaTopicName not in topics:
-      print(("FATAL: Watson kafka topic name (" + watsonKafkaTopicName + ") does not exist in the Watson kafka. Available topics: " + topics + ". Ensure proper topic configuration."))
-      exit()
-   
-   logging.debug("Watson AIOps Kafka topic available.")
-
-
-
-elif publishType.lower() == "rest":
-
-   # start up a thread to pick up the queue messages and add them to the restMetricGroup["groups"] 
-   logging.debug("publishType is \'rest\', let's start a restQueueThread")
-   
-   restQueueThread = threading.Thread(target=restQueueReader)
-   restQueueThread.daemon = True
-   restQueueThread.start()
-   # start up a thread to publish every 60 seconds
-
-#   restPublishThread = threading.Thread(target=postMetric)
-#   restPublishThread.daemon = True
-#   restPublishThread.start()
-   #perfStatThread.join()
-
-   
-
-else:
+if publishType.lower() not in [ "kafka", "rest" ]:
 
    logging.info("FATAL: unknown publishType property. Should be \"kafka\" or \"rest\". Please check the properties file and ensure publishType is configured properly.")
    exit()
 
 
-#############################
-#
-# Connect to SevOne Kafka bus
-#
-#############################
-
-kafkasettings = {
-    'bootstrap.servers': sevOneKafkaServers,
-    'group.id': 'waiopsMetric-Restgroup',
-    'client.id': 'waiopsMetric-Restclient-1@' + socket.gethostname(),
-    'enable.auto.commit': False,
-    'session.timeout.ms': 6000,
-    'socket.timeout.ms': 3000,
-    'default.topic.config': {'auto.offset.reset': 'latest'}
-}
-
-if sevOneKafkaSSL.lower() == "true":
-   kafkasslsettings = {
-      'security.protocol' : 'SSL',
-      'ssl.ca.location': sevOneSSLCaLocation,
-      'ssl.certificate.location': sevOneSSLCertificateLocation,
-      'ssl.key.location': sevOneSSLKeyLocation }
-   kafkasettings.update(kafkasslsettings)
-else:
-   logging.debug("SevOne SDB Kafka connection does not require SSL")
-
-
-logging.debug("kafka settings are: " + str(kafkasettings))
-
-c = Consumer(kafkasettings)    # is this version buggy? thinks this is a Producer
-
-
-
-logging.debug("Verifying SevOne kafka topic - listing topics")
-logging.info("==============================================")
-logging.info("= IGNORE FOLLOWING PRODUCER WARNINGS         =")
-logging.info("==============================================")
-
-
-admin_client = AdminClient(kafkasettings)
-topics = admin_client.list_topics().topics
-if not topics:
-   logging.info("FATAL: Unable to verify connectivity and topics in SevOne kafka bus at " + sevOneKafkaServers + ". Verify kafka configuration, reconfigure, and retry.")
-   print(("FATAL: Unable to verify connectivity and topics in SevOne kafka bus at " + sevOneKafkaServers + ". Verify kafka configuration, reconfigure, and retry."))
-   exit()
-elif sevOneKafkaTopicName not in topics:
-   print(("FATAL: SevOne kafka topic name does not exist in SevOne kafka. Available topics: " + topics + ". Ensure proper topic configuration."))
-   exit()
-
-logging.debug("Successfully listed topics in SevOne kafka. Topics returned: " + str(topics))
-
-logging.debug("Subscribing to SevOne kafka topic")
-try:
-   c.subscribe([sevOneKafkaTopicName])
-except Exception as e:
-   logging.info("FATAL: Unable to connect to SevOne Kafka bus at " + sevOneKafkaServers + ". Verify Kafka configuration, reconfigure, and retry.")
-   print(("FATAL: Unable to connect to SevOne Kafka bus at " + sevOneKafkaServers + ". Verify Kafka configuration, reconfigure, and retry."))
-   exit()
-   
-logging.debug("SevOne Kafka Topic available.")
-
-
 ######################
 #
 # Main processing loop
@@ -1172,41 +4303,55 @@ logging.debug("SevOne Kafka Topic available.")
 ######################
 
 
-# Set up signal handlers for interrupt signal (e.g. CTRL-C) and HUP signal
+# The pipeline is only run when the connector is started as a program. When it is loaded as a module (by
+# python/zabbix-benchmark.py) the configuration above is loaded, and the caller drives the pipeline
 
-signal.signal(signal.SIGINT, shutdownHandler)
-signal.signal(signal.SIGHUP, reconfigHandler)
+if __name__ == "__main__":
 
+   # Set up signal handlers for interrupt signal (e.g. CTRL-C) and HUP signal
 
+   signal.signal(signal.SIGINT, shutdownHandler)
+   signal.signal(signal.SIGHUP, reconfigHandler)
+   signal.signal(signal.SIGUSR2, toggleProfilerHandler)
 
+   if kafkaClient == "fake":
+      fakeKafkaReplay = startFakeKafkaReplay()
 
-# Start a reader thread to connect to the SevOne kafka bus and receive messages
+   if backfillMode:
 
-sdbReaderThread = threading.Thread(target=sdbReader)
-sdbReaderThread.daemon = True
-sdbReaderThread.start()
-#publishThread.join()
+      # Backfill mode: replay the topic between the start and end times, then exit
 
+      try:
+         runBackfill()
+      finally:
+         shutdownPipeline()
+
+   elif connectorWorkers > 1:
 
-# Start a publisher thread that will pick up transformed metric JSON and place it on the Watson kafka topic
+      # Supervisor mode: fork the worker processes, each of which runs its own reader and publisher pipeline,
+      # and merge their statistics into the interval report
 
-if(publishType.lower == "kafka"):
-   publishThread = threading.Thread(target=publishMetric)
-   publishThread.daemon = True
-   publishThread.start()
-   #publishThread.join()
+      runSupervisor()
 
+   else:
 
-# Start a performance statistics thread to keep track of various performance metrics (queue depth, etc)
+      startPublisher(1)
+      c = connectSevOneKafka(1)
+      startPipelineThreads(1)
 
-perfStatThread = threading.Thread(target=logTimeDelta, args=(True,))
-perfStatThread.daemon = True
-perfStatThread.start()
-#perfStatThread.join()
+      # Start a performance statistics thread to keep track of various performance metrics (queue depth, etc)
 
+      perfStatThread = threading.Thread(target=logTimeDelta, args=(True,), name="logTimeDelta")
+      perfStatThread.daemon = True
+      perfStatThread.start()
+      #perfStatThread.join()
+      startAdminServer()
 
-# Sleep until shutdown signal received
 
-while threading.active_count() > 0:
-    time.sleep(0.1)
+      # Sleep until shutdown signal received
 
+      try:
+         while threading.active_count() > 0:
+             time.sleep(0.1)
+      finally:
+         shutdownPipeline()
@@ -0,0 +1,444 @@
+#!/usr/bin/python3.11
+
+#
+# End-to-end throughput benchmark for the Zabbix to Watson AIOps metric connector
+#
+# Generates synthetic Zabbix real-time export item messages into a topic of the in-memory kafka broker
+# (python/fakekafka.py) and runs the whole connector on it, in-process: the sdbReader consumer with its
+# backpressure and offset commits, translateToWatsonMetric, the publish queue, the REST batching in
+# restQueueReader and the REST senders (posting to a null AIOps API in a child process), or the Watson
+# kafka publisher (producing to the in-memory broker). Reports messages per second, per-stage latency
+# percentiles and peak RSS, and writes the results as JSON so that runs can be compared across versions:
+#
+#    python3 zabbix-benchmark.py --messages 500000 --hosts 2000 --items 40 --output before.json
+#    python3 zabbix-benchmark.py --messages 500000 --hosts 2000 --items 40 --output after.json --compare before.json
+#
+# With --api the metrics are posted to a python/aiops-api-server.py instead, to measure the retry cost and
+# batch loss under the faults it injects, and its counts are stored with the results
+#
+# The connector is loaded from this directory, with its configuration written to a temporary home
+# directory, so the installed configuration and logs are not touched. confluent-kafka is not needed
+#
+
+import argparse
+import http.server
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+import fakekafka
+
+benchmarkHome = os.path.dirname(os.path.abspath(sys.argv[0]))
+connectorPath = benchmarkHome + "/zabbix-aiops-metric-connector.py"
+
+valueTypes = { "float": 0, "string": 1, "uint": 3 }
+sevOneTopic = "zabbix"
+watsonTopic = "metrics"
+
+# the consumer group of the connector's live reader, see connectSevOneKafka
+
+consumerGroup = "waiopsMetric-Restgroup"
+malformedKinds = [ "noMetricTag", "noValue", "noClock", "notJson" ]
+
+##########################################################################
+#
+# Synthetic Zabbix messages. Each host reports each of its items once per
+# poll interval. Items are spread over a number of subcomponents, and are
+# tagged with the KafkaSubcomponent and KafkaMetric tags the connector
+# maps, plus any number of unrelated tags ahead of or behind them. A share
+# of the item names are listed in metrics-ignore.conf, and a share of the
+# messages are malformed (missing their metric tag, value or clock, or not
+# JSON at all)
+#
+##########################################################################
+
+def itemTags(item, options):
+
+   extraTags = [ { "tag": "Application", "value": "app-" + str(item % 7) } ]
+   extraTags += [ { "tag": "label" + str(tag), "value": "value" + str(tag) } for tag in range(options.extra_tags) ]
+   kafkaTags = [ { "tag": "KafkaSubcomponent", "value": "component" + str(item % options.components) },
+                 { "tag": "KafkaMetric", "value": "metric" + str(item) } ]
+   if options.tag_order == "first":
+      return kafkaTags + extraTags
+   return extraTags + kafkaTags
+
+def itemValue(valueType, rng):
+
+   if valueType == "float":
+      return round(rng.uniform(0, 100), 4)
+   elif valueType == "uint":
+      return rng.randrange(0, 2 ** 40)
+   else:
+      return str(round(rng.uniform(0, 100), 2))
+
+def generateMessages(options, ignoredItems):
+
+   # returns the message values, JSON encoded as they would be read from the topic
+
+   rng = random.Random(options.seed)
+   types = options.value_types.split(",")
+   itemTypes = [ types[item % len(types)] for item in range(options.items) ]
+   tags = [ itemTags(item, options) for item in range(options.items) ]
+   seriesCount = options.hosts * options.items
+   firstClock = int(time.time()) - (options.messages // seriesCount) * options.poll_interval
+   values = []
+   for sequence in range(options.messages):
+      host, item = divmod(sequence % seriesCount, options.items)
+      event = {
+         "host": { "host": "host" + str(host), "name": "Host " + str(host) },
+         "groups": [ "Zabbix servers" ],
+         "item_tags": tags[item],
+         "itemid": 100000 + sequence % seriesCount,
+         "name": ("ignored" if item in ignoredItems else "item") + str(item),
+         "clock": firstClock + (sequence // seriesCount) * options.poll_interval,
+         "ns": rng.randrange(0, 1000000000),
+         "value": itemValue(itemTypes[item], rng),
+         "type": valueTypes[itemTypes[item]]
+      }
+      if rng.random() < options.malformed_ratio:
+         kind = malformedKinds[sequence % len(malformedKinds)]
+         if kind == "noMetricTag":
+            event["item_tags"] = [ tag for tag in tags[item] if tag["tag"] != "KafkaMetric" ]
+         elif kind == "noValue":
+            del event["value"]
+         elif kind == "noClock":
+            del event["clock"]
+         else:
+
+            # a record cut short, as a truncated or corrupted write would leave it
+
+            values.append(json.dumps(event).encode("utf-8")[:40])
+            continue
+      values.append(json.dumps(event).encode("utf-8"))
+   return values
+
+##########################################################################
+#
+# Null AIOps API. It accepts every post, in a child process so that it
+# does not compete with the connector for the interpreter lock
+#
+##########################################################################
+
+class NullApiHandler(http.server.BaseHTTPRequestHandler):
+
+   protocol_version = "HTTP/1.1"
+
+   def do_POST(self):
+      self.rfile.read(int(self.headers.get("Content-Length", 0)))
+      self.send_response(200)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", "2")
+      self.end_headers()
+      self.wfile.write(b"{}")
+
+   def log_message(self, format, *args):
+      pass
+
+def runNullApi(portQueue):
+
+   server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), NullApiHandler)
+   portQueue.put(server.server_address[1])
+   server.serve_forever()
+
+##########################################################################
+#
+# Connector setup. The connector is loaded as a module with sys.argv[0]
+# pointing into a temporary home directory holding its configuration, so
+# that it reads the benchmark's properties and writes its logs there
+#
+##########################################################################
+
+def writeConnectorHome(home, options, ignoredItems, apiUrl):
+
+   os.makedirs(home + "/conf")
+   os.makedirs(home + "/log")
+   props = {
+      "sevOneKafkaDataFormat": "JSON",
+      "sevOneKafkaTopicName": sevOneTopic,
+      "sevOneKafkaServers": "localhost:9092",
+      "sevOneKafkaSSL": "false",
+      "watsonProductTarget": "pi" if options.sink == "kafka" else "aiops",
+      "publishType": options.sink,
+      "watsonKafkaServers": "localhost:9092",
+      "watsonKafkaTopicName": watsonTopic,
+      "watsonKafkaSSL": "false",
+      "watsonMetricGroup": "zabbix",
+      "watsonTopicName": "ZABBIX",
+      "watsonTopicAggInterval": "5",
+      "watsonTenantId": "cfd95b7e-3bc7-4006-a4a8-a73a79c71255",
+      "watsonRestRoute": (apiUrl or "http://127.0.0.1:9") + "/aiops/api/app/metric-api/v1/metrics",
+      "watsonUser": "benchmark",
+      "watsonApiKey": "benchmark",
+      "loggingLevel": "INFO",
+      "logRawJson": "false",
+      "kafkaConsumeBatchSize": str(options.batch_size),
+      "kafkaConsumeMaxWait": "0.05",
+      "kafkaClient": "fake",
+      "fakeKafkaPartitions": str(options.partitions),
+      "commitOffsets": "true",
+      "stageTimingSampleRate": str(options.stage_sample_rate)
+   }
+   for setting in options.prop:
+      name, value = setting.split("=", 1)
+      props[name.strip()] = value.strip()
+   with open(home + "/conf/sevone-watson-datachannel.props", "w") as propsFile:
+      for name, value in props.items():
+         propsFile.write(name + ' = "' + value + '"\n')
+   with open(home + "/conf/metrics-ignore.conf", "w") as ignoreFile:
+      for item in sorted(ignoredItems):
+         ignoreFile.write("ignored" + str(item) + "\n")
+   return props
+
+def loadConnector(home):
+
+   argv, stdout, stderr = sys.argv, sys.stdout, sys.stderr
+   sys.argv = [ home + "/python/zabbix-aiops-metric-connector.py" ]
+   try:
+      spec = importlib.util.spec_from_file_location("zabbixconnector", connectorPath)
+      connector = importlib.util.module_from_spec(spec)
+      spec.loader.exec_module(connector)
+   except SystemExit:
+
+      # the connector exits on a configuration it can not run with, having logged why
+
+      sys.argv, sys.stdout, sys.stderr = argv, stdout, stderr
+      print("FATAL: the connector did not load with the benchmark configuration. Its log:")
+      with open(home + "/log/sevone-datachannel.log") as logFile:
+         print(logFile.read()[-4000:])
+      raise
+   finally:
+      sys.argv, sys.stdout, sys.stderr = argv, stdout, stderr
+   return connector
+
+def gitCommit():
+
+   try:
+      return subprocess.run([ "git", "rev-parse", "--short", "HEAD" ], cwd=benchmarkHome, capture_output=True, text=True, timeout=10).stdout.strip() or None
+   except (OSError, subprocess.SubprocessError):
+      return None
+
+##########################################################################
+#
+# The run. The messages are loaded into the SevOne topic before the clock
+# starts, and the connector's consumer group is set to start from their
+# beginning. The reader time stops when the connector has consumed them
+# all, and the total time once it has processed them and the publisher has
+# posted or delivered everything
+#
+##########################################################################
+
+def runBenchmark(connector, options, values):
+
+   for partition in range(options.partitions):
+      fakekafka.broker.appendBatch(sevOneTopic, partition, values[partition::options.partitions])
+      fakekafka.broker.setCommitted(consumerGroup, sevOneTopic, partition, 0)
+
+   connector.startPublisher(1)
+   connector.c = connector.connectSevOneKafka(1)
+   rssBeforeRun = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   start = time.perf_counter()
+   connector.startPipelineThreads(1)
+   while connector.statsTotals()["consumedMessages"] < len(values):
+      if not connector.sdbReaderThread.is_alive():
+         print("FATAL: the connector's reader stopped after " + str(connector.statsTotals()["consumedMessages"]) + " messages, see its log")
+         sys.exit(1)
+      time.sleep(0.01)
+   readerEnd = time.perf_counter()
+
+   # the last batch has been processed once the reader next finds the topic empty
+
+   emptyPolls = connector.statsTotals()["consumeEmptyPolls"]
+   while connector.statsTotals()["consumeEmptyPolls"] == emptyPolls:
+      time.sleep(0.01)
+   connector.drainPublisher()
+   end = time.perf_counter()
+   connector.shutdownPipeline()
+
+   totals = connector.statsTotals()
+   totalSeconds = end - start
+   readerSeconds = readerEnd - start
+   with fakekafka.broker.condition:
+      committed = sum(offset for (group, topic, partition), offset in fakekafka.broker.committed.items() if group == consumerGroup and topic == sevOneTopic)
+   stages = {}
+   for stage in connector.stageNames:
+      samples = totals[connector.stageTimingCountNames[stage]]
+      if samples > 0:
+         counts = [ totals[name] for name in connector.stageTimingStatNames[stage] ]
+         stages[stage] = {
+            "samples": samples,
+            "meanMs": round(totals[connector.stageTimingSumNames[stage]] / samples, 4),
+            "p50Ms": stageQuantile(connector, counts, 0.5),
+            "p99Ms": stageQuantile(connector, counts, 0.99)
+         }
+   if options.sink == "kafka":
+      delivered = totals["kafkaMetricsProduced"] - totals["kafkaFailedMetrics"]
+   else:
+      delivered = totals["restSentMetrics"]
+   publishing = {}
+   for name in [ "restPosts", "restPostErrors", "restPostRetries", "restBisections", "restSavedMetrics", "restRejectedMetrics", "restLostMetrics", "spoolReplayedBatches", "kafkaDeliveryFailures", "kafkaFailedMetrics" ]:
+      if totals[name]:
+         publishing[name] = totals[name]
+   return {
+      "messages": len(values),
+      "translatedEntries": totals["translatedEntries"],
+      "deliveredMetrics": delivered,
+      "committedMessages": committed,
+      "dropped": { name[len("dropped_"):]: count for name, count in sorted(totals.items()) if name.startswith("dropped_") },
+      "publishing": publishing,
+      "readerSeconds": round(readerSeconds, 3),
+      "totalSeconds": round(totalSeconds, 3),
+      "messagesPerSecond": round(len(values) / totalSeconds, 1),
+      "readerMessagesPerSecond": round(len(values) / readerSeconds, 1),
+      "stages": stages,
+      "rssBeforeRunKb": rssBeforeRun,
+      "peakRssKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   }
+
+def stageQuantile(connector, counts, quantile):
+
+   # a quantile beyond the last histogram bucket is stored as null, as JSON has no infinity
+
+   value = connector.histogramQuantile(counts, connector.stageTimingBounds, quantile)
+   if value == float("inf"):
+      return None
+   return value
+
+def compareResults(previous, current):
+
+   # prints the change in the headline figures against an earlier result file
+
+   def change(label, before, after, unit):
+      if before is None or after is None:
+         return
+      if before:
+         percent = " (" + format((after - before) * 100.0 / before, "+.1f") + "%)"
+      else:
+         percent = ""
+      print("   " + label.ljust(32) + str(before).rjust(12) + " -> " + str(after).rjust(12) + " " + unit + percent)
+
+   print("Compared with " + str(previous.get("label")) + " (" + str(previous.get("connector", {}).get("commit")) + ", " + str(previous.get("startedAt")) + "):")
+   change("messages per second", previous["results"]["messagesPerSecond"], current["results"]["messagesPerSecond"], "msg/s")
+   change("reader messages per second", previous["results"]["readerMessagesPerSecond"], current["results"]["readerMessagesPerSecond"], "msg/s")
+   change("peak RSS", previous["results"]["peakRssKb"], current["results"]["peakRssKb"], "KB")
+   for stage, figures in current["results"]["stages"].items():
+      before = previous["results"]["stages"].get(stage, {})
+      change(stage + " p50", before.get("p50Ms"), figures["p50Ms"], "ms")
+      change(stage + " p99", before.get("p99Ms"), figures["p99Ms"], "ms")
+   if previous.get("parameters") != current["parameters"]:
+      print("   NOTE: the runs used different parameters")
+
+#############
+#
+# Begins here
+#
+#############
+
+argParser = argparse.ArgumentParser(description="Synthetic Zabbix load benchmark for the Zabbix to Watson AIOps metric connector")
+argParser.add_argument("--messages", type=int, default=200000, help="number of messages to generate (default 200000)")
+argParser.add_argument("--batch-size", type=int, default=500, help="messages per consumed batch, kafkaConsumeBatchSize (default 500)")
+argParser.add_argument("--partitions", type=int, default=6, help="partitions of the SevOne topic (default 6)")
+argParser.add_argument("--hosts", type=int, default=1000, help="number of distinct hosts (default 1000)")
+argParser.add_argument("--items", type=int, default=20, help="number of items per host (default 20)")
+argParser.add_argument("--components", type=int, default=5, help="number of distinct subcomponents the items are spread over (default 5)")
+argParser.add_argument("--extra-tags", type=int, default=2, help="number of tags per item besides the Application and KafkaSubcomponent/KafkaMetric tags (default 2)")
+argParser.add_argument("--tag-order", choices=[ "first", "last" ], default="last", help="whether the KafkaSubcomponent/KafkaMetric tags come before or after the other tags (default last)")
+argParser.add_argument("--value-types", default="float,uint", help="comma separated item value types, from float, uint and string (numeric text), assigned to items in turn (default float,uint)")
+argParser.add_argument("--poll-interval", type=int, default=60, help="seconds between the clocks of successive polls of an item (default 60)")
+argParser.add_argument("--ignored-ratio", type=float, default=0.0, help="share of the items listed in metrics-ignore.conf (default 0)")
+argParser.add_argument("--malformed-ratio", type=float, default=0.0, help="share of the messages missing their metric tag, value or clock, or not JSON (default 0)")
+argParser.add_argument("--sink", choices=[ "rest", "kafka" ], default="rest", help="publish to a null AIOps REST API, or to a Watson kafka topic in the in-memory broker (default rest)")
+argParser.add_argument("--api", default=None, metavar="URL", help="post to the AIOps API at this root URL, e.g. a python/aiops-api-server.py at http://127.0.0.1:9100, instead of the null API")
+argParser.add_argument("--kafka-partitions", type=int, default=6, help="partitions of the Watson kafka topic (default 6)")
+argParser.add_argument("--stage-sample-rate", type=int, default=1, help="time the pipeline stages for 1 in this many batches (default 1)")
+argParser.add_argument("--prop", action="append", default=[], metavar="NAME=VALUE", help="set a connector property, e.g. --prop restCompression=gzip (may be repeated)")
+argParser.add_argument("--seed", type=int, default=1, help="random seed of the generator (default 1)")
+argParser.add_argument("--label", default=None, help="label stored with the results (default: the connector's git commit)")
+argParser.add_argument("--output", default=None, help="write the results as JSON to this file")
+argParser.add_argument("--compare", default=None, metavar="RESULTS", help="compare the results with an earlier results file")
+options = argParser.parse_args()
+
+unknownTypes = set(options.value_types.split(",")) - set(valueTypes)
+if unknownTypes:
+   argParser.error("unknown value type(s): " + ", ".join(sorted(unknownTypes)))
+for setting in options.prop:
+   if "=" not in setting:
+      argParser.error("--prop must be given as NAME=VALUE")
+
+ignoredItems = set(range(int(round(options.items * options.ignored_ratio))))
+parameters = { name: value for name, value in sorted(vars(options).items()) if name not in [ "label", "output", "compare", "api" ] }
+
+print("Generating " + str(options.messages) + " messages from " + str(options.hosts) + " hosts with " + str(options.items) + " items each")
+values = generateMessages(options, ignoredItems)
+
+apiProcess = None
+apiUrl = options.api
+if options.sink == "rest" and apiUrl is None:
+   portQueue = multiprocessing.Queue()
+   apiProcess = multiprocessing.Process(target=runNullApi, args=(portQueue,))
+   apiProcess.daemon = True
+   apiProcess.start()
+   apiUrl = "http://127.0.0.1:" + str(portQueue.get(timeout=30))
+
+# the Watson topic only keeps the latest records, so that it does not add to the memory measured
+
+fakekafka.broker.createTopic(sevOneTopic, options.partitions)
+fakekafka.broker.createTopic(watsonTopic, options.kafka_partitions, retention=1000)
+
+with tempfile.TemporaryDirectory(prefix="zabbix-benchmark-") as home:
+   connectorProps = writeConnectorHome(home, options, ignoredItems, apiUrl)
+   connector = loadConnector(home)
+   print("Running the " + options.sink + " pipeline")
+   results = runBenchmark(connector, options, values)
+   connector.shutdownRequest = True
+
+if apiProcess is not None:
+   apiProcess.terminate()
+elif options.api is not None:
+
+   # the stand-in API's own counts show the posts that were refused, duplicated or delayed
+
+   try:
+      with urllib.request.urlopen(options.api + "/stats", timeout=10) as response:
+         results["api"] = json.loads(response.read())
+   except (OSError, ValueError) as error:
+      print("WARNING: unable to read the counts of the API at " + options.api + ": " + str(error))
+
+commit = gitCommit()
+report = {
+   "label": options.label or commit,
+   "startedAt": datetime.now().isoformat(timespec="seconds"),
+   "connector": { "commit": commit, "properties": connectorProps },
+   "host": { "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count() },
+   "parameters": parameters,
+   "results": results
+}
+
+print(str(results["messages"]) + " messages in " + str(results["totalSeconds"]) + " seconds: " + str(results["messagesPerSecond"]) + " msg/s end to end, " + str(results["readerMessagesPerSecond"]) + " msg/s read and translated")
+print("Translated " + str(results["translatedEntries"]) + " entries, delivered " + str(results["deliveredMetrics"]) + " metrics, committed " + str(results["committedMessages"]) + " messages, dropped " + json.dumps(results["dropped"]))
+if results["publishing"]:
+   print("Publishing: " + json.dumps(results["publishing"]))
+if "api" in results:
+   print("API counts: " + json.dumps(results["api"]["counts"], sort_keys=True))
+for stage, figures in results["stages"].items():
+   quantiles = [ "p50 <= " + str(figures["p50Ms"]) if figures["p50Ms"] is not None else "p50 > " + str(max(connector.stageTimingBounds)),
+                 "p99 <= " + str(figures["p99Ms"]) if figures["p99Ms"] is not None else "p99 > " + str(max(connector.stageTimingBounds)) ]
+   print("   " + stage.ljust(14) + " mean " + str(figures["meanMs"]) + " ms, " + " ms, ".join(quantiles) + " ms (" + str(figures["samples"]) + " samples)")
+print("Peak RSS " + str(results["peakRssKb"]) + " KB (" + str(results["rssBeforeRunKb"]) + " KB before the run)")
+
+if options.output:
+   with open(options.output, "w") as outputFile:
+      json.dump(report, outputFile, indent=3)
+   print("Results written to " + options.output)
+if options.compare:
+   with open(options.compare) as previousFile:
+      compareResults(json.load(previousFile), report)
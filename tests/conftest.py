@@ -0,0 +1,236 @@
+#
+# Fixtures for the connector checks. Each check loads the connector as a module, the way
+# python/zabbix-benchmark.py does, with its configuration written to a temporary home directory and the
+# in-memory kafka broker of python/fakekafka.py in place of confluent-kafka. As the connector keeps its
+# state in module globals and starts threads that run until the process exits, every check runs in a
+# forked child process of its own. Metrics are posted to a python/aiops-api-server.py
+#
+
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+import traceback
+import urllib.request
+
+import pytest
+
+repoHome = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+pythonHome = repoHome + "/python"
+sys.path.insert(0, pythonHome)
+
+import fakekafka
+
+sevOneTopic = "zabbix"
+consumerGroup = "waiopsMetric-Restgroup"
+apiUser = "benchmark"
+apiKey = "benchmark"
+tenantId = "cfd95b7e-3bc7-4006-a4a8-a73a79c71255"
+
+def runIsolated(function, timeout=120):
+
+   # runs function in a forked child process and returns its result, or fails with the child's traceback
+
+   context = multiprocessing.get_context("fork")
+   receiver, sender = context.Pipe(duplex=False)
+
+   def child():
+      try:
+         sender.send(("result", function()))
+      except BaseException:
+         sender.send(("error", traceback.format_exc()))
+
+   process = context.Process(target=child)
+   process.start()
+   sender.close()
+   try:
+      if not receiver.poll(timeout):
+         pytest.fail("the check did not finish within " + str(timeout) + " seconds")
+      kind, value = receiver.recv()
+   except EOFError:
+      pytest.fail("the check's child process exited without a result")
+   finally:
+      if process.is_alive():
+         process.kill()
+      process.join()
+   if kind == "error":
+      pytest.fail("the check failed in its child process:\n" + value, pytrace=False)
+   return value
+
+@pytest.fixture
+def isolated():
+
+   return runIsolated
+
+class ConnectorHome:
+
+   # a home directory holding the connector's configuration and logs
+
+   def __init__(self, path):
+      self.path = str(path)
+
+   def write(self, apiUrl, props):
+      os.makedirs(self.path + "/conf", exist_ok=True)
+      os.makedirs(self.path + "/log", exist_ok=True)
+      settings = {
+         "sevOneKafkaDataFormat": "JSON",
+         "sevOneKafkaTopicName": sevOneTopic,
+         "sevOneKafkaServers": "localhost:9092",
+         "sevOneKafkaSSL": "false",
+         "watsonProductTarget": "aiops",
+         "publishType": "rest",
+         "watsonKafkaServers": "localhost:9092",
+         "watsonKafkaTopicName": "metrics",
+         "watsonKafkaSSL": "false",
+         "watsonMetricGroup": "zabbix",
+         "watsonTopicName": "ZABBIX",
+         "watsonTopicAggInterval": "5",
+         "watsonTenantId": tenantId,
+         "watsonRestRoute": (apiUrl or "http://127.0.0.1:9") + "/aiops/api/app/metric-api/v1/metrics",
+         "watsonUser": apiUser,
+         "watsonApiKey": apiKey,
+         "loggingLevel": "INFO",
+         "logRawJson": "false",
+         "kafkaConsumeBatchSize": "50",
+         "kafkaConsumeMaxWait": "0.05",
+         "kafkaClient": "fake",
+         "fakeKafkaPartitions": "2",
+         "commitOffsets": "true"
+      }
+      settings.update(props)
+      with open(self.path + "/conf/sevone-watson-datachannel.props", "w") as propsFile:
+         for name, value in settings.items():
+            propsFile.write(name + ' = "' + value + '"\n')
+      if not os.path.exists(self.path + "/conf/metrics-ignore.conf"):
+         open(self.path + "/conf/metrics-ignore.conf", "w").close()
+
+   def load(self):
+
+      # called in the child process. The root logger may hold pytest's capture handlers, which would keep the
+      # connector's logging.basicConfig from opening its log file
+
+      for handler in list(logging.root.handlers):
+         logging.root.removeHandler(handler)
+      argv, stdout, stderr = sys.argv, sys.stdout, sys.stderr
+      sys.argv = [ self.path + "/python/zabbix-aiops-metric-connector.py" ]
+      try:
+         spec = importlib.util.spec_from_file_location("zabbixconnector", pythonHome + "/zabbix-aiops-metric-connector.py")
+         connector = importlib.util.module_from_spec(spec)
+         spec.loader.exec_module(connector)
+      finally:
+         sys.argv, sys.stdout, sys.stderr = argv, stdout, stderr
+      return connector
+
+   def log(self):
+      with open(self.path + "/log/sevone-datachannel.log") as logFile:
+         return logFile.read()
+
+@pytest.fixture
+def connectorHome(tmp_path):
+
+   return ConnectorHome(tmp_path / "home")
+
+class AiopsApi:
+
+   # a python/aiops-api-server.py in a subprocess
+
+   def __init__(self, arguments):
+      with socket.socket() as probe:
+         probe.bind(("127.0.0.1", 0))
+         port = probe.getsockname()[1]
+      self.url = "http://127.0.0.1:" + str(port)
+      self.process = subprocess.Popen([ sys.executable, pythonHome + "/aiops-api-server.py", "--port", str(port), "--user", apiUser, "--api-key", apiKey, "--tenant-id", tenantId, "--report-interval", "3600" ] + arguments, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+      deadline = time.time() + 30
+      while True:
+         try:
+            self.counts()
+            break
+         except OSError:
+            if time.time() > deadline or self.process.poll() is not None:
+               self.stop()
+               raise RuntimeError("aiops-api-server.py did not start on port " + str(port))
+            time.sleep(0.1)
+
+   def counts(self):
+      with urllib.request.urlopen(self.url + "/stats", timeout=10) as response:
+         return json.loads(response.read())["counts"]
+
+   def stop(self):
+      self.process.terminate()
+      self.process.wait(10)
+
+@pytest.fixture
+def aiopsApi():
+
+   servers = []
+
+   def start(*arguments):
+      server = AiopsApi(list(arguments))
+      servers.append(server)
+      return server
+
+   yield start
+   for server in servers:
+      server.stop()
+
+def zabbixMessage(host, item, clock, value):
+
+   # a Zabbix real-time export item message, JSON encoded
+
+   return json.dumps({
+      "host": { "host": "host" + str(host), "name": "Host " + str(host) },
+      "groups": [ "Zabbix servers" ],
+      "item_tags": [ { "tag": "KafkaSubcomponent", "value": "component" }, { "tag": "KafkaMetric", "value": "metric" + str(item) } ],
+      "itemid": 100000 + host * 100 + item,
+      "name": "item" + str(item),
+      "clock": clock,
+      "ns": 0,
+      "value": value,
+      "type": 0
+   }).encode("utf-8")
+
+def runPipeline(connector, values, timeout=60):
+
+   ###########################################################################
+   #
+   # Called in the child process. Loads the messages into the SevOne topic,
+   # runs the connector's reader and publisher on them until they have all
+   # been consumed, drains and shuts down the pipeline, and returns the
+   # number of messages committed for the connector's consumer group
+   #
+   ###########################################################################
+
+   partitions = fakekafka.broker.partitionCount(sevOneTopic)
+   for partition in range(partitions):
+      fakekafka.broker.appendBatch(sevOneTopic, partition, values[partition::partitions])
+      fakekafka.broker.setCommitted(consumerGroup, sevOneTopic, partition, 0)
+   connector.startPublisher(1)
+   connector.c = connector.connectSevOneKafka(1)
+   connector.startPipelineThreads(1)
+   deadline = time.time() + timeout
+   while connector.statsTotals()["consumedMessages"] < len(values):
+      assert connector.sdbReaderThread.is_alive(), "the connector's reader stopped"
+      assert time.time() < deadline, "the connector consumed " + str(connector.statsTotals()["consumedMessages"]) + " of " + str(len(values)) + " messages"
+      time.sleep(0.01)
+
+   # the last batch has been processed once the reader next finds the topic empty
+
+   emptyPolls = connector.statsTotals()["consumeEmptyPolls"]
+   while connector.statsTotals()["consumeEmptyPolls"] == emptyPolls:
+      time.sleep(0.01)
+   connector.drainPublisher()
+   connector.shutdownPipeline()
+   with fakekafka.broker.condition:
+      return sum(offset for (group, topic, partition), offset in fakekafka.broker.committed.items() if group == consumerGroup and topic == sevOneTopic)
+
+def waitFor(condition, timeout=30, what="the condition"):
+
+   deadline = time.time() + timeout
+   while not condition():
+      assert time.time() < deadline, "timed out waiting for " + what
+      time.sleep(0.1)
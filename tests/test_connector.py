@@ -0,0 +1,185 @@
+#
+# Checks of the connector's pipeline against the in-memory kafka broker and python/aiops-api-server.py.
+# See conftest.py for how the connector is loaded
+#
+
+import glob
+import io
+import json
+import os
+import signal
+import struct
+import threading
+import time
+import zlib
+
+import pytest
+
+from conftest import runPipeline, waitFor, zabbixMessage
+
+def test_aggregated_and_coalesced_metrics_are_delivered_and_committed(isolated, connectorHome, aiopsApi):
+
+   # the aggregation bucket stays open for the whole run, so its points are only published by the flush on drain
+
+   api = aiopsApi()
+   connectorHome.write(api.url, { "aggregateMetrics": "true", "coalesceMetrics": "true" })
+   bucketStart = int(time.time()) // 300 * 300
+   values = [ zabbixMessage(host, item, bucketStart, host + item) for host in range(10) for item in range(5) ]
+
+   def check():
+      connector = connectorHome.load()
+      committed = runPipeline(connector, values)
+      return committed, connector.statsTotals()["aggregationEntriesOut"], connector.statsTotals()["coalesceEntriesOut"]
+
+   committed, aggregated, coalesced = isolated(check)
+   counts = api.counts()
+   assert committed == len(values)
+   assert aggregated == 10
+   assert coalesced == 10
+   assert counts["acceptedMetrics"] == 10
+   assert counts["acceptedValues"] == 50
+
+def test_spool_is_replayed_up_to_a_corrupt_record(isolated, connectorHome, aiopsApi):
+
+   # a segment left by an earlier run holds a good record, a corrupt one and another good one. The records
+   # from the corrupt one on are skipped. A batch spooled by this run is replayed as well
+
+   api = aiopsApi()
+   connectorHome.write(api.url, { "spoolReplayRate": "100" })
+
+   def spoolRecord(body, crc=None):
+      return struct.pack(">II", len(body), zlib.crc32(body) if crc is None else crc) + body
+
+   def groupsBody(host, clock):
+      return b'{"groups":[' + json.dumps({ "attributes": { "node": "host" + str(host), "component": "component", "group": "zabbix" }, "metrics": { "metric0": 1.0 }, "timestamp": str(clock * 1000), "tenantID": "ZABBIX", "resourceID": "host" + str(host) + ":component" }).encode("utf-8") + b']}'
+
+   spoolDir = connectorHome.path + "/log/spool"
+   os.makedirs(spoolDir)
+   with open(spoolDir + "/segment-000000000001.spool", "wb") as segment:
+      segment.write(spoolRecord(groupsBody(1, 1700000000)))
+      segment.write(spoolRecord(groupsBody(2, 1700000000), crc=1))
+      segment.write(spoolRecord(groupsBody(3, 1700000000)))
+
+   def check():
+      connector = connectorHome.load()
+      connector.startPublisher(1)
+      assert connector.spoolAppend(groupsBody(4, 1700000060))
+      waitFor(lambda: connector.statsTotals()["spoolReplayedBatches"] == 2 and not connector.spoolSegments and connector.spoolActive is None, what="the spool to be replayed")
+      return connector.statsTotals()["spoolCorruptRecords"], connector.statsTotals()["spoolRecordsWritten"]
+
+   corrupt, written = isolated(check)
+   assert corrupt == 1
+   assert written == 1
+   assert api.counts()["acceptedMetrics"] == 2
+   assert glob.glob(spoolDir + "/segment-*.spool") == []
+
+def test_refused_credentials_are_spooled(isolated, connectorHome, aiopsApi):
+
+   api = aiopsApi()
+   connectorHome.write(api.url, { "watsonApiKey": "wrong" })
+
+   def check():
+      connector = connectorHome.load()
+      connector.startPublisher(1)
+      return connector.postMetric(b'{"groups":[]}', retryCount=1), connector.statsTotals()["spoolRecordsWritten"]
+
+   result, written = isolated(check)
+   assert result == "saved"
+   assert written == 1
+   assert api.counts()["authFailures"] == 1
+   assert "FATAL: the metric API refused the credentials with code 401" in connectorHome.log()
+
+def test_refused_payload_is_discarded(isolated, connectorHome, aiopsApi):
+
+   api = aiopsApi()
+   connectorHome.write(api.url, {})
+
+   def check():
+      connector = connectorHome.load()
+      connector.startPublisher(1)
+      delivered = connector.postMetricBatch([ b'{"metrics": ', b'"not json"' ])
+      totals = connector.statsTotals()
+      return delivered, totals["restRejectedMetrics"], totals["restPostRetries"], totals["spoolRecordsWritten"]
+
+   delivered, rejected, retries, written = isolated(check)
+   assert delivered
+   assert rejected == 2
+   assert retries == 0
+   assert written == 0
+   assert api.counts()["badRequests"] == 1
+
+def test_undecodable_json_messages_are_dropped_and_committed(isolated, connectorHome, aiopsApi):
+
+   api = aiopsApi()
+   connectorHome.write(api.url, {})
+   clock = int(time.time())
+   values = [ zabbixMessage(host, 0, clock, 1.5) for host in range(20) ]
+   values[3] = values[3][:40]
+   values[11] = b"\xff\xfe not json"
+
+   def check():
+      connector = connectorHome.load()
+      committed = runPipeline(connector, values)
+      totals = connector.statsTotals()
+      return committed, totals["jsonDecodeErrors"], totals[connector.dropStatNames["decodeError"]], totals["restSentMetrics"]
+
+   committed, decodeErrors, dropped, sent = isolated(check)
+   assert committed == 20
+   assert decodeErrors == 2
+   assert dropped == 2
+   assert sent == 18
+   assert api.counts()["acceptedMetrics"] == 18
+
+def test_undecodable_avro_messages_are_counted_and_logged_once(isolated, connectorHome):
+
+   fastavro = pytest.importorskip("fastavro")
+   schema = { "type": "record", "name": "zabbix", "fields": [ { "name": "name", "type": "string" }, { "name": "clock", "type": "long" }, { "name": "value", "type": "double" } ] }
+   connectorHome.write(None, { "sevOneKafkaDataFormat": "Avro" })
+   with open(connectorHome.path + "/conf/sevone-avro-schema.json", "w") as schemaFile:
+      json.dump(schema, schemaFile)
+   parsedSchema = fastavro.parse_schema(schema)
+
+   def encode(record):
+      buffer = io.BytesIO()
+      fastavro.schemaless_writer(buffer, parsedSchema, record)
+      return buffer.getvalue()
+
+   records = [ { "name": "item" + str(item), "clock": 1700000000 + item, "value": item * 1.5 } for item in range(4) ]
+   values = [ encode(records[0]), encode(records[1])[:3], encode(records[2]) + b"\x00\x01", encode(records[3]) ]
+
+   def check():
+      connector = connectorHome.load()
+      return connector.fastAvroDecodeBatch(values), connector.statsTotals()["avroDecodeErrors"]
+
+   events, decodeErrors = isolated(check)
+   assert events == [ records[0], None, None, records[3] ]
+   assert decodeErrors == 2
+   assert connectorHome.log().count("unable to decode an Avro message") == 1
+
+def test_supervisor_restarts_a_killed_worker(isolated, connectorHome, aiopsApi):
+
+   api = aiopsApi()
+   connectorHome.write(api.url, { "workerRestartMinUptime": "0", "workerStatsFrequency": "1" })
+
+   def check():
+      connector = connectorHome.load()
+
+      # the fake broker limits the connector to one process, so the worker count is set after loading
+
+      connector.connectorWorkers = 2
+      supervisor = threading.Thread(target=connector.runSupervisor)
+      supervisor.start()
+      waitFor(lambda: len(connector.workerProcesses) == 2 and all(worker.is_alive() for worker in connector.workerProcesses.values()), what="the workers to start")
+      killedPid = connector.workerProcesses[1].pid
+      os.kill(killedPid, signal.SIGKILL)
+      waitFor(lambda: connector.workerProcesses[1].pid != killedPid and connector.workerProcesses[1].is_alive(), what="the worker to be restarted")
+      otherAlive = connector.workerProcesses[2].is_alive()
+      connector.shutdownRequest = True
+      supervisor.join(30)
+      return killedPid, connector.workerProcesses[1].pid, otherAlive, supervisor.is_alive()
+
+   killedPid, restartedPid, otherAlive, supervisorAlive = isolated(check)
+   assert restartedPid != killedPid
+   assert otherAlive
+   assert not supervisorAlive
+   assert "connector worker 1 (pid " + str(killedPid) + ") exited with code -9, restarting it" in connectorHome.log()